@@ -0,0 +1,253 @@
+"""与界面无关的对话、辩论和代码生成逻辑
+
+桌面界面、命令行批量任务和服务模式共用这里的实现，模块不依赖 tkinter，可以在无界面的
+进程中运行。模型调用出错时由 AsyncAPIClient 的 error_handler 回调报告；敏感词检查在
+输入和流式输出两端进行，发现敏感词时设置 stop_event 结束本次回答。
+"""
+import asyncio
+import re
+import threading
+
+from request_scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+SENSITIVE_REPLY = "抱歉，因包含敏感词无法回答。"
+# 每个附件最多附带的字符数，避免提示过长
+ATTACHMENT_PREVIEW_CHARS = 2000
+
+DEBATE_PERSONA_A = "你是辩手A，你对给定的话题持赞成态度，请有力地陈述你的观点。"
+DEBATE_PERSONA_B = "你是辩手B，你对给定的话题持反对态度，请针对辩手A的观点进行反驳。"
+
+# 代码块语言标识的各种写法
+LANGUAGE_IDS = {
+    "Python": ["python", "py"],
+    "JavaScript": ["javascript", "js"],
+    "Java": ["java"],
+    "C++": ["c++", "cpp", "cxx"],
+    "SQL": ["sql"]
+}
+_CODE_BLOCK = re.compile(r'```\s*([a-z\+]*)\s*\n([\s\S]*?)```', re.IGNORECASE | re.MULTILINE)
+
+
+def _preview(content):
+    return content[:ATTACHMENT_PREVIEW_CHARS] + "..." if len(content) > ATTACHMENT_PREVIEW_CHARS else content
+
+
+def format_attachments(attachments):
+    """把附件内容拼成附在问题或话题后面的文本，没有附件时返回空字符串"""
+    if not attachments:
+        return ""
+    text = "\n\n参考以下附件内容:\n"
+    for i, attachment in enumerate(attachments):
+        text += f"\n附件 {i+1}: 文件 '{attachment['filename']}' 的内容:\n"
+        text += f"{_preview(attachment['content'])}\n"
+    return text
+
+
+class FilteredReply:
+    """一次经过敏感词过滤的流式回答
+
+    迭代得到过滤后的文本块；发现敏感词时补上扣留的文本、设置 stop_event 并结束。
+    迭代结束后 text 为完整的过滤后回答，contains_sensitive 表示是否因敏感词终止。
+    """
+
+    def __init__(self, client, sensitive_filter, messages, temperature=0.7, stop_event=None,
+                 priority=PRIORITY_INTERACTIVE):
+        self.client = client
+        self.sensitive_filter = sensitive_filter
+        self.messages = messages
+        self.temperature = temperature
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.priority = priority
+        self.parts = []
+        self.contains_sensitive = False
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    @property
+    def stopped(self):
+        """被用户终止或因敏感词终止"""
+        return self.stop_event.is_set()
+
+    def __aiter__(self):
+        return self._run()
+
+    async def _run(self):
+        stream_filter = self.sensitive_filter.start_stream()
+        stream = self.client.stream(self.messages, self.temperature, self.stop_event, priority=self.priority)
+        try:
+            async for chunk in stream:
+                # 实时过滤（可捕获跨数据块的敏感词），发现敏感词立即终止
+                filtered_chunk, self.contains_sensitive = stream_filter.feed(chunk)
+                if self.contains_sensitive:
+                    filtered_chunk += stream_filter.flush()
+                if filtered_chunk:
+                    self.parts.append(filtered_chunk)
+                    yield filtered_chunk
+                if self.contains_sensitive:
+                    self.stop_event.set()
+                    break
+        finally:
+            await stream.aclose()
+        # 输出流结束后补上扣留的尾部文本
+        tail = stream_filter.flush()
+        if tail:
+            self.parts.append(tail)
+            yield tail
+
+
+class ChatReply(FilteredReply):
+    """对话回答，完整结束（未被终止）时记入对话并保存"""
+
+    def __init__(self, memory, context_report, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.memory = memory
+        self.context_report = context_report
+
+    async def _run(self):
+        async for chunk in super()._run():
+            yield chunk
+        if not self.stopped:
+            # 后台写盘的队列满时保存会阻塞，放到线程池中，不阻塞事件循环上的其他回答
+            await asyncio.get_running_loop().run_in_executor(None, self._save)
+
+    def _save(self):
+        self.memory.add_message("assistant", self.text)
+        self.memory.save_conversation()
+
+
+class ConversationEngine:
+    """带记忆的多轮对话：输入过滤、附件拼接、按 token 预算组装上下文、保存问答"""
+
+    def __init__(self, client, sensitive_filter, memory, context_builder):
+        self.client = client
+        self.sensitive_filter = sensitive_filter
+        self.memory = memory
+        self.context_builder = context_builder
+
+    def submit_question(self, question, attachments=()):
+        """过滤问题并记入当前对话，返回 (记入对话的问题, 是否因敏感词拒答)
+
+        包含敏感词时记入过滤后的问题和拒答，不再调用模型。
+        """
+        filtered_question, contains_sensitive = self.sensitive_filter.filter_text(question)
+        if contains_sensitive:
+            self.memory.add_message("user", filtered_question)
+            self.memory.add_message("assistant", SENSITIVE_REPLY)
+            self.memory.save_conversation()
+            return filtered_question, True
+        full_question = filtered_question + format_attachments(attachments)
+        self.memory.add_message("user", full_question)
+        return full_question, False
+
+    def reply(self, question, temperature=0.7, stop_event=None):
+        """为已记入对话的问题生成回答
+
+        在 token 预算内组装对话历史作为上下文，较早的对话压缩为摘要，并附上以往对话中的
+        相关片段；返回的 ChatReply 带有 context_report，迭代即可得到回答。
+        """
+        recalled = self.memory.recall(question)
+        messages, context_report = self.context_builder.build(self.memory.get_conversation_history(),
+                                                              recalled=recalled)
+        return ChatReply(self.memory, context_report, self.client, self.sensitive_filter, messages,
+                         temperature, stop_event)
+
+
+class DebateEngine:
+    """两个辩手轮流发言的多智能体辩论，默认以后台优先级排队，不挤占普通对话的额度"""
+
+    def __init__(self, client, sensitive_filter, rounds=3, priority=PRIORITY_BACKGROUND):
+        self.client = client
+        self.sensitive_filter = sensitive_filter
+        self.rounds = rounds
+        self.priority = priority
+
+    def filter_topic(self, topic, attachments=()):
+        """过滤话题，返回 (完整话题, 是否包含敏感词)；包含敏感词时返回过滤后的话题，不附带附件"""
+        filtered_topic, contains_sensitive = self.sensitive_filter.filter_text(topic)
+        if contains_sensitive:
+            return filtered_topic, True
+        return filtered_topic + format_attachments(attachments), False
+
+    async def run(self, topic, temperature=0.7, stop_event=None):
+        """异步生成器，产出 (事件, 回合, 辩手, 文本)
+
+        事件为 "turn"（辩手开始发言）、"chunk"（发言内容块）、"end"（发言结束，文本为完整发言）
+        或 "sensitive"（发言包含敏感词，辩论终止，文本为已输出的发言）；回合从 1 开始，辩手为 "A" 或 "B"。
+        """
+        stop_event = stop_event if stop_event is not None else threading.Event()
+        messages = [{"role": "system", "content": DEBATE_PERSONA_A},
+                    {"role": "user", "content": f"辩论话题是: '{topic}'。请开始你的开篇陈词。"}]
+        for i in range(1, self.rounds + 1):
+            if stop_event.is_set():
+                return
+            agent_a_response = None
+            async for event in self._turn(i, "A", messages, temperature, stop_event):
+                if event[0] == "end":
+                    agent_a_response = event[3]
+                yield event
+            if agent_a_response is None or stop_event.is_set():
+                return
+
+            messages = [{"role": "system", "content": DEBATE_PERSONA_B},
+                        {"role": "user", "content": f"话题是'{topic}'。刚刚辩手A说：'{agent_a_response}'。请你对此进行反驳。"}]
+            agent_b_response = None
+            async for event in self._turn(i, "B", messages, temperature, stop_event):
+                if event[0] == "end":
+                    agent_b_response = event[3]
+                yield event
+            if agent_b_response is None or stop_event.is_set():
+                return
+
+            messages = [{"role": "system", "content": DEBATE_PERSONA_A},
+                        {"role": "user", "content": f"继续关于'{topic}'的辩论。你的论点是'{agent_a_response}'。"
+                                                    f"辩手B反驳道：'{agent_b_response}'。请你回应。"}]
+
+    async def _turn(self, round_number, speaker, messages, temperature, stop_event):
+        yield "turn", round_number, speaker, ""
+        reply = FilteredReply(self.client, self.sensitive_filter, messages, temperature, stop_event, self.priority)
+        async for chunk in reply:
+            yield "chunk", round_number, speaker, chunk
+        if reply.contains_sensitive:
+            yield "sensitive", round_number, speaker, reply.text
+        elif not reply.stopped:
+            yield "end", round_number, speaker, reply.text
+
+
+def build_codegen_messages(request, language="Python", libraries="", add_comments=True, add_docstrings=False,
+                           explain_first=False, attachments=()):
+    """按代码生成选项构建 Prompt"""
+    system_prompt = f"你是一位精通 {language} 的资深软件开发专家。"
+    parts = [f"请为我生成一段 {language} 代码，我的需求是：'{request}'。", "\n请严格遵守以下要求："]
+    if libraries:
+        parts.append(f"- 必须使用以下库或框架：{libraries}。")
+    if add_comments:
+        parts.append("- 在代码的关键部分添加清晰的中文注释。")
+    if add_docstrings:
+        parts.append("- 为所有函数或类编写详细的文档字符串 (docstrings)。")
+    parts.append(f"- 所有的代码都必须包裹在 ```{language.lower()} ... ``` 格式的代码块中。")
+    if explain_first:
+        parts.append("\n在生成代码之前，请先用中文分步骤详细地解释你的实现思路，然后再给出完整的代码。")
+    if attachments:
+        parts.append(f"\n\n参考以下附件内容:")
+        for i, attachment in enumerate(attachments):
+            parts.append(f"\n附件 {i+1}: 文件 '{attachment['filename']}' 的内容:")
+            parts.append(_preview(attachment['content']))
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": "\n".join(parts)}]
+
+
+def is_language_match(code_block_lang, selected_lang):
+    """检查代码块语言标识是否与所选语言匹配"""
+    valid_ids = LANGUAGE_IDS.get(selected_lang, [])
+    # 如果代码块语言标识在有效标识列表中，或者没有语言标识但用户选择了该语言
+    return code_block_lang.lower() in valid_ids or (not code_block_lang and selected_lang == "C++")
+
+
+def extract_code(text, language):
+    """从回答中取出代码：优先取与所选语言匹配的第一个代码块，其次取第一个代码块，没有代码块时返回全文"""
+    matches = _CODE_BLOCK.findall(text)
+    if not matches:
+        return text
+    language_matches = [m for m in matches if is_language_match(m[0], language)]
+    return (language_matches or matches)[0][1]
@@ -0,0 +1,584 @@
+"""多用户服务模式
+
+一个进程为整个团队提供对话、辩论和代码生成服务：基于 asyncio 的 HTTP 服务器，回答以
+Server-Sent Events 流式返回。每个用户有独立的对话存储（storage_root/<用户名>），同一用户的
+对话请求依次处理；所有用户共用一个 AsyncAPIClient，即同一个连接池、限流调度和接口路由。
+客户端断开连接时立即终止对应的回答，未完成的回答不记入对话。
+
+注意：服务本身不做身份验证，X-User 请求头和 user 字段原样采信，任何能连上端口的人都能以
+任意用户名读写该用户的对话。因此默认只监听 127.0.0.1；要监听其他地址必须加 --allow-remote，
+并且只应部署在负责验证身份、并覆盖 X-User 请求头的反向代理之后。
+
+用法: python agent_service.py [--host 127.0.0.1] [--port 8080] [--storage service_data]
+      [--max-streams 200] [--max-sessions 100] [--words sensitive_words.json] [--allow-remote]
+
+接口（用户名由请求头 X-User 或请求体中的 user 字段给出）:
+    POST /chat       {"message": "...", "conversation_id": 可选, "temperature": 0.7, "attachments": [...]}
+    POST /debate     {"topic": "...", "rounds": 3, "temperature": 0.7}
+    POST /codegen    {"request": "...", "language": "Python", "libraries": "", "add_comments": true, ...}
+    GET  /conversations?user=...            该用户的对话列表
+    GET  /conversations/<对话id>?user=...   对话内容
+    GET  /health                            当前会话数和进行中的回答数
+    GET  /metrics                           Prometheus 文本格式的请求耗时统计
+
+流式接口依次发送 start、若干 chunk（辩论还有 turn、end）事件，最后以 done 事件结束，
+done 中的 status 为 ok、sensitive 或 stopped；调用模型出错时发送 error 事件。
+"""
+import argparse
+import asyncio
+import contextlib
+import ipaddress
+import json
+import os
+import re
+import signal
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from http import HTTPStatus
+
+from dotenv import load_dotenv
+
+from agent_core import (SENSITIVE_REPLY, ConversationEngine, DebateEngine, FilteredReply, build_codegen_messages,
+                        extract_code)
+from async_api_client import AsyncAPIClient
+from context_builder import ContextBuilder
+from memory import ConversationMemory, JournalConversationStore
+from recall_index import RecallIndex
+from sensitive_word_filter import SensitiveWordFilter
+
+# 请求体大小上限，附件内容也在其中
+MAX_BODY_BYTES = 2 * 1024 * 1024
+MAX_HEADERS = 100
+# 读取请求头和请求体的超时（秒）
+REQUEST_TIMEOUT = 30
+MAX_DEBATE_ROUNDS = 10
+# 用户名同时用作存储目录名，只允许字母、数字、汉字、下划线、点和短横线
+_USER_NAME = re.compile(r'^[\w\-][\w.\-]{0,63}$')
+
+
+class ServiceError(Exception):
+    """模型调用出错，由 AsyncAPIClient 的 error_handler 抛出，以 error 事件返回给客户端"""
+
+
+def _raise_service_error(title, message):
+    raise ServiceError(message)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class Request:
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400, "请求体不是有效的 JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "请求体必须是 JSON 对象")
+        return data
+
+    def user(self, data=None):
+        """请求头 X-User 优先，其次是请求体或查询参数中的 user"""
+        user = self.headers.get('x-user') or (data or {}).get('user') or self.query.get('user')
+        if not user:
+            raise HTTPError(400, "缺少用户名（X-User 请求头或 user 字段）")
+        if not _USER_NAME.match(user):
+            raise HTTPError(400, "用户名只能包含字母、数字、汉字、下划线、点和短横线，最长64个字符")
+        return user
+
+
+async def read_request(reader):
+    """读取一个 HTTP/1.1 请求，连接在请求开始前关闭时返回 None"""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, "请求行格式错误")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPError(431, "请求头过多")
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HTTPError(400, "Content-Length 无效")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, f"请求体超过 {MAX_BODY_BYTES // 1024} KB")
+    body = await reader.readexactly(length) if length else b''
+    path, _, query = target.partition('?')
+    query = {name: values[-1] for name, values in urllib.parse.parse_qs(query).items()}
+    if 'x-user' in headers:
+        # 汉字用户名可以直接以 UTF-8 发送，也可以按 UTF-8 百分号编码
+        headers['x-user'] = urllib.parse.unquote(headers['x-user'].encode('latin-1').decode('utf-8', 'replace'))
+    return Request(method.upper(), urllib.parse.unquote(path), query, headers, body)
+
+
+def _response_head(status, content_type, extra_headers=None, length=None):
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Content-Type: {content_type}",
+             "Connection: close"]
+    if length is not None:
+        lines.append(f"Content-Length: {length}")
+    for name, value in (extra_headers or {}).items():
+        lines.append(f"{name}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('utf-8')
+
+
+async def send_json(writer, status, payload, headers=None):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(_response_head(status, "application/json; charset=utf-8", headers, len(body)) + body)
+    await writer.drain()
+
+
+class EventStream:
+    """向客户端发送 SSE 事件；连接断开后设置 stop_event 并取消 task，之后的事件直接丢弃"""
+
+    def __init__(self, reader, writer, stop_event):
+        self.reader = reader
+        self.writer = writer
+        self.stop_event = stop_event
+        self.closed = False
+        self.watcher = None
+        # 产生事件的任务；stop_event 只在数据块之间检查，排队等待额度或首个内容块时要靠取消才能结束
+        self.task = None
+
+    async def open(self):
+        self.writer.write(_response_head(200, "text/event-stream; charset=utf-8",
+                                         {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}))
+        await self.writer.drain()
+        # 请求体已经读完，再读到 EOF 说明客户端已断开
+        self.watcher = asyncio.ensure_future(self._watch_disconnect())
+
+    async def _watch_disconnect(self):
+        try:
+            while await self.reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        self._disconnected()
+
+    def _disconnected(self):
+        self.closed = True
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def send(self, event, payload):
+        if self.closed:
+            return
+        self.writer.write(f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            self._disconnected()
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+
+
+class UserSession:
+    """一个用户的对话存储和对话引擎；ConversationMemory 只有一个当前对话，同一用户的对话请求用 lock 依次处理"""
+
+    def __init__(self, user, memory, engine):
+        self.user = user
+        self.memory = memory
+        self.engine = engine
+        self.lock = asyncio.Lock()
+        # 正在处理的请求数，不为 0 的会话不会被淘汰
+        self.users = 0
+        self.last_used = time.time()
+
+
+class SessionManager:
+    """按用户名创建和缓存会话，超过 max_sessions 时关闭最久未使用且没有请求在处理的会话"""
+
+    def __init__(self, client, sensitive_filter, storage_root="service_data", max_sessions=100,
+                 context_builder=None):
+        self.client = client
+        self.sensitive_filter = sensitive_filter
+        self.storage_root = storage_root
+        self.max_sessions = max_sessions
+        self.context_builder = context_builder if context_builder is not None else ContextBuilder(
+            max_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "8000")))
+        self.sessions = OrderedDict()
+        # 正在创建和正在关闭的会话：用户名 -> Future
+        self.pending = {}
+        self.closing = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _create(self, user):
+        memory = ConversationMemory(os.path.join(self.storage_root, user), store=JournalConversationStore(),
+                                    write_behind=True, recall_index=RecallIndex())
+        engine = ConversationEngine(self.client, self.sensitive_filter, memory, self.context_builder)
+        return UserSession(user, memory, engine)
+
+    @contextlib.asynccontextmanager
+    async def use(self, user):
+        """取得用户的会话，使用期间不会被淘汰"""
+        loop = asyncio.get_running_loop()
+        while user not in self.sessions:
+            # 载入对话索引需要读盘，放到线程池中，不阻塞其他用户的流式输出；
+            # 同一用户的并发请求等待同一次创建，不同用户的会话可以同时创建
+            # 刚被淘汰的会话要等它写完盘再重新打开
+            pending = self.pending.get(user) or self.closing.get(user)
+            if pending is not None:
+                await pending
+                continue
+            pending = self.pending[user] = loop.run_in_executor(None, self._create, user)
+            try:
+                self.sessions[user] = await pending
+            finally:
+                del self.pending[user]
+        session = self.sessions[user]
+        self.sessions.move_to_end(user)
+        session.users += 1
+        self._evict(loop)
+        try:
+            yield session
+        finally:
+            session.users -= 1
+            session.last_used = time.time()
+
+    def _evict(self, loop):
+        idle = [user for user, session in self.sessions.items() if not session.users]
+        for user in idle[:max(0, len(self.sessions) - self.max_sessions)]:
+            # 关闭时要等后台写盘完成，在线程池中进行
+            closing = self.closing[user] = loop.run_in_executor(None, self.sessions.pop(user).memory.close)
+            closing.add_done_callback(lambda _, user=user: self.closing.pop(user, None))
+
+    def close(self):
+        """写完各用户排队的保存"""
+        for session in self.sessions.values():
+            session.memory.close()
+        self.sessions.clear()
+
+
+class AgentService:
+    def __init__(self, client, sensitive_filter, storage_root="service_data", max_streams=200, max_sessions=100):
+        self.client = client
+        self.sensitive_filter = sensitive_filter
+        self.sessions = SessionManager(client, sensitive_filter, storage_root, max_sessions)
+        self.max_streams = max_streams
+        self.active_streams = 0
+        self.served_streams = 0
+        self.started_at = time.time()
+        self.server = None
+        self.routes = {
+            ("POST", "/chat"): self.chat,
+            ("POST", "/debate"): self.debate,
+            ("POST", "/codegen"): self.codegen,
+            ("GET", "/conversations"): self.list_conversations,
+            ("GET", "/health"): self.health,
+            ("GET", "/metrics"): self.metrics,
+        }
+
+    async def start(self, host="127.0.0.1", port=8080):
+        self.server = await asyncio.start_server(self.handle, host, port, limit=MAX_BODY_BYTES, backlog=1024)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        """停止接受新连接；进行中的回答随事件循环停止而结束"""
+        if self.server is not None:
+            self.server.close()
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(read_request(reader), REQUEST_TIMEOUT)
+                if request is None:
+                    return
+                handler = self.routes.get((request.method, request.path))
+                if handler is None and request.method == "GET" and request.path.startswith("/conversations/"):
+                    handler = self.get_conversation
+                if handler is None:
+                    raise HTTPError(404, f"未知接口 {request.method} {request.path}")
+                await handler(request, reader, writer)
+            except HTTPError as e:
+                await send_json(writer, e.status, {'error': str(e)}, e.headers)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                await send_json(writer, 408, {'error': "读取请求超时或请求不完整"})
+        except ConnectionError:
+            pass
+        except Exception as e:
+            print(f"处理请求失败: {e}")
+        finally:
+            writer.close()
+
+    @contextlib.contextmanager
+    def _stream_slot(self):
+        """占用一个回答名额，等待用户会话和对话锁的时间也计入，名额用完时返回 503"""
+        if self.active_streams >= self.max_streams:
+            raise HTTPError(503, f"同时进行的回答已达上限 {self.max_streams}，请稍后重试", {"Retry-After": "1"})
+        self.active_streams += 1
+        try:
+            yield
+        finally:
+            self.active_streams -= 1
+
+    async def _stream(self, reader, writer, produce):
+        """以 SSE 返回 produce(events, stop_event) 产生的事件，调用模型出错时发送 error 事件；
+        produce 在单独的任务中运行，客户端断开时被取消"""
+        stop_event = threading.Event()
+        events = EventStream(reader, writer, stop_event)
+        try:
+            await events.open()
+            task = events.task = asyncio.ensure_future(produce(events, stop_event))
+            try:
+                await asyncio.wait([task])
+            finally:
+                task.cancel()
+            if not task.cancelled():
+                try:
+                    task.result()
+                except ServiceError as e:
+                    await events.send("error", {'message': str(e)})
+        finally:
+            self.served_streams += 1
+            events.close()
+
+    @staticmethod
+    def _temperature(data):
+        try:
+            return min(2.0, max(0.0, float(data.get('temperature', 0.7))))
+        except (TypeError, ValueError):
+            raise HTTPError(400, "temperature 必须是数字")
+
+    @staticmethod
+    def _attachments(data):
+        attachments = data.get('attachments') or []
+        if not isinstance(attachments, list) or not all(
+                isinstance(a, dict) and isinstance(a.get('content'), str) for a in attachments):
+            raise HTTPError(400, "attachments 必须是 [{filename, content}] 列表")
+        return [{'filename': a.get('filename', "附件"), 'content': a['content']} for a in attachments]
+
+    @staticmethod
+    def _status(reply):
+        if reply.contains_sensitive:
+            return "sensitive"
+        return "stopped" if reply.stopped else "ok"
+
+    async def chat(self, request, reader, writer):
+        data = request.json()
+        user = request.user(data)
+        message = data.get('message')
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPError(400, "缺少 message")
+        temperature = self._temperature(data)
+        attachments = self._attachments(data)
+        conversation_id = data.get('conversation_id')
+        # 读写对话文件、检索以往对话和提交保存（写盘队列满时会阻塞）都放到线程池中，不阻塞其他用户的流式输出
+        loop = asyncio.get_running_loop()
+        with self._stream_slot():
+            async with self.sessions.use(user) as session, session.lock:
+                if conversation_id:
+                    if not await loop.run_in_executor(None, session.memory.open_conversation, conversation_id):
+                        raise HTTPError(404, f"对话 {conversation_id} 不存在")
+                else:
+                    session.memory.start_new_conversation()
+                conversation_id = session.memory.current_conversation['id']
+
+                async def produce(events, stop_event):
+                    await events.send("start", {'conversation_id': conversation_id})
+                    full_question, refused = await loop.run_in_executor(
+                        None, session.engine.submit_question, message, attachments)
+                    if refused:
+                        await events.send("chunk", {'content': SENSITIVE_REPLY})
+                        await events.send("done", {'conversation_id': conversation_id, 'status': "sensitive"})
+                        return
+                    reply = await loop.run_in_executor(
+                        None, session.engine.reply, full_question, temperature, stop_event)
+                    chunks = reply.__aiter__()
+                    try:
+                        async for chunk in chunks:
+                            await events.send("chunk", {'content': chunk})
+                    finally:
+                        await chunks.aclose()
+                    await events.send("done", {'conversation_id': conversation_id, 'status': self._status(reply)})
+
+                await self._stream(reader, writer, produce)
+
+    async def debate(self, request, reader, writer):
+        data = request.json()
+        request.user(data)
+        topic = data.get('topic')
+        if not isinstance(topic, str) or not topic.strip():
+            raise HTTPError(400, "缺少 topic")
+        temperature = self._temperature(data)
+        attachments = self._attachments(data)
+        try:
+            rounds = min(MAX_DEBATE_ROUNDS, max(1, int(data.get('rounds', 3))))
+        except (TypeError, ValueError):
+            raise HTTPError(400, "rounds 必须是整数")
+        engine = DebateEngine(self.client, self.sensitive_filter, rounds)
+
+        async def produce(events, stop_event):
+            full_topic, refused = engine.filter_topic(topic, attachments)
+            await events.send("start", {'rounds': rounds})
+            if refused:
+                await events.send("sensitive", {'round': 0, 'speaker': None, 'content': SENSITIVE_REPLY})
+                await events.send("done", {'status': "sensitive"})
+                return
+            status = "ok"
+            turns = engine.run(full_topic, temperature, stop_event)
+            try:
+                async for event, round_number, speaker, text in turns:
+                    await events.send(event, {'round': round_number, 'speaker': speaker, 'content': text})
+                    if event == "sensitive":
+                        status = "sensitive"
+            finally:
+                await turns.aclose()
+            if status == "ok" and stop_event.is_set():
+                status = "stopped"
+            await events.send("done", {'status': status})
+
+        with self._stream_slot():
+            await self._stream(reader, writer, produce)
+
+    async def codegen(self, request, reader, writer):
+        data = request.json()
+        request.user(data)
+        code_request = data.get('request')
+        if not isinstance(code_request, str) or not code_request.strip():
+            raise HTTPError(400, "缺少 request")
+        language = data.get('language', "Python")
+        temperature = self._temperature(data)
+        attachments = self._attachments(data)
+
+        async def produce(events, stop_event):
+            await events.send("start", {'language': language})
+            filtered_request, contains_sensitive = self.sensitive_filter.filter_text(code_request)
+            if contains_sensitive:
+                await events.send("chunk", {'content': SENSITIVE_REPLY})
+                await events.send("done", {'status': "sensitive", 'code': ""})
+                return
+            messages = build_codegen_messages(
+                filtered_request, language, data.get('libraries', ""), add_comments=data.get('add_comments', True),
+                add_docstrings=data.get('add_docstrings', False), explain_first=data.get('explain_first', False),
+                attachments=attachments)
+            reply = FilteredReply(self.client, self.sensitive_filter, messages, temperature, stop_event)
+            chunks = reply.__aiter__()
+            try:
+                async for chunk in chunks:
+                    await events.send("chunk", {'content': chunk})
+            finally:
+                await chunks.aclose()
+            await events.send("done", {'status': self._status(reply), 'code': extract_code(reply.text, language)})
+
+        with self._stream_slot():
+            await self._stream(reader, writer, produce)
+
+    async def list_conversations(self, request, reader, writer):
+        async with self.sessions.use(request.user()) as session:
+            conversations = session.memory.get_all_conversations()
+        await send_json(writer, 200, {'conversations': conversations})
+
+    async def get_conversation(self, request, reader, writer):
+        conversation_id = request.path[len("/conversations/"):]
+        async with self.sessions.use(request.user()) as session:
+            if conversation_id not in session.memory.index:
+                raise HTTPError(404, f"对话 {conversation_id} 不存在")
+            messages = await asyncio.get_running_loop().run_in_executor(
+                None, session.memory.get_conversation_history, conversation_id)
+        await send_json(writer, 200, {'conversation_id': conversation_id,
+                                      'messages': [msg.to_dict() for msg in messages]})
+
+    async def health(self, request, reader, writer):
+        await send_json(writer, 200, {'status': "ok", 'uptime': round(time.time() - self.started_at),
+                                      'sessions': len(self.sessions), 'active_streams': self.active_streams,
+                                      'max_streams': self.max_streams, 'served_streams': self.served_streams,
+                                      'endpoints': self.client.router.stats()})
+
+    async def metrics(self, request, reader, writer):
+        body = self.client.metrics.prometheus_text().encode('utf-8')
+        writer.write(_response_head(200, "text/plain; version=0.0.4; charset=utf-8", length=len(body)) + body)
+        await writer.drain()
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def is_loopback(host):
+    """host 是否只能从本机访问（localhost 或回环地址）"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多用户对话、辩论和代码生成服务（SSE 流式输出）")
+    parser.add_argument('--host', default="127.0.0.1", help="监听地址")
+    parser.add_argument('--port', type=int, default=8080, help="监听端口")
+    parser.add_argument('--storage', default="service_data", help="各用户对话的存储目录")
+    parser.add_argument('--max-streams', type=int, default=200, help="同时进行的回答数上限，超过时返回 503")
+    parser.add_argument('--max-sessions', type=int, default=100, help="保持打开的用户会话数")
+    parser.add_argument('--words', default="sensitive_words.json", help="敏感词库文件")
+    parser.add_argument('--allow-remote', action='store_true',
+                        help="允许监听本机以外的地址；服务不验证 X-User，只应部署在负责验证身份的反向代理之后")
+    args = parser.parse_args()
+    if not is_loopback(args.host) and not args.allow_remote:
+        print(f"拒绝监听 {args.host}：服务不验证用户身份，X-User 请求头原样采信，任何能连上端口的人都能读写"
+              f"任意用户的对话。确需对外提供服务时请部署在验证身份的反向代理之后，并加 --allow-remote")
+        return
+
+    load_dotenv()
+    api_key = os.getenv("SILICONFLOW_API_KEY")
+    if not api_key:
+        print("请在您的 .env 文件中设置 SILICONFLOW_API_KEY。")
+        return
+    # 所有用户共用一个连接池，未在 .env 中设置时按回答数上限放宽连接数，避免在连接池中排队超时
+    os.environ.setdefault("HTTP_MAX_CONNECTIONS", str(args.max_streams))
+    os.environ.setdefault("HTTP_MAX_KEEPALIVE", str(args.max_streams))
+    client = AsyncAPIClient(api_key, os.getenv("BASE_URL", "https://api.siliconflow.cn/v1"),
+                            os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-V3"), error_handler=_raise_service_error)
+    client.metrics.start_from_env()
+    service = AgentService(client, SensitiveWordFilter(args.words), args.storage, max(1, args.max_streams),
+                           max(1, args.max_sessions))
+    # 以 kill 停止服务时同样写完排队的保存再退出
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        host, port = client.submit(service.start(args.host, args.port)).result()
+        print(f"服务已启动: http://{host}:{port}（同时进行的回答上限 {service.max_streams}）")
+        # 不能在事件循环线程上 join：被信号打断后 client.close() 中的 join 会提前返回
+        threading.Event().wait()
+    except OSError as e:
+        print(f"启动服务失败: {e}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.submit(service.stop()).result(timeout=5)
+        client.close()
+        # 事件循环停止后不会再有新消息，写完各用户排队的保存
+        service.sessions.close()
+        print(f"已处理 {service.served_streams} 个流式请求")
+
+
+if __name__ == "__main__":
+    main()
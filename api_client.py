@@ -1,37 +1,74 @@
+import importlib.util
 import os
+
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
-import tkinter as tk
-from tkinter import messagebox
+
+from response_cache import ResponseCache
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+def http_client_options():
+    """按 .env 中的设置生成连接池参数，空闲连接保持复用，装有 h2 时启用 HTTP/2"""
+    limits = httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "10")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "5")),
+        keepalive_expiry=_env_float("HTTP_KEEPALIVE_EXPIRY", "120"),
+    )
+    # read 是两次收到数据之间的最长等待时间，流式输出时相当于单个数据块的超时
+    timeout = httpx.Timeout(
+        connect=_env_float("HTTP_CONNECT_TIMEOUT", "10"),
+        read=_env_float("HTTP_READ_TIMEOUT", "120"),
+        write=_env_float("HTTP_WRITE_TIMEOUT", "30"),
+        pool=_env_float("HTTP_POOL_TIMEOUT", "10"),
+    )
+    http2 = os.getenv("HTTP2", "auto").lower()
+    if http2 == "auto":
+        http2 = importlib.util.find_spec("h2") is not None
+    else:
+        http2 = http2 in ("1", "true", "yes")
+    return {'limits': limits, 'timeout': timeout, 'http2': http2}
+
+
+def print_error(title, message):
+    """默认的错误回调：输出到控制台，不依赖界面"""
+    print(f"{title}: {message}")
+
 
 class APIClient:
-    def __init__(self):
+    """从 .env 读取的接口配置、回答缓存和错误回调；请求由 AsyncAPIClient.from_api_client 创建的异步客户端发出"""
+
+    def __init__(self, error_handler=None):
         load_dotenv()
         api_key = os.getenv("SILICONFLOW_API_KEY")
         base_url = os.getenv("BASE_URL", "https://api.siliconflow.cn/v1")
 
         if not api_key:
-            messagebox.showerror("API密钥错误", "请在您的 .env 文件中设置 SILICONFLOW_API_KEY。")
-            raise ValueError("未找到API密钥")
+            raise ValueError("请在您的 .env 文件中设置 SILICONFLOW_API_KEY。")
 
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
-        self.model = os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-V3")
+        # 出错时以 (标题, 信息) 调用，默认输出到控制台
+        self.error_handler = error_handler if error_handler is not None else print_error
 
-    def get_response_stream(self, messages, temperature=0.7, stop_event=None):
-        try:
-            stream = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                stream=True,
-                temperature=temperature
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-V3")
+        # 低温度请求的回答缓存，默认关闭（.env 中 RESPONSE_CACHE=1 开启）
+        self.cache = None
+        if os.getenv("RESPONSE_CACHE", "0") == "1":
+            self.cache = ResponseCache(
+                os.getenv("RESPONSE_CACHE_PATH", "response_cache.db"),
+                max_disk_bytes=int(os.getenv("RESPONSE_CACHE_MAX_MB", "64")) * 1024 * 1024,
+                ttl=_env_float("RESPONSE_CACHE_TTL", "604800"),
             )
-            for chunk in stream:
-                if stop_event and stop_event.is_set():
-                    break
-
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
-        except Exception as e:
-            if not (stop_event and stop_event.is_set()):
-                messagebox.showerror("API错误", f"调用API时发生错误: {str(e)}")
-                yield f"\n[错误] {str(e)}"
+        self.cache_max_temperature = _env_float("RESPONSE_CACHE_MAX_TEMPERATURE", "0.3")
+
+    def close(self):
+        """关闭回答缓存"""
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(f"回答缓存：命中 {stats['memory_hits'] + stats['disk_hits']} 次，未命中 {stats['misses']} 次，"
+                  f"命中率 {stats['hit_rate']:.0%}")
+            self.cache.close()
@@ -1,70 +1,19 @@
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, ttk
+import asyncio
 import threading
+import traceback
 import json
 import os
-from memory import ConversationMemory
+from memory import ConversationMemory, JournalConversationStore
+from context_builder import ContextBuilder
+from recall_index import RecallIndex
+from agent_core import (SENSITIVE_REPLY, ConversationEngine, DebateEngine, FilteredReply, build_codegen_messages,
+                        extract_code, format_attachments)
 from tkinter import filedialog
 from tkinter.scrolledtext import ScrolledText
 import base64
 from file_processor import extract_text_from_file
-import sensitive_word_filter
-
-class SensitiveWordFilter:
-    """敏感词过滤类，负责加载、管理和过滤敏感词"""
-    
-    def __init__(self, file_path="sensitive_words.json"):
-        self.file_path = file_path
-        self.sensitive_words = self.load_sensitive_words()
-        
-    def load_sensitive_words(self):
-        """从文件加载敏感词库"""
-        try:
-            if os.path.exists(self.file_path):
-                with open(self.file_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            # 如果文件不存在，返回默认敏感词库
-            return ["色情", "毒品", "傻逼"]
-        except Exception as e:
-            print(f"加载敏感词库失败: {e}")
-            return []
-            
-    def save_sensitive_words(self):
-        """保存敏感词库到文件"""
-        try:
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.sensitive_words, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"保存敏感词库失败: {e}")
-            
-    def add_sensitive_word(self, word):
-        """添加敏感词"""
-        if word and word not in self.sensitive_words:
-            self.sensitive_words.append(word)
-            self.save_sensitive_words()
-            return True
-        return False
-        
-    def remove_sensitive_word(self, word):
-        """移除敏感词"""
-        if word in self.sensitive_words:
-            self.sensitive_words.remove(word)
-            self.save_sensitive_words()
-            return True
-        return False
-        
-    def filter_text(self, text):
-        """过滤文本中的敏感词，返回过滤后的文本和是否包含敏感词的标志"""
-        contains_sensitive = False
-        filtered_text = text
-        
-        for word in self.sensitive_words:
-            if word in filtered_text:
-                contains_sensitive = True
-                filtered_text = filtered_text.replace(word, '*' * len(word))
-                
-        return filtered_text, contains_sensitive
-
 
 class BasePage(tk.Frame):
     """所有页面的基类，包含共享的控件和元素。"""
@@ -73,6 +22,8 @@ class BasePage(tk.Frame):
         super().__init__(parent)
         self.controller = controller
         self.sensitive_filter = controller.sensitive_filter  # 获取敏感词过滤器实例
+        self.stop_event = None
+        self.task = None  # 正在事件循环上运行的请求
 
         # --- 顶部控制栏 ---
         top_frame = tk.Frame(self)
@@ -93,6 +44,27 @@ class BasePage(tk.Frame):
             tk.Radiobutton(temp_frame, text=text, variable=self.temp_var, value=value).pack(side=tk.LEFT)
         temp_frame.pack(side=tk.RIGHT)
 
+    def submit_task(self, coro):
+        """把页面的请求协程提交到共享的事件循环，不再为每个请求创建线程。"""
+        self.stop_event = threading.Event()
+        self.task = self.controller.async_client.submit(coro(self.stop_event))
+        self.task.add_done_callback(self.report_task_error)
+
+    def report_task_error(self, future):
+        """请求协程因未处理的异常结束时打印堆栈并通过 error_handler 报告，被取消不算出错。"""
+        if future.cancelled() or future.exception() is None:
+            return
+        error = future.exception()
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.controller.async_client.error_handler("程序错误", f"处理请求时发生错误: {error}")
+
+    def stop_response(self):
+        """终止当前请求：设置终止标志并取消协程，等待首个数据块时也能立即结束。"""
+        if self.stop_event:
+            self.stop_event.set()
+        if self.task:
+            self.task.cancel()
+
     def get_temperature(self):
         """将GUI上的选项映射为具体的temperature数值。"""
         mapping = {"low": 0.2, "medium": 0.7, "high": 1.2}
@@ -168,8 +140,8 @@ class SensitiveWordsManager:
     def refresh_word_list(self):
         """刷新敏感词列表"""
         self.word_listbox.delete(0, tk.END)
-        for word in self.sensitive_filter.sensitive_words:
-            self.word_listbox.insert(tk.END, word)
+        if self.sensitive_filter.sensitive_words:
+            self.word_listbox.insert(tk.END, *self.sensitive_filter.sensitive_words)
             
     def add_word(self):
         """添加敏感词"""
@@ -177,6 +149,9 @@ class SensitiveWordsManager:
         if not word:
             messagebox.showwarning("警告", "请输入敏感词!")
             return
+        if not self.sensitive_filter.is_matchable(word):
+            messagebox.showwarning("警告", f"敏感词 '{word}' 只包含空白或标点，无法用于匹配!")
+            return
             
         if self.sensitive_filter.add_sensitive_word(word):
             self.refresh_word_list()
@@ -217,12 +192,8 @@ class SensitiveWordsManager:
                 else:
                     words = [line.strip() for line in f if line.strip()]
                     
-            # 添加到敏感词库
-            added_count = 0
-            for word in words:
-                if self.sensitive_filter.add_sensitive_word(word):
-                    added_count += 1
-                    
+            # 批量添加到敏感词库，只写一次文件
+            added_count = self.sensitive_filter.add_sensitive_words(words)
             self.refresh_word_list()
             messagebox.showinfo("成功", f"已从文件导入 {added_count} 个敏感词")
         except Exception as e:
@@ -250,6 +221,78 @@ class SensitiveWordsManager:
             messagebox.showerror("错误", f"导出敏感词库失败: {str(e)}")
 
 
+class MetricsPanel:
+    """请求耗时调试面板，每秒刷新最近请求的 p50/p95"""
+
+    ROWS = (
+        ('queue_seconds', "排队", "ms"),
+        ('connect_seconds', "建立连接", "ms"),
+        ('first_byte_seconds', "首个数据块", "ms"),
+        ('ttft_seconds', "首字", "ms"),
+        ('total_seconds', "总耗时", "ms"),
+        ('tokens_per_second', "输出速度", "token/s"),
+        ('chunks', "数据块数", ""),
+    )
+
+    def __init__(self, parent, metrics):
+        self.metrics = metrics
+
+        self.window = tk.Toplevel(parent)
+        self.window.title("请求耗时统计")
+        self.window.geometry("420x300")
+
+        frame = tk.Frame(self.window, padx=10, pady=10)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        for column, title in enumerate(("指标", "p50", "p95", "样本数")):
+            tk.Label(frame, text=title, font=("Arial", 10, "bold")).grid(row=0, column=column, sticky=tk.W, padx=5)
+        self.cells = {}
+        for row, (name, label, _) in enumerate(self.ROWS, start=1):
+            tk.Label(frame, text=label).grid(row=row, column=0, sticky=tk.W, padx=5)
+            self.cells[name] = [tk.Label(frame, text="-") for _ in range(3)]
+            for column, cell in enumerate(self.cells[name], start=1):
+                cell.grid(row=row, column=column, sticky=tk.W, padx=5)
+
+        self.totals_label = tk.Label(frame, text="", anchor=tk.W, justify=tk.LEFT)
+        self.totals_label.grid(row=len(self.ROWS) + 1, column=0, columnspan=4, sticky=tk.W, pady=(10, 0))
+        tk.Button(frame, text="导出指标", command=self.export_metrics).grid(
+            row=len(self.ROWS) + 2, column=0, sticky=tk.W, pady=5)
+
+        self.refresh()
+
+    @staticmethod
+    def _format(value, unit):
+        if value is None:
+            return "-"
+        if unit == "ms":
+            return f"{value * 1000:.0f} ms"
+        return f"{value:.1f} {unit}".strip()
+
+    def refresh(self):
+        """刷新统计，窗口关闭后停止"""
+        if not self.window.winfo_exists():
+            return
+        summary = self.metrics.summary()
+        for name, _, unit in self.ROWS:
+            p50, p95, count = self.cells[name]
+            p50.config(text=self._format(summary[name]['p50'], unit))
+            p95.config(text=self._format(summary[name]['p95'], unit))
+            count.config(text=str(summary[name]['count']))
+        self.totals_label.config(
+            text=f"请求 {summary['requests']}，错误 {summary['errors']}，重试 {summary['retries']}，"
+                 f"输入 {summary['prompt_tokens']} token，输出 {summary['completion_tokens']} token")
+        self.window.after(1000, self.refresh)
+
+    def export_metrics(self):
+        """把当前指标以 Prometheus 文本格式导出到文件"""
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".prom",
+            filetypes=[("Prometheus文本", "*.prom"), ("文本文件", "*.txt"), ("所有文件", "*.*")]
+        )
+        if file_path:
+            self.metrics.write(file_path)
+
+
 class HomePage(tk.Frame):
     """应用的主页面。"""
 
@@ -268,8 +311,14 @@ class ChatPage(BasePage):
 
     def __init__(self, parent, controller):
         super().__init__(parent, controller)
-        self.stop_event = None
-        self.memory = ConversationMemory()
+        # 追加式保存，每次只写入新消息；写盘由后台线程完成，不阻塞界面和流式输出；
+        # 所有消息同时加入本地倒排索引，提问时检索以往对话中的相关内容
+        self.memory = ConversationMemory(store=JournalConversationStore(), write_behind=True,
+                                         recall_index=RecallIndex())
+        # 按 token 预算组装上下文，可在 .env 中用 CONTEXT_MAX_TOKENS 调整
+        self.context_builder = ContextBuilder(max_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "8000")))
+        self.engine = ConversationEngine(controller.async_client, self.sensitive_filter, self.memory,
+                                         self.context_builder)
         self.attachments = []  # 存储附件信息
         
         # 历史对话管理框架 - 单行布局
@@ -477,81 +526,54 @@ class ChatPage(BasePage):
             messagebox.showwarning("警告", "请输入问题或添加附件。")
             return
 
-        # 过滤敏感词
-        filtered_question, contains_sensitive = self.sensitive_filter.filter_text(question)
-        
-        if contains_sensitive:
-            # 修改：显示过滤后的问题并终止对话
-            self.output.insert(tk.END, f"\n\n您: {filtered_question}\nAI: 抱歉，因包含敏感词无法回答。\n")
-            self.memory.add_message("user", filtered_question)
-            self.memory.add_message("assistant", "抱歉，因包含敏感词无法回答。")
-            self.memory.save_conversation()
-            self.update_conversation_dropdown()
-            self.entry.delete(0, tk.END)
-            return
-
-        # 构建包含附件内容的完整问题
-        full_question = filtered_question
-        
-        if self.attachments:
-            full_question += "\n\n参考以下附件内容:\n"
-            
-            for i, attachment in enumerate(self.attachments):
-                # 对于文件，提取并添加内容
-                full_question += f"\n附件 {i+1}: 文件 '{attachment['filename']}' 的内容:\n"
-                # 限制内容长度，避免过长
-                content = attachment['content']
-                if len(content) > 2000:
-                    content = content[:2000] + "..."
-                full_question += f"{content}\n"
-
-        self.output.insert(tk.END, f"\n\n您: {full_question}\nAI: ")
-        self.memory.add_message("user", full_question)
+        attachments = list(self.attachments)
         self.entry.delete(0, tk.END)
 
         self.submit_button.config(state=tk.DISABLED)
         self.stop_button.config(state=tk.NORMAL)
 
-        self.stop_event = threading.Event()
-        thread = threading.Thread(target=self.get_response, args=(full_question, self.stop_event))
-        thread.start()
-
-    def stop_response(self):
-        if self.stop_event:
-            self.stop_event.set()
+        self.submit_task(lambda stop_event: self.get_response(question, attachments, stop_event))
 
-    def get_response(self, question, stop_event):
+    async def get_response(self, question, attachments, stop_event):
         try:
             self.controller.set_status("正在获取回答...")
             temperature = self.get_temperature()
-            
-            # 获取对话历史作为上下文
-            messages = [{"role": "user" if msg['role'] == "user" else "assistant", 
-                         "content": msg['content']} 
-                        for msg in self.memory.get_conversation_history()]
-            
-            response_content = ""
-            for content_chunk in self.controller.api_client.get_response_stream(
-                messages, temperature, stop_event
-            ):
-                # 修改：实时过滤AI响应，发现敏感词立即终止
-                filtered_chunk, contains_sensitive = self.sensitive_filter.filter_text(content_chunk)
-                response_content += filtered_chunk
-                self.output.insert(tk.END, filtered_chunk)
+            # 记入对话、检索以往对话和读取对话历史都要读写磁盘，放到线程池中，不阻塞其他流式输出
+            loop = asyncio.get_running_loop()
+
+            # 过滤敏感词并记入对话，问题包含敏感词时直接拒答
+            full_question, contains_sensitive = await loop.run_in_executor(
+                None, self.engine.submit_question, question, attachments)
+            if contains_sensitive:
+                # 修改：显示过滤后的问题并终止对话
+                self.output.insert(tk.END, f"\n\n您: {full_question}\nAI: {SENSITIVE_REPLY}\n")
+                self.update_conversation_dropdown()
+                return
+            self.output.insert(tk.END, f"\n\n您: {full_question}\nAI: ")
+
+            # 在 token 预算内组装对话历史作为上下文，较早的对话压缩为摘要，并附上以往对话中的相关片段
+            reply = await loop.run_in_executor(None, self.engine.reply, full_question, temperature, stop_event)
+            context_report = reply.context_report
+            if context_report['dropped_tokens']:
+                self.controller.set_status(
+                    f"正在获取回答...（上下文约 {context_report['total_tokens']} tokens，"
+                    f"较早的 {context_report['dropped_messages']} 条消息已压缩，省略约 {context_report['dropped_tokens']} tokens）")
+            elif context_report['recalled_messages']:
+                self.controller.set_status(
+                    f"正在获取回答...（已参考 {context_report['recalled_messages']} 条以往对话中的相关内容）")
+
+            # 回答经过实时过滤（可捕获跨数据块的敏感词），完整结束时由 engine 记入对话
+            async for content_chunk in reply:
+                self.output.insert(tk.END, content_chunk)
                 self.output.see(tk.END)
-                
-                if contains_sensitive:
-                    # 修改：发现敏感词时终止输出并提示
-                    self.output.insert(tk.END, "\n\n[系统提示] 部分内容包含敏感词，已终止输出。\n")
-                    self.output.see(tk.END)
-                    stop_event.set()  # 终止API调用
-                    break  # 跳出循环
-                    
-            if not stop_event.is_set():
-                self.memory.add_message("assistant", response_content)
-                self.memory.save_conversation()
+
+            if reply.contains_sensitive:
+                # 修改：发现敏感词时终止输出并提示
+                self.output.insert(tk.END, "\n\n[系统提示] 部分内容包含敏感词，已终止输出。\n")
+                self.output.see(tk.END)
+            elif not reply.stopped:
                 self.update_conversation_dropdown()
-                
+
         finally:
             status_text = "用户已终止" if stop_event.is_set() else "回答完成"
             self.controller.set_status(status_text)
@@ -564,7 +586,7 @@ class MultiAgentPage(BasePage):
 
     def __init__(self, parent, controller):
         super().__init__(parent, controller)
-        self.stop_event = None
+        self.engine = DebateEngine(controller.async_client, self.sensitive_filter)
         self.attachments = []  # 存储附件信息
 
         # 附件控制按钮 - 放在输入框上方
@@ -607,33 +629,18 @@ class MultiAgentPage(BasePage):
             messagebox.showwarning("警告", "请输入一个辩论话题或添加附件。")
             return
 
-        # 过滤敏感词
-        filtered_topic, contains_sensitive = self.sensitive_filter.filter_text(topic)
-        
+        # 过滤敏感词，构建包含附件内容的完整话题
+        full_topic, contains_sensitive = self.engine.filter_topic(topic, self.attachments)
+
         if contains_sensitive:
             # 修改：显示过滤后的话题并终止辩论
             self.output.delete(1.0, tk.END)
-            self.output.insert(tk.END, f"辩论话题: {filtered_topic}\n\nAI: 抱歉，因话题包含敏感词无法开始辩论。\n")
+            self.output.insert(tk.END, f"辩论话题: {full_topic}\n\nAI: 抱歉，因话题包含敏感词无法开始辩论。\n")
             self.entry.delete(0, tk.END)
             self.submit_button.config(state=tk.NORMAL)
             self.stop_button.config(state=tk.DISABLED)
             self.save_button.config(state=tk.NORMAL)
             return
-        
-        # 构建包含附件内容的完整话题
-        full_topic = filtered_topic
-        
-        if self.attachments:
-            full_topic += "\n\n参考以下附件内容:\n"
-            
-            for i, attachment in enumerate(self.attachments):
-                # 对于文件，提取并添加内容
-                full_topic += f"\n附件 {i+1}: 文件 '{attachment['filename']}' 的内容:\n"
-                # 限制内容长度，避免过长
-                content = attachment['content']
-                if len(content) > 2000:
-                    content = content[:2000] + "..."
-                full_topic += f"{content}\n"
 
         self.output.delete(1.0, tk.END)
         self.output.insert(tk.END, f"辩论话题: {full_topic}\n\n")
@@ -643,13 +650,11 @@ class MultiAgentPage(BasePage):
         self.stop_button.config(state=tk.NORMAL)
         self.save_button.config(state=tk.DISABLED)  # 辩论开始时禁用保存按钮
 
-        self.stop_event = threading.Event()
-        thread = threading.Thread(target=self.run_debate, args=(full_topic, self.stop_event))
-        thread.start()
+        self.submit_task(lambda stop_event: self.run_debate(full_topic, stop_event))
 
     def stop_response(self):
         if self.stop_event:
-            self.stop_event.set()
+            super().stop_response()
             self.save_button.config(state=tk.NORMAL)  # 终止后启用保存按钮
 
     def save_debate(self):
@@ -704,63 +709,26 @@ class MultiAgentPage(BasePage):
                 self.attachments = []
                 self.attachments_listbox.delete(0, tk.END)
 
-    def run_debate(self, topic, stop_event):
+    async def run_debate(self, topic, stop_event):
         try:
             self.controller.set_status("辩论进行中...")
             temperature = self.get_temperature()
 
-            agent_a_persona = "你是辩手A，你对给定的话题持赞成态度，请有力地陈述你的观点。"
-            agent_b_persona = "你是辩手B，你对给定的话题持反对态度，请针对辩手A的观点进行反驳。"
-
-            messages = [{"role": "system", "content": agent_a_persona},
-                        {"role": "user", "content": f"辩论话题是: '{topic}'。请开始你的开篇陈词。"}]
-
-            for i in range(3):
-                if stop_event.is_set(): break
-
-                self.output.insert(tk.END, f"--- 第 {i + 1} 回合 ---\n辩手A: ")
-                agent_a_response = ""
-                for chunk in self.controller.api_client.get_response_stream(messages, temperature, stop_event):
-                    # 修改：实时过滤辩手A的回应
-                    filtered_chunk, contains_sensitive = self.sensitive_filter.filter_text(chunk)
-                    agent_a_response += filtered_chunk
-                    self.output.insert(tk.END, filtered_chunk)
+            # 辩论以后台优先级排队，不挤占普通对话的额度；发言经过实时过滤，发现敏感词时终止辩论
+            async for event, round_number, speaker, text in self.engine.run(topic, temperature, stop_event):
+                if event == "turn":
+                    if speaker == "A":
+                        self.output.insert(tk.END, f"--- 第 {round_number} 回合 ---\n辩手A: ")
+                    else:
+                        self.output.insert(tk.END, "\n辩手B: ")
+                elif event == "chunk":
+                    self.output.insert(tk.END, text)
                     self.output.see(tk.END)
-                    
-                    if contains_sensitive:
-                        # 修改：发现敏感词时终止辩论
-                        self.output.insert(tk.END, "\n\n[系统提示] 辩手A的发言包含敏感词，已终止辩论。\n")
-                        self.output.see(tk.END)
-                        stop_event.set()
-                        break
-                        
-                if stop_event.is_set(): break
-
-                messages = [{"role": "system", "content": agent_b_persona}, {"role": "user",
-                                                                             "content": f"话题是'{topic}'。刚刚辩手A说：'{agent_a_response}'。请你对此进行反驳。"}]
-
-                self.output.insert(tk.END, f"\n辩手B: ")
-                agent_b_response = ""
-                for chunk in self.controller.api_client.get_response_stream(messages, temperature, stop_event):
-                    # 修改：实时过滤辩手B的回应
-                    filtered_chunk, contains_sensitive = self.sensitive_filter.filter_text(chunk)
-                    agent_b_response += filtered_chunk
-                    self.output.insert(tk.END, filtered_chunk)
+                elif event == "sensitive":
+                    self.output.insert(tk.END, f"\n\n[系统提示] 辩手{speaker}的发言包含敏感词，已终止辩论。\n")
                     self.output.see(tk.END)
-                    
-                    if contains_sensitive:
-                        # 修改：发现敏感词时终止辩论
-                        self.output.insert(tk.END, "\n\n[系统提示] 辩手B的发言包含敏感词，已终止辩论。\n")
-                        self.output.see(tk.END)
-                        stop_event.set()
-                        break
-                        
-                if stop_event.is_set(): break
-                        
-                self.output.insert(tk.END, "\n\n")
-
-                messages = [{"role": "system", "content": agent_a_persona}, {"role": "user",
-                                                                             "content": f"继续关于'{topic}'的辩论。你的论点是'{agent_a_response}'。辩手B反驳道：'{agent_b_response}'。请你回应。"}]
+                elif event == "end" and speaker == "B":
+                    self.output.insert(tk.END, "\n\n")
         finally:
             status_text = "用户已终止" if stop_event.is_set() else "辩论完成"
             self.controller.set_status(status_text)
@@ -774,7 +742,6 @@ class CodeGenPage(BasePage):
 
     def __init__(self, parent, controller):
         super().__init__(parent, controller)
-        self.stop_event = None
         self.attachments = []  # 存储附件信息
         self.is_first_request = True   #来记录刷新状态
 
@@ -867,19 +834,7 @@ class CodeGenPage(BasePage):
             return
         
         # 构建包含附件内容的完整请求
-        full_request = filtered_request
-        
-        if self.attachments:
-            full_request += "\n\n参考以下附件内容:\n"
-            
-            for i, attachment in enumerate(self.attachments):
-                # 对于文件，提取并添加内容
-                full_request += f"\n附件 {i+1}: 文件 '{attachment['filename']}' 的内容:\n"
-                # 限制内容长度，避免过长
-                content = attachment['content']
-                if len(content) > 2000:
-                    content = content[:2000] + "..."
-                full_request += f"{content}\n"
+        full_request = filtered_request + format_attachments(self.attachments)
 
         self.output.insert(tk.END, f"\n\n> 用户需求: {full_request}\n\n")
         self.entry.delete(0, tk.END)
@@ -888,62 +843,32 @@ class CodeGenPage(BasePage):
         self.stop_button.config(state=tk.NORMAL)
         self.save_button.config(state=tk.DISABLED)  # 生成过程中禁用保存按钮
 
-        self.stop_event = threading.Event()
-        thread = threading.Thread(target=self.get_response, args=(full_request, self.stop_event))
-        thread.start()
+        self.submit_task(lambda stop_event: self.get_response(full_request, stop_event))
 
-    def stop_response(self):
-        if self.stop_event:
-            self.stop_event.set()
-
-    def get_response(self, request, stop_event):
+    async def get_response(self, request, stop_event):
         try:
             self.controller.set_status("正在构建Prompt并生成代码...")
             language = self.lang_var.get()
-            libraries = self.libs_var.get()
-            system_prompt = f"你是一位精通 {language} 的资深软件开发专家。"
-            
-            # 构建包含附件信息的完整请求
-            full_request_parts = [f"请为我生成一段 {language} 代码，我的需求是：'{request}'。", "\n请严格遵守以下要求："]
-            if libraries: full_request_parts.append(f"- 必须使用以下库或框架：{libraries}。")
-            if self.add_comments_var.get(): full_request_parts.append("- 在代码的关键部分添加清晰的中文注释。")
-            if self.add_docstrings_var.get(): full_request_parts.append(
-                f"- 为所有函数或类编写详细的文档字符串 (docstrings)。")
-            full_request_parts.append(f"- 所有的代码都必须包裹在 ```{language.lower()} ... ``` 格式的代码块中。")
-            if self.explain_first_var.get(): full_request_parts.append(
-                "\n在生成代码之前，请先用中文分步骤详细地解释你的实现思路，然后再给出完整的代码。")
-            
-            # 添加附件信息
-            if self.attachments:
-                full_request_parts.append(f"\n\n参考以下附件内容:")
-                
-                for i, attachment in enumerate(self.attachments):
-                    full_request_parts.append(f"\n附件 {i+1}: 文件 '{attachment['filename']}' 的内容:")
-                    # 限制内容长度，避免过长
-                    content = attachment['content']
-                    if len(content) > 2000:
-                        content = content[:2000] + "..."
-                    full_request_parts.append(content)
-                
-            final_request = "\n".join(full_request_parts)
+            messages = build_codegen_messages(
+                request, language, self.libs_var.get(), add_comments=self.add_comments_var.get(),
+                add_docstrings=self.add_docstrings_var.get(), explain_first=self.explain_first_var.get(),
+                attachments=self.attachments)
 
             self.controller.set_status("正在生成代码...")
-            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": final_request}]
             temperature = self.get_temperature()
 
-            for content_chunk in self.controller.api_client.get_response_stream(messages, temperature, stop_event):
-                # 修改：实时过滤代码生成内容
-                filtered_chunk, contains_sensitive = self.sensitive_filter.filter_text(content_chunk)
-                self.output.insert(tk.END, filtered_chunk)
+            # 修改：实时过滤代码生成内容
+            reply = FilteredReply(self.controller.async_client, self.sensitive_filter, messages, temperature,
+                                  stop_event)
+            async for content_chunk in reply:
+                self.output.insert(tk.END, content_chunk)
                 self.output.see(tk.END)
-                
-                if contains_sensitive:
-                    # 修改：发现敏感词时终止生成
-                    self.output.insert(tk.END, "\n\n[系统提示] 生成的代码包含敏感词，已终止输出。\n")
-                    self.output.see(tk.END)
-                    stop_event.set()
-                    break
-                    
+
+            if reply.contains_sensitive:
+                # 修改：发现敏感词时终止生成
+                self.output.insert(tk.END, "\n\n[系统提示] 生成的代码包含敏感词，已终止输出。\n")
+                self.output.see(tk.END)
+
         finally:
             status_text = "用户已终止" if stop_event.is_set() else "代码生成完成"
             self.controller.set_status(status_text)
@@ -967,27 +892,8 @@ class CodeGenPage(BasePage):
         # 获取默认文件扩展名
         default_ext = ext_map.get(language, ".txt")
         
-        # 获取代码内容
-        code_content = self.output.get("1.0", tk.END)
-        
-        # 提取代码块（如果存在）
-        import re
-        # 修改：增强正则表达式，更灵活地匹配语言标识和代码块
-        code_block_pattern = re.compile(r'```\s*([a-z\+]*)\s*\n([\s\S]*?)```', re.IGNORECASE | re.MULTILINE)
-        matches = code_block_pattern.findall(code_content)
-        
-        # 如果找到代码块，使用第一个代码块的内容
-        if matches:
-            # 尝试找到与所选语言匹配的代码块
-            language_matches = [m for m in matches if self._is_language_match(m[0], language)]
-            if language_matches:
-                code_content = language_matches[0][1]  # 提取代码部分
-            else:
-                # 如果没有找到匹配的语言，使用第一个代码块
-                code_content = matches[0][1]
-        else:
-            # 如果没有找到代码块，使用完整内容
-            pass
+        # 获取代码内容，优先取与所选语言匹配的代码块
+        code_content = extract_code(self.output.get("1.0", tk.END), language)
         
         # 打开文件对话框
         file_path = filedialog.asksaveasfilename(
@@ -1005,22 +911,6 @@ class CodeGenPage(BasePage):
             except Exception as e:
                 messagebox.showerror("错误", f"保存文件时出错: {str(e)}")
 
-    def _is_language_match(self, code_block_lang, selected_lang):
-        """检查代码块语言标识是否与所选语言匹配"""
-        # 语言映射表，处理不同表示方式
-        lang_map = {
-            "Python": ["python", "py"],
-            "JavaScript": ["javascript", "js"],
-            "Java": ["java"],
-            "C++": ["c++", "cpp", "cxx"],
-            "SQL": ["sql"]
-        }
-        
-        # 获取所选语言的所有可能标识
-        valid_ids = lang_map.get(selected_lang, [])
-        # 如果代码块语言标识在有效标识列表中，或者没有语言标识但用户选择了该语言
-        return code_block_lang.lower() in valid_ids or (not code_block_lang and selected_lang == "C++")
-
     def upload_file(self):
         """上传文件附件"""
         file_path = filedialog.askopenfilename()
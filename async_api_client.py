@@ -0,0 +1,359 @@
+"""基于 asyncio 的 API 客户端
+
+所有页面的请求都作为协程提交到同一个后台事件循环线程上运行，多个流式输出
+共用一个事件循环和一个连接池，不再为每个请求单独创建线程。配置了多个接口时，
+每个请求由 endpoint_router 发往当前最快的可用接口。
+"""
+import asyncio
+import os
+import threading
+import time
+
+import httpx
+from openai import APIConnectionError
+
+from api_client import http_client_options, print_error
+from response_cache import iter_replay, make_cache_key
+from context_builder import MESSAGE_OVERHEAD, estimate_tokens
+from endpoint_router import EndpointRouter
+from request_scheduler import PRIORITY_INTERACTIVE, RequestScheduler
+from retry_policy import FirstTokenTimeout, LatencyTracker, RetryPolicy, StreamStalled, is_retryable
+from stream_metrics import MetricsRegistry, RequestMetrics
+
+
+class AsyncAPIClient:
+    def __init__(self, api_key, base_url, model, cache=None, cache_max_temperature=0.3, scheduler=None,
+                 router=None, metrics=None, error_handler=None):
+        # 默认模型名；缓存的回答以实际回答的接口的模型名为键
+        self.model = model
+        self.cache = cache
+        self.cache_max_temperature = cache_max_temperature
+        # 出错时在事件循环线程上以 (标题, 信息) 调用，默认输出到控制台；回调不能阻塞（如弹出模态对话框），
+        # 否则其他回答和调度定时器都会停住；抛出的异常会传给 stream 的调用方
+        self.error_handler = error_handler if error_handler is not None else print_error
+        # 所有接口共用一个连接池；重试由 retry_policy 统一控制，各接口关闭了 SDK 自带的重试
+        self.http_client = httpx.AsyncClient(**http_client_options())
+        self.router = router if router is not None else EndpointRouter.from_config(
+            api_key, base_url, model, self.http_client)
+        self.retry_policy = RetryPolicy.from_env()
+        # 所有请求先经过限流和优先级调度，再发往服务商
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler.from_env()
+        # 预扣额度时为回答部分估算的 token 数，请求结束后按实际输出修正
+        self.output_token_estimate = int(os.getenv("API_OUTPUT_TOKEN_ESTIMATE", "512"))
+        self.router.expected_output_tokens = self.output_token_estimate
+        # 每个请求的耗时、数据块和 token 用量统计；API_STREAM_USAGE=0 时不向服务端请求用量（部分接口不支持）
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.stream_usage = os.getenv("API_STREAM_USAGE", "1") != "0"
+        # 最近的首字耗时，用于计算对冲阈值
+        self.ttft = LatencyTracker()
+        self.retries = 0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self.warm_up_seconds = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, name="api-event-loop", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_api_client(cls, api_client, error_handler=None):
+        """沿用 APIClient 中的密钥、地址、模型、回答缓存和错误回调
+
+        error_handler 在事件循环线程上被调用，不能阻塞；界面程序应传入把错误转到界面线程显示的回调。
+        """
+        return cls(api_client.api_key, api_client.base_url, api_client.model,
+                   cache=api_client.cache, cache_max_temperature=api_client.cache_max_temperature,
+                   error_handler=error_handler if error_handler is not None else api_client.error_handler)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """把协程提交到后台事件循环，返回 concurrent.futures.Future，可用 cancel() 立即终止"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def warm_up(self):
+        """在事件循环上向每个接口发送一个轻量请求，提前完成 DNS 解析和 TCP/TLS 握手"""
+        return self.submit(self._warm_up())
+
+    async def _warm_up(self):
+        start = time.perf_counter()
+        results = await asyncio.gather(*(self._warm_up_endpoint(endpoint) for endpoint in self.router.endpoints))
+        if any(results):
+            self.warm_up_seconds = time.perf_counter() - start
+
+    async def _warm_up_endpoint(self, endpoint):
+        try:
+            await endpoint.client.with_options(timeout=10).models.list()
+        except APIConnectionError as e:
+            print(f"预热接口 {endpoint.name} 失败: {e}")
+            return False
+        except Exception:
+            # 接口不支持列出模型时连接也已经建立，同样算作预热成功
+            pass
+        return True
+
+    def _hedge_delay(self):
+        """开启对冲且样本足够时，返回发出对冲请求前的等待秒数"""
+        policy = self.retry_policy
+        if not policy.hedge or len(self.ttft) < policy.hedge_min_samples:
+            return None
+        return self.ttft.percentile(policy.hedge_percentile)
+
+    async def _open_stream(self, endpoint, messages, temperature, probe=None):
+        """向 endpoint 发起请求并等待第一个内容块，probe 为 router.choose 返回的试探编号
+
+        返回 (stream, 迭代器, 第一个内容块, endpoint, 计时)，回答为空时返回 None。计时字典包含
+        发出请求、收到响应头、第一个数据块和第一个内容块的时间以及已收到的数据块数。
+        首字耗时和可重试的错误会记入该接口的统计和熔断器，其余情况（被取消、回答为空、不可重试的
+        错误）记为没有结果，该请求是熔断器的试探请求时由下一个请求重新试探。
+        """
+        start = time.perf_counter()
+        options = {'stream_options': {'include_usage': True}} if self.stream_usage else {}
+        recorded = False
+        try:
+            try:
+                stream = await endpoint.client.chat.completions.create(
+                    model=endpoint.model,
+                    messages=messages,
+                    stream=True,
+                    temperature=temperature,
+                    **options
+                )
+            except Exception as e:
+                if is_retryable(e):
+                    self.router.record_failure(endpoint)
+                    recorded = True
+                raise
+            timing = {'sent': start, 'connected': time.perf_counter(), 'first_byte': None, 'chunks': 0}
+            try:
+                iterator = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        await stream.close()
+                        return None
+                    now = time.perf_counter()
+                    if timing['first_byte'] is None:
+                        timing['first_byte'] = now
+                    timing['chunks'] += 1
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        timing['first_token'] = now
+                        self.router.record_first_token(endpoint, now - start)
+                        recorded = True
+                        return stream, iterator, chunk.choices[0].delta.content, endpoint, timing
+            except BaseException as e:
+                if isinstance(e, Exception) and is_retryable(e):
+                    self.router.record_failure(endpoint)
+                    recorded = True
+                await stream.close()
+                raise
+        finally:
+            if not recorded:
+                self.router.record_abandoned(endpoint, probe)
+
+    def _start(self, messages, temperature, tried, tasks, charges, charged):
+        """选出接口并发起请求；已经试过的接口只在没有其他可用接口时再用"""
+        endpoint, probe = self.router.choose(exclude=tried)
+        tried.append(endpoint)
+        task = asyncio.ensure_future(self._open_stream(endpoint, messages, temperature, probe))
+        tasks[task] = endpoint
+        charges[task] = charged
+
+    async def _first_token(self, messages, temperature, charged, prompt_tokens, priority, tried):
+        """等待第一个内容块，超过首字超时抛出 FirstTokenTimeout；需要对冲时向另一个接口（只有一个接口时
+        向同一接口）再发一个相同请求，取先返回的一个
+
+        返回 (_open_stream 的结果, 该请求扣除的 token 数)，回答为空时返回 None。其余请求都已发出，
+        按输入的 token 数修正各自扣除的额度。
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        deadline = start + self.retry_policy.ttft_timeout
+        hedge_delay = self._hedge_delay()
+        hedge_at = start + hedge_delay if hedge_delay is not None else None
+        # 请求任务 -> 接口，按发起顺序排列；请求任务 -> 扣除的 token 数
+        tasks = {}
+        charges = {}
+        self._start(messages, temperature, tried, tasks, charges, charged)
+        winner = None
+        error = None
+        try:
+            while True:
+                for task in tasks:
+                    if task.done() and not task.cancelled():
+                        if task.exception() is None:
+                            self.ttft.add(loop.time() - start)
+                            if task is not next(iter(tasks)):
+                                self.hedge_wins += 1
+                            if task.result() is None:
+                                return None
+                            winner = task
+                            return task.result(), charges[task]
+                        error = task.exception()
+                now = loop.time()
+                if now >= deadline:
+                    for task, endpoint in tasks.items():
+                        if not task.done():
+                            self.router.record_failure(endpoint)
+                    raise FirstTokenTimeout(f"{self.retry_policy.ttft_timeout:g} 秒内没有收到回答")
+                wake = deadline
+                if hedge_at is not None:
+                    if now >= hedge_at:
+                        # 对冲请求同样占用额度，额度不足或有请求在排队时放弃对冲
+                        hedge_charge = self.scheduler.try_acquire(charged, priority)
+                        if hedge_charge is not None:
+                            self._start(messages, temperature, tried, tasks, charges, hedge_charge)
+                            self.hedged_requests += 1
+                        hedge_at = None
+                    else:
+                        wake = min(wake, hedge_at)
+                pending = [task for task in tasks if not task.done()]
+                if not pending:
+                    raise error
+                await asyncio.wait(pending, timeout=wake - loop.time(), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                self.scheduler.settle(charges[task], prompt_tokens)
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None and task.result():
+                    await task.result()[0].close()
+
+    async def _open_with_retries(self, messages, temperature, stop_event, charge, prompt_tokens, priority, metrics):
+        """在收到第一个内容块之前，对可重试的错误按指数退避加抖动重试，重试优先换到没有试过的接口；
+        每次请求前先向调度器申请额度，返回值同 _first_token"""
+        policy = self.retry_policy
+        attempt = 0
+        tried = []
+        while True:
+            charged = await self.scheduler.acquire(charge, priority)
+            if metrics.dispatched is None:
+                metrics.dispatched = time.perf_counter()
+            if stop_event and stop_event.is_set():
+                self.scheduler.settle(charged, 0)
+                return None
+            try:
+                return await self._first_token(messages, temperature, charged, prompt_tokens, priority, tried)
+            except Exception as e:
+                if attempt >= policy.max_retries or not is_retryable(e):
+                    raise
+                delay = policy.backoff(attempt, e)
+                print(f"请求失败（{e}），{delay:.1f} 秒后第 {attempt + 1} 次重试")
+                self.retries += 1
+                metrics.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+                if stop_event and stop_event.is_set():
+                    return None
+
+    async def stream(self, messages, temperature=0.7, stop_event=None, use_cache=True,
+                     priority=PRIORITY_INTERACTIVE):
+        """异步生成器，逐块产出回答内容；开启缓存且温度不高于 cache_max_temperature 时，相同的请求直接
+        重放缓存，use_cache=False 可跳过缓存，只缓存完整结束的回答
+
+        请求按 priority 排队申请额度；首个内容块到达前的 429、5xx、连接错误和首字超时
+        会自动重试；输出过程中超过停顿超时没有新内容时中止本次回答。每个请求的计时和
+        token 用量记入 self.metrics。
+        """
+        metrics = RequestMetrics(time.perf_counter(), self.model, priority)
+        loop = asyncio.get_running_loop()
+        cacheable = self.cache is not None and use_cache and temperature <= self.cache_max_temperature
+        if cacheable:
+            # 还不知道会路由到哪个接口，任一接口的模型缓存过的回答都可以使用；
+            # 缓存未命中内存时要查 SQLite，放到线程池中，不阻塞事件循环上的其他回答
+            models = {make_cache_key(model, messages, temperature): model
+                      for model in dict.fromkeys(endpoint.model for endpoint in self.router.endpoints)}
+            key, cached = await loop.run_in_executor(None, self.cache.lookup, list(models))
+            if cached is not None:
+                metrics.cached = True
+                metrics.model = models[key]
+                self.metrics.record(metrics)
+                for chunk in iter_replay(cached, stop_event):
+                    yield chunk
+                return
+
+        prompt_tokens = sum(estimate_tokens(msg['content']) + MESSAGE_OVERHEAD for msg in messages)
+        charge = prompt_tokens + self.output_token_estimate
+        stream = None
+        parts = []
+        try:
+            opened = await self._open_with_retries(messages, temperature, stop_event, charge, prompt_tokens,
+                                                   priority, metrics)
+            if opened is None:
+                metrics.outcome = "stopped"
+                return
+            (stream, iterator, first, endpoint, timing), charged = opened
+            metrics.endpoint = endpoint.name
+            metrics.model = endpoint.model
+            metrics.sent = timing['sent']
+            metrics.connected = timing['connected']
+            metrics.first_byte = timing['first_byte']
+            metrics.first_token = metrics.last_token = timing['first_token']
+            metrics.chunks = timing['chunks']
+            parts.append(first)
+            yield first
+            while not (stop_event and stop_event.is_set()):
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), self.retry_policy.stall_timeout)
+                except StopAsyncIteration:
+                    metrics.outcome = "ok"
+                    # 只缓存完整结束的回答，被终止或出错的回答不缓存
+                    if cacheable:
+                        await loop.run_in_executor(None, self.cache.put,
+                                                   make_cache_key(endpoint.model, messages, temperature), ''.join(parts))
+                    # 只用完整结束的回答统计输出速度，第一个内容块之后的部分才计入
+                    output_tokens = metrics.completion_tokens if metrics.usage_reported \
+                        else estimate_tokens(''.join(parts[1:]))
+                    self.router.record_throughput(endpoint, output_tokens, metrics.last_token - metrics.first_token)
+                    break
+                except asyncio.TimeoutError:
+                    self.router.record_failure(endpoint)
+                    raise StreamStalled(f"超过 {self.retry_policy.stall_timeout:g} 秒没有收到新内容，已中止")
+                metrics.chunks += 1
+                usage = getattr(chunk, 'usage', None)
+                if usage is not None:
+                    # include_usage 时最后一个数据块不含内容，只带本次请求的 token 用量
+                    metrics.prompt_tokens = usage.prompt_tokens
+                    metrics.completion_tokens = usage.completion_tokens
+                    metrics.usage_reported = True
+                if chunk.choices and chunk.choices[0].delta.content:
+                    metrics.last_token = time.perf_counter()
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            else:
+                metrics.outcome = "stopped"
+        except asyncio.CancelledError:
+            metrics.outcome = "cancelled"
+            raise
+        except Exception as e:
+            metrics.outcome = "error"
+            if not (stop_event and stop_event.is_set()):
+                self.error_handler("API错误", f"调用API时发生错误: {str(e)}")
+                yield f"\n[错误] {str(e)}"
+        finally:
+            if not metrics.usage_reported:
+                metrics.prompt_tokens = prompt_tokens
+                metrics.completion_tokens = estimate_tokens(''.join(parts))
+            if metrics.outcome is None:
+                # 页面提前关闭了生成器
+                metrics.outcome = "stopped"
+            self.metrics.record(metrics)
+            # 提前结束或被取消时关闭响应，连接才能回到连接池中复用
+            if stream is not None:
+                self.scheduler.settle(charged, metrics.prompt_tokens + metrics.completion_tokens)
+                await stream.close()
+
+    def close(self):
+        """关闭连接池并停止事件循环"""
+        try:
+            self.submit(self.http_client.aclose()).result(timeout=5)
+        except Exception as e:
+            print(f"关闭异步API客户端失败: {e}")
+        self.metrics.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
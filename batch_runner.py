@@ -0,0 +1,234 @@
+"""命令行批量任务
+
+不打开界面，把 JSONL 文件中的对话、代码生成和辩论任务按设定的并发数交给模型处理，
+输入和输出都经过敏感词过滤，每完成一个任务就追加一行结果到输出文件。再次运行时跳过
+输出文件中已经完成的任务，出错的任务会重新执行。结束时报告吞吐量和单个任务耗时。
+
+用法: python batch_runner.py INPUT OUTPUT [--concurrency 4] [--words sensitive_words.json]
+
+输入文件每行一个任务，temperature 可选（默认0.7）:
+    {"id": "q1", "type": "chat", "prompt": "什么是协程？"}
+    {"id": "c1", "type": "codegen", "prompt": "读取CSV并统计每列的平均值", "language": "Python", "libraries": "pandas"}
+    {"id": "d1", "type": "debate", "prompt": "远程办公利大于弊", "rounds": 3}
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+
+from agent_core import SENSITIVE_REPLY, DebateEngine, FilteredReply, build_codegen_messages
+from async_api_client import AsyncAPIClient
+from context_builder import estimate_tokens
+from request_scheduler import PRIORITY_BATCH
+from retry_policy import LatencyTracker
+from sensitive_word_filter import SensitiveWordFilter
+
+JOB_TYPES = ("chat", "codegen", "debate")
+# 视为已完成、再次运行时跳过的状态
+DONE_STATUSES = ("ok", "sensitive")
+
+
+class JobFailed(Exception):
+    """模型调用出错，由 AsyncAPIClient 的 error_handler 抛出"""
+
+
+def _raise_job_error(title, message):
+    raise JobFailed(message)
+
+
+def load_completed_ids(output_path):
+    """读取输出文件中已经完成的任务 id"""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 上次运行中断时可能留下不完整的最后一行
+                continue
+            if record.get('status') in DONE_STATUSES:
+                completed.add(record.get('id'))
+    return completed
+
+
+def job_error(job):
+    """检查一行任务的字段，有问题时返回说明，否则返回 None"""
+    if not isinstance(job, dict):
+        return "不是 JSON 对象"
+    if job.get('id') is None:
+        return "缺少 id"
+    if job.get('type', "chat") not in JOB_TYPES:
+        return f"任务类型无效（可选 {', '.join(JOB_TYPES)}）"
+    if not isinstance(job.get('prompt'), str) or not job['prompt'].strip():
+        return "缺少 prompt"
+    try:
+        float(job.get('temperature', 0.7))
+        int(job.get('rounds', 3))
+    except (TypeError, ValueError):
+        return "temperature 必须是数字，rounds 必须是整数"
+    return None
+
+
+def iter_jobs(input_path, skip_ids):
+    """逐行读取任务，跳过格式错误、重复和已完成的任务"""
+    seen = set()
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                print(f"第 {line_number} 行不是有效的 JSON，已跳过: {e}")
+                continue
+            error = job_error(job)
+            if error is not None:
+                print(f"第 {line_number} 行{error}，已跳过")
+                continue
+            job_id = job['id']
+            if job_id in skip_ids or job_id in seen:
+                continue
+            seen.add(job_id)
+            yield job
+
+
+def codegen_messages(job):
+    """按任务中的选项构建代码生成 Prompt，选项默认值与代码生成页面一致"""
+    return build_codegen_messages(job['prompt'], job.get('language', "Python"), job.get('libraries', ""),
+                                  add_comments=job.get('add_comments', True),
+                                  add_docstrings=job.get('add_docstrings', False),
+                                  explain_first=job.get('explain_first', False))
+
+
+class BatchRunner:
+    def __init__(self, client, sensitive_filter, concurrency=4):
+        self.client = client
+        self.sensitive_filter = sensitive_filter
+        self.concurrency = concurrency
+        self.latencies = LatencyTracker(size=None)
+        self.counts = {'ok': 0, 'sensitive': 0, 'error': 0}
+        self.output_tokens = 0
+
+    async def _complete(self, messages, temperature, timing):
+        """流式获取一次回答并过滤，返回 (文本, 是否命中敏感词)"""
+        reply = FilteredReply(self.client, self.sensitive_filter, messages, temperature, priority=PRIORITY_BATCH)
+        async for _ in reply:
+            if timing['first_token'] is None:
+                timing['first_token'] = time.perf_counter()
+        return reply.text, reply.contains_sensitive
+
+    async def _run_debate(self, topic, rounds, temperature, timing):
+        """返回 (发言列表, 是否命中敏感词)"""
+        turns = []
+        engine = DebateEngine(self.client, self.sensitive_filter, rounds, PRIORITY_BATCH)
+        async for event, _, speaker, text in engine.run(topic, temperature):
+            if event == "chunk" and timing['first_token'] is None:
+                timing['first_token'] = time.perf_counter()
+            elif event in ("end", "sensitive"):
+                turns.append({'speaker': speaker, 'content': text})
+                if event == "sensitive":
+                    return turns, True
+        return turns, False
+
+    async def run_job(self, job):
+        """执行一个任务，返回输出文件中的一行记录；任务字段有误时同样返回状态为 error 的记录"""
+        job_type = job.get('type', "chat")
+        timing = {'start': time.perf_counter(), 'first_token': None}
+        record = {'id': job.get('id'), 'type': job_type, 'status': "ok", 'output': None, 'error': None}
+        try:
+            temperature = float(job.get('temperature', 0.7))
+            prompt, contains_sensitive = self.sensitive_filter.filter_text(job['prompt'])
+            if contains_sensitive:
+                record['status'] = "sensitive"
+                record['output'] = SENSITIVE_REPLY
+            elif job_type == "debate":
+                record['output'], contains_sensitive = await self._run_debate(
+                    prompt, int(job.get('rounds', 3)), temperature, timing)
+            else:
+                messages = codegen_messages(dict(job, prompt=prompt)) if job_type == "codegen" \
+                    else [{"role": "user", "content": prompt}]
+                record['output'], contains_sensitive = await self._complete(messages, temperature, timing)
+            if contains_sensitive:
+                record['status'] = "sensitive"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            record['status'] = "error"
+            record['error'] = str(e)
+        latency = time.perf_counter() - timing['start']
+        record['latency_ms'] = round(latency * 1000)
+        record['ttft_ms'] = round((timing['first_token'] - timing['start']) * 1000) \
+            if timing['first_token'] is not None else None
+        record['finished_at'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.latencies.add(latency)
+        self.counts[record['status']] += 1
+        output = record['output']
+        if isinstance(output, list):
+            output = ''.join(turn['content'] for turn in output)
+        self.output_tokens += estimate_tokens(output or '')
+        return record
+
+    async def run(self, jobs, output_file):
+        """由 concurrency 个协程从同一个任务迭代器中取任务，完成一个写入一行"""
+        async def worker():
+            for job in jobs:
+                record = await self.run_job(job)
+                output_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                output_file.flush()
+                done = sum(self.counts.values())
+                print(f"[{done}] {record['id']} {record['status']} {record['latency_ms'] / 1000:.1f}s"
+                      + (f"（{record['error']}）" if record['error'] else ""))
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    def report(self, elapsed):
+        done = sum(self.counts.values())
+        print(f"完成 {done} 个任务（成功 {self.counts['ok']}，敏感词 {self.counts['sensitive']}，"
+              f"失败 {self.counts['error']}），用时 {elapsed:.1f} 秒")
+        if done and elapsed > 0:
+            print(f"吞吐量: {done / elapsed:.2f} 任务/秒，约 {self.output_tokens / elapsed:.0f} token/秒；"
+                  f"单个任务耗时 p50 {self.latencies.percentile(50):.1f} 秒，p95 {self.latencies.percentile(95):.1f} 秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量处理 JSONL 中的对话、代码生成和辩论任务")
+    parser.add_argument('input', help="任务文件（JSONL）")
+    parser.add_argument('output', help="结果文件（JSONL，追加写入）")
+    parser.add_argument('--concurrency', type=int, default=4, help="同时进行的任务数")
+    parser.add_argument('--words', default="sensitive_words.json", help="敏感词库文件")
+    args = parser.parse_args()
+
+    load_dotenv()
+    api_key = os.getenv("SILICONFLOW_API_KEY")
+    if not api_key:
+        print("请在您的 .env 文件中设置 SILICONFLOW_API_KEY。")
+        return
+    client = AsyncAPIClient(api_key, os.getenv("BASE_URL", "https://api.siliconflow.cn/v1"),
+                            os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-V3"), error_handler=_raise_job_error)
+    runner = BatchRunner(client, SensitiveWordFilter(args.words), max(1, args.concurrency))
+    completed = load_completed_ids(args.output)
+    if completed:
+        print(f"跳过 {len(completed)} 个已完成的任务")
+
+    start = time.perf_counter()
+    with open(args.output, 'a', encoding='utf-8') as output_file:
+        future = client.submit(runner.run(iter_jobs(args.input, completed), output_file))
+        try:
+            future.result()
+        except KeyboardInterrupt:
+            # 已完成的任务都已写入输出文件，下次运行时从未完成的任务继续
+            future.cancel()
+            print("已中断，再次运行即可继续")
+        finally:
+            # 先停止事件循环再关闭输出文件
+            client.close()
+    runner.report(time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""按 token 预算组装发送给模型的上下文
+
+保留系统提示和最近的若干轮对话，更早的对话压缩成一段摘要，并可附上从以往对话中
+检索到的相关片段；每条消息的 token 数只计算一次并缓存在消息上。
+"""
+import re
+from functools import lru_cache
+
+# 每条消息除正文外的格式开销（角色标记等）的估计值
+MESSAGE_OVERHEAD = 4
+
+_CJK_CHAR = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+@lru_cache(maxsize=1)
+def _load_encoding():
+    """加载本地分词器（需要安装 tiktoken），未安装时返回 None"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def estimate_tokens(text):
+    """估算文本的 token 数：有 tiktoken 时精确计数，否则中日韩字符按 1 个、其余按每 4 个字符 1 个估算"""
+    encoding = _load_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ContextBuilder:
+    """在 token 预算内组装上下文：系统提示 + 以往对话的相关片段 + 较早对话的滚动摘要 + 最近的对话"""
+
+    def __init__(self, max_tokens=8000, summary_tokens=600, summary_chars_per_message=80, recall_tokens=500):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.summary_chars_per_message = summary_chars_per_message
+        self.recall_tokens = recall_tokens
+
+    @staticmethod
+    def count(message):
+        """返回消息的 token 数，首次计算后缓存在消息的 tokens 字段中"""
+        tokens = message.get('tokens')
+        if tokens is None:
+            tokens = estimate_tokens(message.get('content') or '') + MESSAGE_OVERHEAD
+            message['tokens'] = tokens
+        return tokens
+
+    def _take_recent(self, history, budget):
+        """从最新的消息往前取，直到超出预算；最后一条（当前问题）总会保留"""
+        used = 0
+        start = len(history)
+        while start > 0:
+            tokens = self.count(history[start - 1])
+            if used + tokens > budget and start < len(history):
+                break
+            used += tokens
+            start -= 1
+        return start, used
+
+    def _summarize(self, dropped):
+        """把较早的对话压缩为摘要：从最近的被省略消息往前取每条消息的开头，直到用完摘要预算"""
+        lines = []
+        used = estimate_tokens("以下是较早对话的摘要：") + MESSAGE_OVERHEAD
+        for message in reversed(dropped):
+            role = "用户" if message.get('role') == "user" else "AI"
+            content = ' '.join((message.get('content') or '').split())
+            if len(content) > self.summary_chars_per_message:
+                content = content[:self.summary_chars_per_message] + "…"
+            line = f"- {role}: {content}"
+            tokens = estimate_tokens(line) + 1
+            if used + tokens > self.summary_tokens:
+                break
+            lines.append(line)
+            used += tokens
+        lines.reverse()
+        return "以下是较早对话的摘要：\n" + "\n".join(lines), used
+
+    def _format_recalled(self, recalled):
+        """把检索到的以往对话片段按相关度依次放入，直到用完检索片段的预算"""
+        header = "以下是以往对话中可能相关的内容，仅供参考："
+        lines = []
+        used = estimate_tokens(header) + MESSAGE_OVERHEAD
+        for hit in recalled:
+            role = "用户" if hit['role'] == "user" else "AI"
+            line = f"- {role}: {hit['snippet']}"
+            tokens = estimate_tokens(line) + 1
+            if used + tokens > self.recall_tokens:
+                break
+            lines.append(line)
+            used += tokens
+        if not lines:
+            return None, 0, 0
+        return header + "\n" + "\n".join(lines), used, len(lines)
+
+    def build(self, history, system_prompt=None, recalled=None):
+        """返回 (messages, report)，report 中包含使用和省略的 token 数
+
+        recalled 为 ConversationMemory.recall() 的检索结果，会在 recall_tokens 预算内附在系统提示之后。
+        """
+        budget = self.max_tokens
+        prefix = []
+        if system_prompt:
+            budget -= estimate_tokens(system_prompt) + MESSAGE_OVERHEAD
+            prefix.append({'role': 'system', 'content': system_prompt})
+        recalled_messages = 0
+        if recalled:
+            content, recall_used, recalled_messages = self._format_recalled(recalled)
+            if content:
+                budget -= recall_used
+                prefix.append({'role': 'system', 'content': content})
+
+        start, used = self._take_recent(history, budget)
+        summary_used = 0
+        if start > 0:
+            # 放不下全部历史时，为摘要预留空间后重新挑选最近的对话
+            start, used = self._take_recent(history, budget - self.summary_tokens)
+            summary, summary_used = self._summarize(history[:start])
+            prefix.append({'role': 'system', 'content': summary})
+
+        messages = prefix + [{'role': 'user' if msg['role'] == "user" else 'assistant', 'content': msg['content']}
+                             for msg in history[start:]]
+        dropped_tokens = sum(self.count(msg) for msg in history[:start])
+        report = {
+            'total_tokens': self.max_tokens - budget + summary_used + used,
+            'dropped_messages': start,
+            'dropped_tokens': dropped_tokens,
+            'recalled_messages': recalled_messages,
+        }
+        return messages, report
@@ -0,0 +1,108 @@
+"""对话存档敏感词回溯审计
+
+敏感词库更新后，用多进程重新扫描 conversations/ 下的全部对话，输出紧凑的命中报告
+（每行一个 JSON：对话id、消息序号、命中区间），可选择把命中内容原地替换为 *。
+
+用法: python conversation_audit.py [--storage-dir conversations] [--report audit_report.jsonl]
+                                   [--workers N] [--rewrite]
+"""
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+from memory import JournalConversationStore, iter_conversation_files, store_for_path
+from sensitive_word_filter import SensitiveWordFilter, mask_spans
+
+# 每个工作进程持有一个预先编译好的过滤器
+_worker_filter = None
+_worker_rewrite = False
+
+
+def _init_worker(words_path, variants_path, rewrite):
+    global _worker_filter, _worker_rewrite
+    _worker_filter = SensitiveWordFilter(words_path, variants_path)
+    _worker_rewrite = rewrite
+
+
+def _rewrite_conversation(path, store, data):
+    """原子地重写对话文件"""
+    if isinstance(store, JournalConversationStore):
+        store.compact(path, data)
+        return
+    tmp_path = path + '.tmp'
+    store.write(tmp_path, data)
+    os.replace(tmp_path, path)
+
+
+def audit_file(path):
+    """审计单个对话文件，返回 (对话id, 消息数, 命中列表, 错误信息)"""
+    store = store_for_path(path)
+    conversation_id = os.path.basename(path)[:-len(store.suffix)]
+    try:
+        data = store.read(path)
+    except Exception as e:
+        return conversation_id, 0, [], str(e)
+
+    automaton = _worker_filter.automaton
+    messages = data.get('messages', [])
+    hits = []
+    for index, msg in enumerate(messages):
+        content = msg.get('content') or ''
+        spans = automaton.find_spans(content)
+        if spans:
+            hits.append((index, spans))
+            if _worker_rewrite:
+                msg['content'] = mask_spans(content, spans)
+
+    if hits and _worker_rewrite:
+        try:
+            _rewrite_conversation(path, store, data)
+        except Exception as e:
+            return conversation_id, len(messages), hits, str(e)
+    return conversation_id, len(messages), hits, None
+
+
+def run_audit(storage_dir="conversations", report_path="audit_report.jsonl", workers=None,
+              rewrite=False, words_path="sensitive_words.json", variants_path="char_variants.json",
+              chunksize=64):
+    """多进程审计全部对话，命中结果边扫描边写入报告文件，返回统计信息"""
+    stats = {'files': 0, 'messages': 0, 'hit_files': 0, 'hits': 0, 'errors': 0}
+    start = time.perf_counter()
+    with open(report_path, 'w', encoding='utf-8') as report, \
+            Pool(workers, initializer=_init_worker, initargs=(words_path, variants_path, rewrite)) as pool:
+        for conversation_id, message_count, hits, error in pool.imap_unordered(
+                audit_file, iter_conversation_files(storage_dir), chunksize):
+            stats['files'] += 1
+            stats['messages'] += message_count
+            if error:
+                stats['errors'] += 1
+                print(f"处理对话 {conversation_id} 失败: {error}")
+            if hits:
+                stats['hit_files'] += 1
+                for index, spans in hits:
+                    stats['hits'] += len(spans)
+                    report.write(json.dumps({'id': conversation_id, 'message': index, 'spans': spans},
+                                            ensure_ascii=False, separators=(',', ':')) + '\n')
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用当前敏感词库回溯审计已保存的对话")
+    parser.add_argument('--storage-dir', default="conversations", help="对话存储目录")
+    parser.add_argument('--report', default="audit_report.jsonl", help="命中报告输出路径")
+    parser.add_argument('--workers', type=int, default=None, help="工作进程数，默认等于CPU核数")
+    parser.add_argument('--rewrite', action='store_true', help="把命中内容原地替换为 *")
+    parser.add_argument('--words', default="sensitive_words.json", help="敏感词库文件")
+    args = parser.parse_args()
+
+    stats = run_audit(args.storage_dir, args.report, args.workers, args.rewrite, args.words)
+    print(f"共扫描 {stats['files']} 个对话、{stats['messages']} 条消息，耗时 {stats['seconds']:.2f} 秒")
+    print(f"命中 {stats['hit_files']} 个对话、{stats['hits']} 处敏感内容，失败 {stats['errors']} 个，"
+          f"报告已写入 {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""对话存档批量导出
+
+用多进程把 conversations/ 下的全部对话渲染为 Markdown 或 JSONL（每行一个对话），
+边渲染边写入同一个输出文件，不会把整个存档读入内存，结束时报告每秒导出的消息数。
+
+用法: python conversation_export.py OUTPUT [--format md|jsonl] [--storage-dir conversations] [--workers N]
+"""
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+from memory import _json_default, iter_conversation_files, iter_markdown, store_for_path
+
+
+def render_conversation(task):
+    """读取并渲染单个对话，返回 (渲染结果, 消息数, 错误信息)"""
+    path, output_format = task
+    store = store_for_path(path)
+    conversation_id = os.path.basename(path)[:-len(store.suffix)]
+    try:
+        conversation = store.read(path)
+    except Exception as e:
+        return '', 0, f"{conversation_id}: {e}"
+    conversation.setdefault('created_at', '')
+    if output_format == 'jsonl':
+        conversation.setdefault('id', conversation_id)
+        text = json.dumps(conversation, ensure_ascii=False, default=_json_default) + '\n'
+    else:
+        text = ''.join(iter_markdown(conversation_id, conversation)) + '---\n\n'
+    return text, len(conversation['messages']), None
+
+
+def export_all(output_path, output_format='md', storage_dir="conversations", workers=None, chunksize=32):
+    """多进程导出全部对话到 output_path，返回统计信息"""
+    if output_format not in ('md', 'jsonl'):
+        raise ValueError(f"不支持的导出格式: {output_format}")
+    stats = {'conversations': 0, 'messages': 0, 'errors': 0}
+    start = time.perf_counter()
+    tasks = ((path, output_format) for path in iter_conversation_files(storage_dir))
+    with open(output_path, 'w', encoding='utf-8') as out, Pool(workers) as pool:
+        for text, message_count, error in pool.imap_unordered(render_conversation, tasks, chunksize):
+            if error:
+                stats['errors'] += 1
+                print(f"导出对话失败: {error}")
+                continue
+            out.write(text)
+            stats['conversations'] += 1
+            stats['messages'] += message_count
+    stats['seconds'] = time.perf_counter() - start
+    stats['messages_per_second'] = stats['messages'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量导出全部历史对话")
+    parser.add_argument('output', help="输出文件路径")
+    parser.add_argument('--format', choices=['md', 'jsonl'], default='md', help="导出格式")
+    parser.add_argument('--storage-dir', default="conversations", help="对话存储目录")
+    parser.add_argument('--workers', type=int, default=None, help="工作进程数，默认等于CPU核数")
+    args = parser.parse_args()
+
+    stats = export_all(args.output, args.format, args.storage_dir, args.workers)
+    print(f"已导出 {stats['conversations']} 个对话、{stats['messages']} 条消息到 {args.output}，"
+          f"失败 {stats['errors']} 个，耗时 {stats['seconds']:.2f} 秒（{stats['messages_per_second']:.0f} 条消息/秒）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""多个 OpenAI 兼容接口之间的路由
+
+为每个接口记录首字耗时和输出速度的指数加权移动平均（EWMA），每个请求发往当前最快的
+可用接口；连续失败的接口由熔断器暂时移出轮换，冷却后先放行一个试探请求。
+
+接口列表写在 endpoints.json 中（可用 API_ENDPOINTS_FILE 指定其他路径），例如：
+    [
+        {"name": "siliconflow", "base_url": "https://api.siliconflow.cn/v1", "model": "deepseek-ai/DeepSeek-V3"},
+        {"name": "local", "base_url": "http://127.0.0.1:8000/v1", "model": "stand-in", "api_key": "local"}
+    ]
+api_key 可省略（使用 .env 中的 SILICONFLOW_API_KEY），也可用 api_key_env 指定其他环境变量。
+没有该文件时只使用 .env 中的 BASE_URL 和 MODEL_NAME。
+"""
+import json
+import os
+import time
+
+from openai import AsyncOpenAI
+
+
+class CircuitBreaker:
+    """连续失败 failure_threshold 次后断开，reset_timeout 秒后放行一个试探请求，成功则恢复；
+    试探请求超过 reset_timeout 秒仍没有结果时视为已丢失，再放行一个"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        # 当前试探请求的编号，只有它被放弃时才恢复为断开状态
+        self.probe = 0
+
+    def available(self):
+        """当前是否可以接收请求（不改变状态）"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return self.clock() - self.opened_at >= self.reset_timeout
+        return self.clock() - self.probe_started >= self.reset_timeout
+
+    def begin(self):
+        """请求即将发出；冷却结束后的第一个请求作为试探请求，返回试探编号，其他请求返回 None"""
+        if self.state != self.CLOSED and self.available():
+            self.state = self.HALF_OPEN
+            self.probe_started = self.clock()
+            self.probe += 1
+            return self.probe
+        return None
+
+    def abandon(self, probe):
+        """请求没有得出成败就结束（被取消、输给对冲请求、回答为空或出现不可重试的错误）；
+        probe 是仍在进行的试探请求的编号时恢复为已冷却的断开状态，由下一个请求重新试探"""
+        if probe is not None and self.state == self.HALF_OPEN and probe == self.probe:
+            self.state = self.OPEN
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+
+
+class Endpoint:
+    def __init__(self, name, base_url, model, api_key, http_client, breaker):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        self.breaker = breaker
+        # 首字耗时（秒）和输出速度（token/秒）的 EWMA，尚无样本时为 None
+        self.ttft = None
+        self.tokens_per_second = None
+        self.last_used = None
+        self.requests = 0
+        self.failures = 0
+
+
+class EndpointRouter:
+    def __init__(self, endpoints, alpha=0.3, probe_interval=60.0, expected_output_tokens=512,
+                 clock=time.monotonic):
+        self.endpoints = endpoints
+        self.alpha = alpha
+        # 超过该秒数没有使用的接口会被优先试一次，慢接口恢复后也能重新被选中
+        self.probe_interval = probe_interval
+        self.expected_output_tokens = expected_output_tokens
+        self.clock = clock
+
+    @classmethod
+    def from_config(cls, api_key, base_url, model, http_client, path=None):
+        """读取接口列表；没有配置文件时只使用 .env 中的接口"""
+        path = path or os.getenv("API_ENDPOINTS_FILE", "endpoints.json")
+        failure_threshold = int(os.getenv("API_BREAKER_FAILURES", "3"))
+        reset_timeout = float(os.getenv("API_BREAKER_RESET", "30"))
+        configs = [{'name': "default", 'base_url': base_url, 'model': model}]
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    configs = json.load(f)
+            except Exception as e:
+                print(f"读取接口列表 {path} 失败，只使用默认接口: {e}")
+        endpoints = []
+        for i, config in enumerate(configs):
+            key = config.get('api_key') or os.getenv(config.get('api_key_env', ''), '') or api_key
+            endpoints.append(Endpoint(config.get('name', f"endpoint{i + 1}"), config['base_url'],
+                                      config.get('model', model), key, http_client,
+                                      CircuitBreaker(failure_threshold, reset_timeout)))
+        return cls(endpoints)
+
+    def _score(self, endpoint):
+        """排序键：最近失败过（尚未熔断）的接口排在后面，其余按预计完成一次请求的秒数
+        （首字耗时 + 预计输出长度 / 输出速度）排序，需要试探的接口预计为 0 秒"""
+        failing = endpoint.breaker.state == CircuitBreaker.CLOSED and endpoint.breaker.consecutive_failures > 0
+        if endpoint.ttft is None or self.clock() - endpoint.last_used > self.probe_interval:
+            return failing, 0.0
+        seconds = endpoint.ttft
+        if endpoint.tokens_per_second:
+            seconds += self.expected_output_tokens / endpoint.tokens_per_second
+        return failing, seconds
+
+    def choose(self, exclude=()):
+        """选出预计最快的可用接口；都不可用时仍返回一个，避免请求直接失败
+
+        返回 (接口, 试探编号)，该请求不是熔断器的试探请求时编号为 None，放弃请求时传给 record_abandoned。
+        """
+        available = [e for e in self.endpoints if e.breaker.available()]
+        candidates = [e for e in available if e not in exclude] or available
+        if candidates:
+            endpoint = min(candidates, key=self._score)
+        else:
+            # 全部熔断时选冷却最久的接口
+            endpoint = min(self.endpoints, key=lambda e: e.breaker.opened_at)
+        probe = endpoint.breaker.begin()
+        endpoint.last_used = self.clock()
+        endpoint.requests += 1
+        return endpoint, probe
+
+    def _ewma(self, old, sample):
+        return sample if old is None else old + self.alpha * (sample - old)
+
+    def record_first_token(self, endpoint, seconds):
+        endpoint.ttft = self._ewma(endpoint.ttft, seconds)
+        endpoint.breaker.record_success()
+
+    def record_throughput(self, endpoint, tokens, seconds):
+        if tokens > 0 and seconds > 0:
+            endpoint.tokens_per_second = self._ewma(endpoint.tokens_per_second, tokens / seconds)
+
+    def record_failure(self, endpoint):
+        endpoint.failures += 1
+        endpoint.breaker.record_failure()
+
+    def record_abandoned(self, endpoint, probe):
+        endpoint.breaker.abandon(probe)
+
+    def stats(self):
+        """每个接口的状态、EWMA 首字耗时（毫秒）、输出速度和请求/失败次数"""
+        return [{
+            'name': e.name,
+            'model': e.model,
+            'state': e.breaker.state,
+            'ttft_ms': e.ttft * 1000 if e.ttft is not None else None,
+            'tokens_per_second': e.tokens_per_second,
+            'requests': e.requests,
+            'failures': e.failures,
+        } for e in self.endpoints]
@@ -0,0 +1,233 @@
+"""服务模式压测
+
+启动一个合成模式的替身服务器（stand_in_server.py）作为上游接口，再启动一个服务进程
+（agent_service.py）连接它，然后按逐级增加的并发数同时发起流式请求，每个请求使用不同的
+用户名。每一级报告成功、出错和被拒绝（503）的请求数、首字耗时和输出速度，最后给出首字耗时
+p95 不超过 --ttft-limit-ms 且没有失败请求的最大并发数，即单个进程能稳定支撑的并发流数量。
+
+用法: python load_test.py [--levels 10,50,100,200] [--endpoint chat|codegen|debate]
+      [--mock-ttft-ms 200] [--mock-tokens-per-second 50] [--mock-max-tokens 100] [--ttft-limit-ms 2000]
+      [--service http://127.0.0.1:8080]   # 压测已在运行的服务，不再启动替身服务器和服务进程
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+from retry_policy import LatencyTracker
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PAYLOADS = {
+    'chat': lambda i: {'message': f"第 {i} 个压测请求：请简单介绍一下协程。"},
+    'codegen': lambda i: {'request': f"第 {i} 个压测请求：读取CSV并统计每列的平均值", 'language': "Python"},
+    'debate': lambda i: {'topic': f"第 {i} 个压测话题：远程办公利大于弊", 'rounds': 1},
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url, process, timeout=30):
+    """轮询 url 直到返回成功，进程提前退出或超时时报错"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"进程已退出（返回码 {process.returncode}）: {' '.join(process.args)}")
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 超时")
+
+
+class StreamResult:
+    __slots__ = ('status', 'ttft', 'duration', 'chunks', 'chars', 'error')
+
+    def __init__(self):
+        self.status = None
+        self.ttft = None
+        self.duration = None
+        self.chunks = 0
+        self.chars = 0
+        self.error = None
+
+
+async def run_stream(host, port, path, user, payload, timeout):
+    """发起一个流式请求并读完全部 SSE 事件"""
+    result = StreamResult()
+    start = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        writer.write((f"POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\nX-User: {urllib.parse.quote(user)}\r\n"
+                      f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n").encode('latin-1')
+                     + body)
+        await writer.drain()
+
+        async def read_events():
+            status_line = await reader.readline()
+            status = int(status_line.split()[1])
+            while (await reader.readline()).strip():
+                pass
+            if status != 200:
+                result.status = "rejected" if status == 503 else "error"
+                result.error = f"HTTP {status}"
+                return
+            event = None
+            async for line in reader:
+                line = line.decode('utf-8').rstrip('\n')
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "chunk":
+                        if result.ttft is None:
+                            result.ttft = time.perf_counter() - start
+                        result.chunks += 1
+                        result.chars += len(data.get('content') or '')
+                    elif event == "error":
+                        result.status = "error"
+                        result.error = data.get('message')
+                    elif event == "done":
+                        result.status = "ok" if data.get('status') == "ok" else data.get('status')
+            if result.status is None:
+                result.status = "error"
+                result.error = "连接在 done 事件之前关闭"
+
+        await asyncio.wait_for(read_events(), timeout)
+    except asyncio.TimeoutError:
+        result.status = "error"
+        result.error = f"超过 {timeout:g} 秒未完成"
+    except (OSError, ValueError, IndexError) as e:
+        result.status = "error"
+        result.error = str(e) or type(e).__name__
+    finally:
+        if writer is not None:
+            writer.close()
+    result.duration = time.perf_counter() - start
+    return result
+
+
+async def run_level(host, port, endpoint, concurrency, timeout, offset):
+    """同时发起 concurrency 个请求，返回 (结果列表, 用时)"""
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        run_stream(host, port, f"/{endpoint}", f"loadtest-{offset + i}", PAYLOADS[endpoint](offset + i), timeout)
+        for i in range(concurrency)))
+    return results, time.perf_counter() - start
+
+
+def report_level(concurrency, results, elapsed):
+    """打印一级并发的结果，返回 (失败数, 首字耗时 p95 毫秒)"""
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    ok = [result for result in results if result.status == "ok"]
+    ttft = LatencyTracker(size=None)
+    for result in ok:
+        if result.ttft is not None:
+            ttft.add(result.ttft)
+    chunks = sum(result.chunks for result in results)
+    failed = len(results) - len(ok)
+    p50 = ttft.percentile(50) * 1000 if ok else float('nan')
+    p95 = ttft.percentile(95) * 1000 if ok else float('nan')
+    print(f"并发 {concurrency:>4}: 成功 {len(ok)}，失败 {failed}"
+          + (f"（{', '.join(f'{status} {count}' for status, count in counts.items() if status != 'ok')}）"
+             if failed else "")
+          + f"，首字耗时 p50 {p50:.0f} ms / p95 {p95:.0f} ms，用时 {elapsed:.1f} 秒，"
+            f"{len(ok) / elapsed:.1f} 流/秒，{chunks / elapsed:.0f} 块/秒")
+    errors = {result.error for result in results if result.error}
+    for error in list(errors)[:3]:
+        print(f"        错误示例: {error}")
+    return failed, p95
+
+
+def start_processes(args, storage_dir):
+    """启动替身服务器和服务进程，返回 (进程列表, 服务地址, 服务端口)"""
+    mock_port = free_port()
+    service_port = free_port()
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "stand_in_server.py"), "--mode", "synth", "--port", str(mock_port),
+         "--ttft-ms", str(args.mock_ttft_ms), "--ttft-sigma", "0.3",
+         "--tokens-per-second", str(args.mock_tokens_per_second), "--max-tokens", str(args.mock_max_tokens)],
+        stdout=subprocess.DEVNULL)
+    processes = [mock]
+    wait_until_ready(f"http://127.0.0.1:{mock_port}/v1/models", mock)
+    # 压测测的是服务本身，关闭限流；不写入 .env 以外的任何配置
+    env = dict(os.environ, SILICONFLOW_API_KEY="load-test", BASE_URL=f"http://127.0.0.1:{mock_port}/v1",
+               MODEL_NAME="stand-in", API_RPM="0", API_TPM="0", API_ENDPOINTS_FILE="", METRICS_FILE="",
+               METRICS_PORT="0")
+    service = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "agent_service.py"), "--port", str(service_port),
+         "--storage", storage_dir, "--max-streams", str(args.max_streams),
+         "--max-sessions", str(args.max_streams)],
+        stdout=subprocess.DEVNULL, env=env, cwd=HERE)
+    processes.append(service)
+    wait_until_ready(f"http://127.0.0.1:{service_port}/health", service)
+    return processes, "127.0.0.1", service_port
+
+
+def main():
+    parser = argparse.ArgumentParser(description="服务模式压测：逐级增加并发流数量")
+    parser.add_argument('--levels', default="10,50,100,200", help="逐级的并发数，逗号分隔")
+    parser.add_argument('--endpoint', choices=sorted(PAYLOADS), default="chat", help="压测的接口")
+    parser.add_argument('--service', default=None, help="已在运行的服务地址，不指定时自动启动替身服务器和服务进程")
+    parser.add_argument('--max-streams', type=int, default=1000, help="自动启动的服务进程的回答数上限")
+    parser.add_argument('--mock-ttft-ms', type=float, default=200.0, help="替身服务器首字耗时的中位数（毫秒）")
+    parser.add_argument('--mock-tokens-per-second', type=float, default=50.0, help="替身服务器的输出速度")
+    parser.add_argument('--mock-max-tokens', type=int, default=100, help="替身服务器每个回答的 token 数")
+    parser.add_argument('--ttft-limit-ms', type=float, default=2000.0, help="视为稳定支撑的首字耗时 p95 上限")
+    parser.add_argument('--timeout', type=float, default=120.0, help="单个请求的超时（秒）")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(',') if level.strip()]
+
+    processes = []
+    storage_dir = tempfile.mkdtemp(prefix="load_test_")
+    try:
+        if args.service:
+            url = urllib.parse.urlsplit(args.service)
+            host, port = url.hostname, url.port or 80
+        else:
+            processes, host, port = start_processes(args, storage_dir)
+            print(f"替身服务器首字耗时约 {args.mock_ttft_ms:g} ms，输出 {args.mock_tokens_per_second:g} token/秒，"
+                  f"每个回答 {args.mock_max_tokens} token")
+        sustained = 0
+        offset = 0
+        for concurrency in levels:
+            results, elapsed = asyncio.run(run_level(host, port, args.endpoint, concurrency, args.timeout, offset))
+            offset += concurrency
+            failed, p95 = report_level(concurrency, results, elapsed)
+            if failed == 0 and p95 <= args.ttft_limit_ms:
+                sustained = concurrency
+        with urllib.request.urlopen(f"http://{host}:{port}/health", timeout=5) as response:
+            health = json.load(response)
+        print(f"服务进程当前会话 {health['sessions']} 个，累计处理 {health['served_streams']} 个流式请求")
+        print(f"单个进程稳定支撑的并发流: {sustained}" if sustained else "没有一级并发满足稳定条件")
+    except KeyboardInterrupt:
+        print("已中断")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
+import os
 import tkinter as tk
+from tkinter import messagebox
 from api_client import APIClient
-from app_pages import HomePage, ChatPage, MultiAgentPage, CodeGenPage
+from async_api_client import AsyncAPIClient
+from app_pages import HomePage, ChatPage, MultiAgentPage, CodeGenPage, MetricsPanel
 from sensitive_word_filter import SensitiveWordFilter
 
 class MainApp(tk.Tk):
@@ -10,13 +13,19 @@ class MainApp(tk.Tk):
         self.geometry("800x600")
 
         try:
-            # 实例化API客户端
+            # 读取接口配置和回答缓存设置，请求由下面的异步客户端发出
             self.api_client = APIClient()
-        except ValueError:
-            # 如果API密钥未找到，则退出应用
+        except ValueError as e:
+            # 如果API密钥未找到，则提示后退出应用
+            messagebox.showerror("API密钥错误", str(e))
             self.destroy()
             return
 
+        # 各页面的请求作为协程在同一个后台事件循环上运行，共用一个连接池；
+        # 出错时在事件循环线程上报告，由 show_error 转到界面线程弹出对话框
+        self.async_client = AsyncAPIClient.from_api_client(self.api_client, error_handler=self.show_error)
+        # 按 .env 中的 METRICS_FILE / METRICS_PORT 导出请求耗时统计
+        self.async_client.metrics.start_from_env()
         self.sensitive_filter = SensitiveWordFilter()  # 创建敏感词过滤器实例
 
         container = tk.Frame(self)
@@ -31,11 +40,23 @@ class MainApp(tk.Tk):
             self.frames[page_name] = frame
             frame.grid(row=0, column=0, sticky="nsew")
 
-        self.status_bar = tk.Label(self, text="就绪", bd=1, relief=tk.SUNKEN, anchor=tk.W)
-        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        status_frame = tk.Frame(self)
+        status_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        self.status_bar = tk.Label(status_frame, text="就绪", bd=1, relief=tk.SUNKEN, anchor=tk.W)
+        self.status_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        # 右侧显示请求调度的排队情况和剩余额度
+        self.scheduler_bar = tk.Label(status_frame, text="", bd=1, relief=tk.SUNKEN, anchor=tk.E)
+        self.scheduler_bar.pack(side=tk.RIGHT)
+        tk.Button(status_frame, text="耗时统计", bd=1, command=self.open_metrics_panel).pack(side=tk.RIGHT)
+        self.update_scheduler_status()
 
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         self.show_home_page()
 
+        # 停留在主页时提前建立到API服务器的连接，第一次提问不必再等待握手（.env 中 API_WARM_UP=0 可关闭）
+        if os.getenv("API_WARM_UP", "1") != "0":
+            self.async_client.warm_up()
+
     def show_frame(self, page_name):
         """将指定名称的页面显示在最上层。"""
         frame = self.frames[page_name]
@@ -57,6 +78,43 @@ class MainApp(tk.Tk):
         """显示代码生成页面。"""
         self.show_frame("CodeGenPage")
 
+    def open_metrics_panel(self):
+        """打开请求耗时统计面板。"""
+        MetricsPanel(self, self.async_client.metrics)
+
+    def on_close(self):
+        """关闭窗口前持久化对话索引，关闭连接池和回答缓存。"""
+        self.frames["ChatPage"].memory.close()
+        self.async_client.close()
+        self.api_client.close()
+        self.destroy()
+
+    def update_scheduler_status(self):
+        """每秒刷新一次请求调度的统计信息。"""
+        stats = self.async_client.scheduler.stats()
+        parts = [f"排队 {stats['queued']}"]
+        if stats['queued_by_priority']:
+            parts[0] += "（" + "/".join(f"{name}{count}" for name, count in stats['queued_by_priority'].items()) + "）"
+        parts.append(f"等待 p95 {stats['wait_p95_ms']:.0f}ms")
+        if stats['requests_available'] is not None:
+            parts.append(f"请求额度 {stats['requests_available']:.0f}")
+        if stats['tokens_available'] is not None:
+            parts.append(f"token额度 {stats['tokens_available']:.0f}")
+        endpoints = self.async_client.router.stats()
+        if len(endpoints) > 1:
+            # 配置了多个接口时显示各接口的首字耗时，熔断中的接口标记为"断开"
+            parts.append(" ".join(
+                f"{e['name']}:断开" if e['state'] != "closed"
+                else f"{e['name']}:{e['ttft_ms']:.0f}ms" if e['ttft_ms'] is not None
+                else f"{e['name']}:-"
+                for e in endpoints))
+        self.scheduler_bar.config(text=" | ".join(parts))
+        self.after(1000, self.update_scheduler_status)
+
+    def show_error(self, title, message):
+        """在界面线程中弹出错误对话框；可从后台事件循环线程调用，不等待用户关闭对话框，其他回答照常进行。"""
+        self.after(0, messagebox.showerror, title, message)
+
     def set_status(self, message):
         """更新状态栏的文本。"""
         self.status_bar.config(text=message)
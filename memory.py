@@ -1,45 +1,761 @@
+import hashlib
 import json
 import os
+import re
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 
+from recall_index import make_snippet
+
+# 旧的平铺布局使用的单文件索引，迁移到分片目录后删除
+INDEX_FILENAME = "conversations.index"
+# 分片清单所在的子目录，以及运行期间存在、正常退出时删除的标记文件
+MANIFEST_DIRNAME = "index"
+SESSION_MARKER = "session.open"
+# 跨对话检索索引的持久化文件，位于清单目录中
+RECALL_INDEX_FILENAME = "recall.json"
+SHARD_WIDTH = 2
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# LaTeX公式标记 \( \) \[ \] 转换为 Markdown 的 $ / $$，一次扫描完成全部替换
+_LATEX_DELIMITER = re.compile(r'\\[()\[\]]')
+_LATEX_REPLACEMENT = {r'\(': '$', r'\)': '$', r'\[': '$$', r'\]': '$$'}
+
+
+def rewrite_latex_delimiters(text):
+    """替换LaTeX公式标记"""
+    return _LATEX_DELIMITER.sub(lambda m: _LATEX_REPLACEMENT[m.group()], text)
+
+
+def iter_markdown(conversation_id, conversation):
+    """逐段生成对话的 Markdown 文本"""
+    yield f"# 对话记录: {conversation_id}\n\n"
+    yield f"**创建时间**: {conversation['created_at']}\n\n"
+    for msg in conversation['messages']:
+        yield f"## {msg['role']} ({msg['timestamp']})\n\n"
+        yield f"{rewrite_latex_delimiters(msg['content'])}\n\n"
+
+
+def _parse_timestamp(text):
+    """把 "YYYY-MM-DD HH:MM:SS" 格式的旧时间戳转换为整数秒，无法解析时返回 0"""
+    try:
+        return int(time.mktime((int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                                int(text[11:13]), int(text[14:16]), int(text[17:19]), 0, 0, -1)))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+class Message:
+    """对话中的一条消息
+
+    角色字符串驻留共享，时间戳保存为整数秒，只在写盘或调用接口时才转换为字典。
+    同时支持 msg['content']、msg.get('role') 等字典式访问，兼容原有代码。
+    """
+
+    __slots__ = ('role', 'content', 'created', 'tokens')
+
+    FIELDS = ('role', 'content', 'timestamp', 'created', 'tokens')
+
+    def __init__(self, role, content, created=None, tokens=None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.created = int(time.time()) if created is None else created
+        # token 数由 ContextBuilder 按需计算并缓存，不写入磁盘
+        self.tokens = tokens
+
+    @property
+    def timestamp(self):
+        return time.strftime(TIMESTAMP_FORMAT, time.localtime(self.created))
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in ('content', 'tokens'):
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def to_dict(self):
+        """转换为保存到文件时的字典格式"""
+        return {'role': self.role, 'content': self.content, 'timestamp': self.timestamp, 'created': self.created}
+
+    @classmethod
+    def from_dict(cls, data):
+        created = data.get('created')
+        if created is None:
+            created = _parse_timestamp(data.get('timestamp'))
+        return cls(data.get('role', 'user'), data.get('content', ''), created)
+
+
+def _json_default(obj):
+    if isinstance(obj, Message):
+        return obj.to_dict()
+    raise TypeError(f"无法序列化 {type(obj).__name__}")
+
+
+def _load_messages(data):
+    data['messages'] = [Message.from_dict(msg) for msg in data.get('messages', [])]
+    return data
+
+
+class JsonConversationStore:
+    """每个对话一个 JSON 文件，每次保存整体重写"""
+
+    suffix = '.json'
+
+    def read(self, path, repair=False):
+        with open(path, 'r', encoding='utf-8') as f:
+            return _load_messages(json.load(f))
+
+    def write(self, path, conversation):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(conversation, f, ensure_ascii=False, indent=2, default=_json_default)
+
+    def forget(self, conversation_id):
+        pass
+
+
+class JournalConversationStore:
+    """每个对话一个 JSONL 追加日志：首行是对话头，之后每行一条消息
+
+    保存时只把新增消息一次性追加到文件末尾；读取时跳过崩溃留下的半行，只有 repair 为 True
+    时才截断文件（读取可能与另一线程的追加同时进行，末尾的半行也可能是正在写入的记录）；
+    内存中的消息列表与磁盘不再是单纯追加关系时，改为原子重写（压缩）整个日志。
+    """
+
+    suffix = '.jsonl'
+
+    def __init__(self, fsync=True):
+        self.fsync = fsync
+        # 对话id -> 已写入日志的消息条数
+        self.persisted = {}
+
+    def read(self, path, repair=False):
+        if path.endswith(JsonConversationStore.suffix):
+            return JsonConversationStore().read(path)
+        header = None
+        messages = []
+        good_bytes = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                # 没有换行结尾或无法解析的行只可能是最后一次写入被中断
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if header is None:
+                    header = record
+                else:
+                    messages.append(Message.from_dict(record))
+                good_bytes += len(line)
+        torn = good_bytes < os.path.getsize(path)
+        if torn and repair:
+            print(f"对话日志 {path} 末尾存在不完整的记录，已截断")
+            with open(path, 'r+b') as f:
+                f.truncate(good_bytes)
+        if header is None:
+            raise ValueError("对话日志缺少对话头")
+        header['messages'] = messages
+        if not torn or repair:
+            # 已知写入条数时以写入方为准；末尾有半行且未修复时不记录，下次保存会整体重写
+            self.persisted.setdefault(header['id'], len(messages))
+        return header
+
+    def write(self, path, conversation):
+        conversation_id = conversation['id']
+        messages = conversation['messages']
+        # 只取一次长度：不开启后台写盘时其他线程可能同时追加消息，之后追加的留给下次保存
+        end = len(messages)
+        count = self.persisted.get(conversation_id)
+        if count is None or count > end or not os.path.exists(path):
+            self.compact(path, conversation)
+            return
+        if count == end:
+            return
+        payload = ''.join(json.dumps(msg, ensure_ascii=False, default=_json_default) + '\n'
+                          for msg in messages[count:end])
+        try:
+            with open(path, 'ab') as f:
+                f.write(payload.encode('utf-8'))
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            # 追加可能只写了一半，下次保存时整体重写
+            self.persisted.pop(conversation_id, None)
+            raise
+        self.persisted[conversation_id] = end
+
+    def compact(self, path, conversation):
+        """把对话整体重写为一行对话头加每条消息一行，先写临时文件再原子替换"""
+        header = {k: v for k, v in conversation.items() if k != 'messages'}
+        messages = conversation['messages']
+        end = len(messages)
+        lines = [json.dumps(header, ensure_ascii=False)]
+        lines.extend(json.dumps(msg, ensure_ascii=False, default=_json_default) for msg in messages[:end])
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.persisted[conversation['id']] = end
+
+    def forget(self, conversation_id):
+        self.persisted.pop(conversation_id, None)
+
+
+class BackgroundWriter:
+    """后台写盘线程：同一对话排队期间的多次保存只写最后一次，排队的对话数有上限"""
+
+    def __init__(self, write_func, max_pending=64):
+        self.write_func = write_func
+        self.max_pending = max_pending
+        # 对话id -> 待写入的快照，按提交顺序写盘
+        self.pending = OrderedDict()
+        self.in_flight = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writes = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, key, payload):
+        """提交一次保存；队列已满时阻塞调用方，直到后台线程腾出位置"""
+        with self.condition:
+            if key in self.pending:
+                self.pending[key] = payload
+                self.coalesced += 1
+                return
+            while len(self.pending) >= self.max_pending and not self.closed:
+                self.condition.wait()
+            self.pending[key] = payload
+            self.condition.notify_all()
+
+    def get(self, key):
+        """返回尚未写盘的最新快照，没有时返回 None"""
+        with self.condition:
+            if key in self.pending:
+                return self.pending[key]
+            if self.in_flight and self.in_flight[0] == key:
+                return self.in_flight[1]
+            return None
+
+    def discard(self, key):
+        """放弃尚未开始写入的保存，并等待正在进行的写入结束；返回是否放弃了排队中的保存"""
+        with self.condition:
+            dropped = self.pending.pop(key, None) is not None
+            while self.in_flight and self.in_flight[0] == key:
+                self.condition.wait()
+            return dropped
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                self.in_flight = self.pending.popitem(last=False)
+                self.condition.notify_all()
+            start = time.perf_counter()
+            try:
+                self.write_func(*self.in_flight)
+            except Exception as e:
+                print(f"后台保存对话 {self.in_flight[0]} 失败: {e}")
+                self.errors += 1
+            latency = time.perf_counter() - start
+            with self.condition:
+                self.in_flight = None
+                self.writes += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """等待所有已提交的保存写盘，超时返回 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending or self.in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self):
+        """写完剩余的保存后结束后台线程"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        """返回待写入数量和写盘耗时统计（毫秒）"""
+        with self.condition:
+            return {
+                'pending': len(self.pending) + (1 if self.in_flight else 0),
+                'writes': self.writes,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'avg_latency_ms': self.total_latency / self.writes * 1000 if self.writes else 0.0,
+                'max_latency_ms': self.max_latency * 1000,
+            }
+
+
+def store_for_path(path):
+    """根据文件后缀返回能读写该文件的存储格式"""
+    if path.endswith(JournalConversationStore.suffix):
+        return JournalConversationStore()
+    return JsonConversationStore()
+
+
+CONVERSATION_SUFFIXES = (JsonConversationStore.suffix, JournalConversationStore.suffix)
+
+
+def shard_of(conversation_id):
+    """对话所在的分片目录名：对话id哈希值的前两位十六进制数，共 256 个分片"""
+    return hashlib.md5(conversation_id.encode('utf-8')).hexdigest()[:SHARD_WIDTH]
+
+
+def is_shard_name(name):
+    return len(name) == SHARD_WIDTH and all(c in '0123456789abcdef' for c in name)
+
+
+def iter_conversation_files(storage_dir):
+    """逐个产出对话文件路径（分片目录以及尚未迁移的平铺文件），不一次性列出整个目录"""
+    with os.scandir(storage_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if is_shard_name(entry.name):
+                    yield from iter_conversation_files(entry.path)
+            elif entry.name.endswith(CONVERSATION_SUFFIXES):
+                yield entry.path
+
+
 class ConversationMemory:
-    def __init__(self, storage_dir="conversations"):
+    """对话存储：对话文件按id哈希分散到 256 个分片目录中，每个分片在 index/ 下有一份清单
+
+    上次正常退出且分片目录的修改时间与清单中记录的一致时，启动时直接采用清单，
+    不再逐个检查该分片中的文件。旧版本平铺在存储目录下的对话文件由后台线程
+    逐个移入分片目录，迁移期间访问到的对话会先被立即迁移。
+    """
+
+    def __init__(self, storage_dir="conversations", max_cache_bytes=32 * 1024 * 1024, index_flush_interval=30,
+                 store=None, write_behind=False, recall_index=None, repair_journals=True):
         self.storage_dir = storage_dir
+        # 载入时截断对话日志末尾崩溃留下的半行；只有拥有该存储目录的实例才应开启
+        self.repair_journals = repair_journals
+        # 索引和缓存可能同时被界面线程、流式输出线程和后台写盘线程访问
+        self.lock = threading.RLock()
+        # 对话文件的存储格式，默认每个对话一个 JSON 文件
+        self.store = store if store is not None else JsonConversationStore()
         self.current_conversation = None
-        self.conversations = {}
+        # 对话索引：id -> {created_at, title, message_count, mtime, size}，启动时只读取它
+        self.index = {}
+        # 分片名 -> 该分片中的对话id；清单按分片写入，只重写有变化的分片
+        self.shard_members = {}
+        self.dirty_shards = set()
+        # 仍平铺在存储目录下、等待迁移到分片目录的对话id
+        self.unmigrated = set()
+        # 最近使用的对话正文，按文件字节数限制总大小
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.max_cache_bytes = max_cache_bytes
+        self.index_flush_interval = index_flush_interval
+        self.last_index_flush = 0.0
         os.makedirs(storage_dir, exist_ok=True)
         self.load_conversations()
+        # 开启后保存操作只提交快照，由后台线程合并并写盘
+        self.writer = BackgroundWriter(self._write_conversation) if write_behind else None
+        self.closing = threading.Event()
+        self.migration_thread = None
+        if self.unmigrated:
+            self.migration_thread = threading.Thread(target=self._migrate_all, name="conversation-migration",
+                                                     daemon=True)
+            self.migration_thread.start()
+        # 跨对话检索用的倒排索引（recall_index.RecallIndex）。启动时先载入上次退出时保存的索引，
+        # 上次保存后有变化或尚未索引的对话由后台线程逐个加入
+        self.recall_index = recall_index
+        self.recall_thread = None
+        if recall_index is not None:
+            self._load_recall_index()
+            self.recall_thread = threading.Thread(target=self._build_recall_index, name="recall-index", daemon=True)
+            self.recall_thread.start()
+
+    def _path(self, conversation_id):
+        return os.path.join(self.storage_dir, shard_of(conversation_id), f"{conversation_id}{self.store.suffix}")
+
+    def _flat_paths(self, conversation_id):
+        """旧的平铺布局下对话可能使用的文件路径，当前存储格式优先"""
+        suffixes = (self.store.suffix,) + tuple(s for s in CONVERSATION_SUFFIXES if s != self.store.suffix)
+        return [os.path.join(self.storage_dir, f"{conversation_id}{suffix}") for suffix in suffixes]
+
+    def _manifest_path(self, shard):
+        return os.path.join(self.storage_dir, MANIFEST_DIRNAME, f"{shard}.json")
+
+    @staticmethod
+    def _make_index_entry(data, stat):
+        """根据对话内容和文件状态生成索引项"""
+        messages = data.get('messages', [])
+        title = next((msg['content'] for msg in messages if msg.get('role') == 'user'), '')
+        return {
+            'created_at': data.get('created_at', ''),
+            'title': title[:30],
+            'message_count': len(messages),
+            'mtime': stat.st_mtime if stat else None,
+            'size': stat.st_size if stat else 0,
+        }
+
+    def _set_entry(self, conversation_id, meta):
+        """更新索引项并标记所在分片的清单需要重写（调用方持有 self.lock）"""
+        shard = shard_of(conversation_id)
+        self.index[conversation_id] = meta
+        self.shard_members.setdefault(shard, set()).add(conversation_id)
+        self.dirty_shards.add(shard)
+        return meta
+
+    def _drop_entry(self, conversation_id):
+        shard = shard_of(conversation_id)
+        del self.index[conversation_id]
+        self.shard_members.get(shard, set()).discard(conversation_id)
+        self.dirty_shards.add(shard)
 
     def load_conversations(self):
-        """加载所有保存的对话"""
-        self.conversations = {}
-        for filename in os.listdir(self.storage_dir):
-            if filename.endswith('.json'):
-                filepath = os.path.join(self.storage_dir, filename)
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.conversations[filename[:-5]] = data
+        """加载对话索引：读取各分片清单，只重新解析清单缺失或已被修改的对话文件"""
+        self.index = {}
+        self.shard_members = {}
+        self.dirty_shards = set()
+        self.unmigrated = set()
+        self.cache.clear()
+        self.cache_bytes = 0
+        marker_path = os.path.join(self.storage_dir, SESSION_MARKER)
+        # 标记文件仍在说明上次没有正常退出，清单可能落后于对话文件，需要逐个核对
+        trusted = not os.path.exists(marker_path)
+        shards = []
+        flat_entries = []
+        with os.scandir(self.storage_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if is_shard_name(entry.name):
+                        shards.append(entry)
+                elif entry.name.endswith(CONVERSATION_SUFFIXES):
+                    flat_entries.append(entry)
+        for entry in shards:
+            self._load_shard(entry.name, entry.path, trusted)
+
+        legacy_index_path = os.path.join(self.storage_dir, INDEX_FILENAME)
+        if flat_entries:
+            self._load_flat(flat_entries, legacy_index_path)
+        elif os.path.exists(legacy_index_path):
+            os.remove(legacy_index_path)
+        self.save_index()
+        with open(marker_path, 'w', encoding='utf-8'):
+            pass
+
+    def _read_manifest(self, shard):
+        try:
+            with open(self._manifest_path(shard), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"读取分片 {shard} 的清单失败，将重建: {e}")
+            return None
+
+    def _load_shard(self, shard, shard_dir, trusted):
+        manifest = self._read_manifest(shard)
+        # 清单由另一种存储格式写入时，其中的对话文件后缀与当前格式不同，需要重新扫描分片
+        if trusted and manifest and manifest.get('suffix') == self.store.suffix \
+                and manifest.get('dir_mtime') == os.stat(shard_dir).st_mtime_ns:
+            self.index.update(manifest['entries'])
+            self.shard_members[shard] = set(manifest['entries'])
+            return
+
+        stored = manifest['entries'] if manifest else {}
+        self.shard_members[shard] = set()
+        self.dirty_shards.add(shard)
+        suffix = self.store.suffix
+        with os.scandir(shard_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith((suffix, JsonConversationStore.suffix)) or not entry.is_file():
+                    continue
+                conversation_id = os.path.splitext(entry.name)[0]
+                if entry.name.endswith(suffix):
+                    meta = stored.get(conversation_id)
+                    stat = entry.stat()
+                    if meta and meta.get('mtime') == stat.st_mtime and meta.get('size') == stat.st_size:
+                        self._set_entry(conversation_id, meta)
+                        continue
+                try:
+                    data = self.store.read(entry.path, repair=self.repair_journals)
+                    if not entry.name.endswith(suffix):
+                        # 切换到日志格式后，旧的 JSON 对话在这里一次性转换
+                        self.store.write(self._path(conversation_id), data)
+                        os.remove(entry.path)
+                except Exception as e:
+                    print(f"加载对话 {conversation_id} 失败: {e}")
+                    continue
+                self._set_entry(conversation_id, self._make_index_entry(data, os.stat(self._path(conversation_id))))
+
+    def _load_flat(self, flat_entries, legacy_index_path):
+        """登记旧的平铺布局下的对话，沿用旧索引中仍然有效的索引项，文件本身留给后台线程迁移"""
+        stored = {}
+        try:
+            if os.path.exists(legacy_index_path):
+                with open(legacy_index_path, 'r', encoding='utf-8') as f:
+                    stored = json.load(f)
+        except Exception as e:
+            print(f"读取旧的对话索引失败，将重新解析对话文件: {e}")
+
+        for entry in flat_entries:
+            conversation_id = os.path.splitext(entry.name)[0]
+            self.unmigrated.add(conversation_id)
+            if conversation_id in self.index:
+                # 上次迁移在删除旧文件前中断，分片中的文件才是最新的
+                continue
+            meta = stored.get(conversation_id)
+            stat = entry.stat()
+            if not (meta and meta.get('mtime') == stat.st_mtime and meta.get('size') == stat.st_size):
+                try:
+                    meta = self._make_index_entry(
+                        store_for_path(entry.path).read(entry.path, repair=self.repair_journals), stat)
+                except Exception as e:
+                    print(f"加载对话 {conversation_id} 失败: {e}")
+                    self.unmigrated.discard(conversation_id)
+                    continue
+            self._set_entry(conversation_id, meta)
+
+    def _migrate_file(self, conversation_id):
+        """把一个平铺布局下的对话移入分片目录，已迁移时什么也不做"""
+        with self.lock:
+            if conversation_id not in self.unmigrated:
+                return
+            target = self._path(conversation_id)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                for path in self._flat_paths(conversation_id):
+                    if not os.path.exists(path):
+                        continue
+                    if os.path.exists(target):
+                        os.remove(path)
+                    elif path.endswith(self.store.suffix):
+                        os.replace(path, target)
+                    else:
+                        data = store_for_path(path).read(path)
+                        self.store.write(target, data)
+                        os.remove(path)
+                        self._set_entry(conversation_id, self._make_index_entry(data, os.stat(target)))
+            except Exception as e:
+                print(f"迁移对话 {conversation_id} 失败: {e}")
+                return
+            self.unmigrated.discard(conversation_id)
+            self.dirty_shards.add(shard_of(conversation_id))
+
+    def _migrate_all(self):
+        """后台线程：逐个迁移平铺布局下的对话，全部完成后删除旧索引"""
+        with self.lock:
+            pending = list(self.unmigrated)
+        for conversation_id in pending:
+            if self.closing.is_set():
+                return
+            self._migrate_file(conversation_id)
+        with self.lock:
+            if self.unmigrated:
+                return
+            legacy_index_path = os.path.join(self.storage_dir, INDEX_FILENAME)
+            if os.path.exists(legacy_index_path):
+                os.remove(legacy_index_path)
+        self.save_index()
+        print(f"已把 {len(pending)} 个对话迁移到分片目录")
+
+    def save_index(self, force=True):
+        """把有变化的分片清单写入磁盘（先写临时文件再原子替换）"""
+        with self.lock:
+            if not self.dirty_shards:
+                return
+            now = time.monotonic()
+            if not force and now - self.last_index_flush < self.index_flush_interval:
+                return
+            manifest_dir = os.path.join(self.storage_dir, MANIFEST_DIRNAME)
+            os.makedirs(manifest_dir, exist_ok=True)
+            shards, self.dirty_shards = self.dirty_shards, set()
+            for shard in shards:
+                # 先取目录修改时间再取索引项，之后目录再有变化时清单会被判定为过期
+                try:
+                    dir_mtime = os.stat(os.path.join(self.storage_dir, shard)).st_mtime_ns
+                except FileNotFoundError:
+                    dir_mtime = None
+                entries = {conversation_id: self.index[conversation_id]
+                           for conversation_id in self.shard_members.get(shard, ())
+                           if conversation_id not in self.unmigrated}
+                fd, tmp_path = tempfile.mkstemp(dir=manifest_dir, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        json.dump({'dir_mtime': dir_mtime, 'suffix': self.store.suffix, 'entries': entries}, f,
+                                  ensure_ascii=False, separators=(',', ':'))
+                    os.replace(tmp_path, self._manifest_path(shard))
+                except Exception as e:
+                    print(f"保存分片 {shard} 的清单失败: {e}")
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    self.dirty_shards.add(shard)
+            self.last_index_flush = now
+
+    def close(self):
+        """退出前写完后台排队的保存，并把尚未持久化的清单写入磁盘"""
+        self.closing.set()
+        for thread in (self.migration_thread, self.recall_thread):
+            if thread:
+                thread.join()
+        if self.writer:
+            self.writer.close()
+        self.save_index()
+        if self.recall_index is not None:
+            os.makedirs(os.path.join(self.storage_dir, MANIFEST_DIRNAME), exist_ok=True)
+            self.recall_index.save(self._recall_index_path())
+        marker_path = os.path.join(self.storage_dir, SESSION_MARKER)
+        if not self.dirty_shards and os.path.exists(marker_path):
+            os.remove(marker_path)
+
+    def write_stats(self):
+        """后台写盘的统计信息，未开启后台写盘时返回 None"""
+        return self.writer.stats() if self.writer else None
+
+    def _cache_put(self, conversation_id, data, size):
+        with self.lock:
+            if conversation_id in self.cache:
+                self.cache_bytes -= self.cache.pop(conversation_id)[1]
+            self.cache[conversation_id] = (data, size)
+            self.cache_bytes += size
+            # 超出字节上限时淘汰最久未使用的对话（至少保留刚放入的这一个）
+            while self.cache_bytes > self.max_cache_bytes and len(self.cache) > 1:
+                _, (_, evicted_size) = self.cache.popitem(last=False)
+                self.cache_bytes -= evicted_size
+
+    def _load_conversation(self, conversation_id, cache=True):
+        """按需读取对话正文，命中缓存时直接返回；cache 为 False 时读取的内容不放入缓存"""
+        with self.lock:
+            cached = self.cache.get(conversation_id)
+            if cached is not None:
+                self.cache.move_to_end(conversation_id)
+                return cached[0]
+            if conversation_id not in self.index:
+                return None
+        if self.writer:
+            pending = self.writer.get(conversation_id)
+            if pending is not None:
+                return pending
+        self._migrate_file(conversation_id)
+        filepath = self._path(conversation_id)
+        try:
+            data = self.store.read(filepath)
+        except Exception as e:
+            print(f"加载对话 {conversation_id} 失败: {e}")
+            return None
+        if cache:
+            self._cache_put(conversation_id, data, self.index[conversation_id].get('size', 0))
+        return data
+
+    def _recall_index_path(self):
+        return os.path.join(self.storage_dir, MANIFEST_DIRNAME, RECALL_INDEX_FILENAME)
+
+    def _load_recall_index(self):
+        """载入保存的检索索引，并去掉其中已不存在的对话（在新消息加入索引之前调用）"""
+        if not self.recall_index.load(self._recall_index_path()):
+            return
+        with self.lock:
+            stale = [conversation_id
+                     for conversation_id in set(self.recall_index.by_conversation) | set(self.recall_index.sources)
+                     if conversation_id not in self.index]
+        for conversation_id in stale:
+            self.recall_index.remove_conversation(conversation_id)
+
+    def _build_recall_index(self):
+        """后台线程：把索引中缺失或文件已变化的对话逐个加入检索索引，不占用对话缓存"""
+        with self.lock:
+            conversations = [(conversation_id, [meta.get('mtime'), meta.get('size')])
+                             for conversation_id, meta in self.index.items()]
+        for conversation_id, source in conversations:
+            if self.closing.is_set():
+                return
+            if self.recall_index.sources.get(conversation_id) == source:
+                continue
+            data = self._load_conversation(conversation_id, cache=False)
+            if data is not None:
+                # 消息只会追加，已索引的消息在加入时被忽略
+                self.recall_index.add_conversation(conversation_id, data.get('messages', []), source=source)
+
+    def recall(self, query, k=5, snippet_chars=200):
+        """从以往的对话中检索与 query 最相关的 k 条消息，返回 [{conversation_id, index, role, snippet, score}, ...]"""
+        if self.recall_index is None:
+            return []
+        current_id = self.current_conversation['id'] if self.current_conversation else None
+        results = []
+        for score, conversation_id, seq in self.recall_index.search(query, k, exclude_conversation=current_id):
+            messages = self.get_conversation_history(conversation_id)
+            if seq >= len(messages):
+                continue
+            msg = messages[seq]
+            results.append({'conversation_id': conversation_id, 'index': seq, 'role': msg['role'],
+                             'snippet': make_snippet(msg['content'], query, snippet_chars), 'score': score})
+        return results
 
     def start_new_conversation(self):
-        """开始新的对话"""
+        """开始新的对话，id 由创建时间加随机后缀组成，同一秒内创建的对话也不会重名"""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        conversation_id = f"对话_{timestamp}_{secrets.token_hex(3)}"
+        while conversation_id in self.index:
+            conversation_id = f"对话_{timestamp}_{secrets.token_hex(3)}"
         self.current_conversation = {
-            'id': f"对话_{timestamp}",
+            'id': conversation_id,
             'created_at': timestamp,
             'messages': []
         }
         return self.current_conversation['id']
 
+    def open_conversation(self, conversation_id):
+        """把已保存的对话设为当前对话，之后的消息追加到该对话中；对话不存在时返回 False"""
+        data = self._load_conversation(conversation_id)
+        if data is None:
+            return False
+        self.current_conversation = data
+        return True
+
     def add_message(self, role, content):
         """添加消息到当前对话"""
         if self.current_conversation is None:
             self.start_new_conversation()
-        
-        self.current_conversation['messages'].append({
-            'role': role,
-            'content': content,
-            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
+
+        messages = self.current_conversation['messages']
+        messages.append(Message(role, content))
+        if self.recall_index is not None:
+            self.recall_index.add(self.current_conversation['id'], len(messages) - 1, content)
 
     def get_conversation_history(self, conversation_id=None):
         """获取对话历史"""
@@ -48,48 +764,102 @@ class ConversationMemory:
                 return self.current_conversation['messages']
             return []
         else:
-            return self.conversations.get(conversation_id, {}).get('messages', [])
+            data = self._load_conversation(conversation_id)
+            return data.get('messages', []) if data else []
 
     def save_conversation(self):
         """保存当前对话到文件"""
         if self.current_conversation:
-            filepath = os.path.join(self.storage_dir, f"{self.current_conversation['id']}.json")
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(self.current_conversation, f, ensure_ascii=False, indent=2)
-            self.conversations[self.current_conversation['id']] = self.current_conversation
+            conversation = self.current_conversation
+            conversation_id = conversation['id']
+            if self.writer is None:
+                self._write_conversation(conversation_id, conversation)
+                return
+            # 后台写盘时提交快照，之后继续追加的消息不会和写盘线程冲突
+            snapshot = dict(conversation)
+            snapshot['messages'] = list(conversation['messages'])
+            with self.lock:
+                # 新对话先登记到索引中，写盘完成前也能出现在对话列表里
+                meta = self.index.get(conversation_id)
+                if meta is None:
+                    meta = self._set_entry(conversation_id, self._make_index_entry(conversation, None))
+                self._cache_put(conversation_id, conversation, meta['size'])
+            self.writer.submit(conversation_id, snapshot)
+
+    def _write_conversation(self, conversation_id, conversation):
+        """把对话写入文件并更新索引"""
+        self._migrate_file(conversation_id)
+        filepath = self._path(conversation_id)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.store.write(filepath, conversation)
+        meta = self._make_index_entry(conversation, os.stat(filepath))
+        with self.lock:
+            self._set_entry(conversation_id, meta)
+            if self.writer is None:
+                self._cache_put(conversation_id, conversation, meta['size'])
+        if self.recall_index is not None:
+            self.recall_index.set_source(conversation_id, meta['message_count'], [meta['mtime'], meta['size']])
+        self.save_index(force=False)
 
     def delete_conversation(self, conversation_id):
         """删除指定对话"""
-        if conversation_id in self.conversations:
-            filepath = os.path.join(self.storage_dir, f"{conversation_id}.json")
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            del self.conversations[conversation_id]
-            return True
-        return False
-    
+        dropped = self.writer.discard(conversation_id) if self.writer else False
+        with self.lock:
+            if conversation_id not in self.index:
+                return dropped
+            for filepath in [self._path(conversation_id)] + self._flat_paths(conversation_id):
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            self.unmigrated.discard(conversation_id)
+            self.store.forget(conversation_id)
+            if self.recall_index is not None:
+                self.recall_index.remove_conversation(conversation_id)
+            self._drop_entry(conversation_id)
+            cached = self.cache.pop(conversation_id, None)
+            if cached is not None:
+                self.cache_bytes -= cached[1]
+        self.save_index()
+        return True
+
     def export_to_markdown(self, conversation_id, filename):
         """导出对话到Markdown文件"""
-        if conversation_id not in self.conversations:
+        conversation = self._load_conversation(conversation_id)
+        if conversation is None:
             return False
-        
-        messages = self.conversations[conversation_id]['messages']
+
         with open(filename, 'w', encoding='utf-8') as f:
-            f.write(f"# 对话记录: {conversation_id}\n\n")
-            f.write(f"**创建时间**: {self.conversations[conversation_id]['created_at']}\n\n")
-            for msg in messages:
-                f.write(f"## {msg['role']} ({msg['timestamp']})\n\n")
-                
-                # 替换LaTeX公式标记
-                content = msg['content']
-                content = content.replace(r'\(', '$')
-                content = content.replace(r'\)', '$')
-                content = content.replace(r'\[', '$$')
-                content = content.replace(r'\]', '$$')
-                
-                f.write(f"{content}\n\n")
+            f.writelines(iter_markdown(conversation_id, conversation))
         return True
 
     def get_all_conversations(self):
         """获取所有对话列表"""
-        return sorted(self.conversations.keys(), reverse=True)
+        with self.lock:
+            return sorted(self.index.keys(), reverse=True)
+
+
+def measure_message_footprint(count=100000):
+    """对比旧的字典消息与 Message 的内存占用（字节），消息正文两者共享，不计入结果"""
+    import tracemalloc
+    contents = [f"消息内容 {i}" for i in range(count)]
+    now = time.time()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    dict_messages = [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': content,
+                      'timestamp': datetime.fromtimestamp(now + i).strftime(TIMESTAMP_FORMAT)}
+                     for i, content in enumerate(contents)]
+    dict_bytes = tracemalloc.get_traced_memory()[0] - before
+
+    before = tracemalloc.get_traced_memory()[0]
+    slot_messages = [Message('user' if i % 2 == 0 else 'assistant', content, int(now) + i)
+                     for i, content in enumerate(contents)]
+    slot_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del dict_messages, slot_messages
+    return {'count': count, 'dict_bytes': dict_bytes, 'message_bytes': slot_bytes}
+
+
+if __name__ == "__main__":
+    result = measure_message_footprint()
+    print(f"{result['count']} 条消息：字典 {result['dict_bytes'] / result['count']:.0f} 字节/条，"
+          f"Message {result['message_bytes'] / result['count']:.0f} 字节/条")
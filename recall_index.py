@@ -0,0 +1,202 @@
+"""跨对话的长期记忆检索
+
+对全部历史消息建立本地倒排索引（中日韩文本取相邻两字，其余按单词切分），用 BM25
+给消息打分。新消息在 add_message 时增量加入索引，耗时只与消息长度有关。索引可以保存为
+JSON 文件，下次启动时载入，只需重新读取此后有变化的对话。
+"""
+import heapq
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+from array import array
+from collections import Counter
+
+_TOKEN = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[0-9a-z_]+')
+
+
+def tokenize(text):
+    """把文本切分为检索词：中日韩字符串取相邻两字（只有一个字时取单字），其余取小写单词"""
+    tokens = []
+    for run in _TOKEN.findall(text.lower()):
+        if run[0] > 'z' and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def make_snippet(content, query, max_chars=200):
+    """截取消息中第一个命中检索词附近的一段文字"""
+    content = ' '.join(content.split())
+    if len(content) <= max_chars:
+        return content
+    lowered = content.lower()
+    positions = [pos for pos in (lowered.find(term) for term in set(tokenize(query))) if pos >= 0]
+    start = max(0, min(positions) - max_chars // 4) if positions else 0
+    start = min(start, len(content) - max_chars)
+    snippet = content[start:start + max_chars]
+    return ("…" if start > 0 else "") + snippet + ("…" if start + max_chars < len(content) else "")
+
+
+class RecallIndex:
+    """历史消息的 BM25 倒排索引，可在多个线程中同时增量更新和查询"""
+
+    def __init__(self, k1=1.2, b=0.75, max_postings=10000):
+        self.k1 = k1
+        self.b = b
+        # 检索词按稀有程度依次计分，累计扫描的倒排记录将超过 max_postings 时停止，
+        # 跳过的常见词区分度很低。最稀有的词总会计分，但它本身过于常见时只扫描最近的记录
+        self.max_postings = max_postings
+        self.lock = threading.Lock()
+        # 文档编号 -> (对话id, 消息序号)，文档的词数单独存放，被删除的文档词数记为 -1
+        self.docs = []
+        self.lengths = array('l')
+        # (对话id, 消息序号) -> 文档编号，同一条消息只索引一次
+        self.doc_numbers = {}
+        self.by_conversation = {}
+        # 检索词 -> (文档编号数组, 词频数组)
+        self.postings = {}
+        self.live_docs = 0
+        self.total_length = 0
+        # 对话id -> 从文件加入索引时该文件的签名，用于下次启动时判断对话是否需要重新读取
+        self.sources = {}
+
+    def add(self, conversation_id, seq, content):
+        """把一条消息加入索引，已索引过的消息会被忽略"""
+        counts = Counter(tokenize(content or ''))
+        key = (conversation_id, seq)
+        with self.lock:
+            if key in self.doc_numbers:
+                return
+            doc = len(self.docs)
+            length = sum(counts.values())
+            self.docs.append((conversation_id, seq))
+            self.lengths.append(length)
+            self.doc_numbers[key] = doc
+            self.by_conversation.setdefault(conversation_id, []).append(doc)
+            for term, tf in counts.items():
+                entry = self.postings.get(term)
+                if entry is None:
+                    entry = self.postings[term] = (array('l'), array('H'))
+                entry[0].append(doc)
+                entry[1].append(min(tf, 65535))
+            self.live_docs += 1
+            self.total_length += length
+
+    def add_conversation(self, conversation_id, messages, source=None):
+        for seq, msg in enumerate(messages):
+            self.add(conversation_id, seq, msg.get('content'))
+        if source is not None:
+            with self.lock:
+                self.sources[conversation_id] = source
+
+    def set_source(self, conversation_id, message_count, source):
+        """对话的 message_count 条消息恰好都已在索引中时，记录刚写入的对话文件的签名"""
+        with self.lock:
+            if len(self.by_conversation.get(conversation_id, ())) == message_count:
+                self.sources[conversation_id] = source
+
+    def remove_conversation(self, conversation_id):
+        """把对话的全部消息标记为已删除，倒排表中的旧记录在查询时跳过"""
+        with self.lock:
+            self.sources.pop(conversation_id, None)
+            for doc in self.by_conversation.pop(conversation_id, ()):
+                length = self.lengths[doc]
+                self.lengths[doc] = -1
+                del self.doc_numbers[self.docs[doc]]
+                self.live_docs -= 1
+                self.total_length -= length
+
+    def __len__(self):
+        return self.live_docs
+
+    def search(self, query, k=5, exclude_conversation=None):
+        """返回 BM25 得分最高的 k 条消息 [(得分, 对话id, 消息序号), ...]"""
+        terms = set(tokenize(query))
+        k1 = self.k1
+        with self.lock:
+            n = self.live_docs
+            if not terms or not n:
+                return []
+            selected = sorted((self.postings[term] for term in terms if term in self.postings),
+                              key=lambda entry: len(entry[0]))
+            # BM25 的长度归一化项 k1 * (1 - b + b * 词数 / 平均词数) 拆成常数项和词数系数
+            base = k1 * (1 - self.b)
+            per_token = k1 * self.b * n / (self.total_length or 1)
+            lengths = self.lengths
+            scores = {}
+            get = scores.get
+            scanned = 0
+            for doc_numbers, tfs in selected:
+                df = len(doc_numbers)
+                if scanned and scanned + df > self.max_postings:
+                    break
+                if df > self.max_postings:
+                    doc_numbers, tfs = doc_numbers[-self.max_postings:], tfs[-self.max_postings:]
+                scanned += len(doc_numbers)
+                weight = math.log(1 + (n - df + 0.5) / (df + 0.5)) * (k1 + 1)
+                for doc, tf in zip(doc_numbers, tfs):
+                    length = lengths[doc]
+                    if length >= 0:
+                        scores[doc] = get(doc, 0.0) + weight * tf / (tf + base + per_token * length)
+            for doc in self.by_conversation.get(exclude_conversation, ()):
+                scores.pop(doc, None)
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [(score,) + self.docs[doc] for doc, score in best]
+
+    def save(self, path):
+        """把索引写入 JSON 文件（先写临时文件再原子替换），已删除的文档不写入，其余文档重新编号"""
+        with self.lock:
+            live = [doc for doc in range(len(self.docs)) if self.lengths[doc] >= 0]
+            renumber = {doc: new for new, doc in enumerate(live)}
+            postings = {}
+            for term, (doc_numbers, tfs) in self.postings.items():
+                pairs = [(renumber[doc], tf) for doc, tf in zip(doc_numbers, tfs) if doc in renumber]
+                if pairs:
+                    postings[term] = [[doc for doc, _ in pairs], [tf for _, tf in pairs]]
+            state = {
+                'docs': [self.docs[doc] for doc in live],
+                'lengths': [self.lengths[doc] for doc in live],
+                'postings': postings,
+                'sources': dict(self.sources),
+            }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"保存检索索引失败: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load(self, path):
+        """从 save 写入的文件恢复索引，替换当前内容；文件不存在或无法解析时返回 False"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            docs = [tuple(doc) for doc in state['docs']]
+            lengths = array('l', state['lengths'])
+            postings = {term: (array('l', doc_numbers), array('H', tfs))
+                        for term, (doc_numbers, tfs) in state['postings'].items()}
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"读取检索索引失败，将重新建立: {e}")
+            return False
+        by_conversation = {}
+        for doc, (conversation_id, _) in enumerate(docs):
+            by_conversation.setdefault(conversation_id, []).append(doc)
+        with self.lock:
+            self.docs = docs
+            self.lengths = lengths
+            self.doc_numbers = {key: doc for doc, key in enumerate(docs)}
+            self.by_conversation = by_conversation
+            self.postings = postings
+            self.sources = state.get('sources', {})
+            self.live_docs = len(docs)
+            self.total_length = sum(lengths)
+        return True
@@ -0,0 +1,172 @@
+"""所有模型请求共用的限流和优先级调度
+
+请求数和估算 token 数各用一个令牌桶限制（对应服务商的 RPM / TPM 限额），额度不足时
+请求在优先级队列中等待：交互式对话优先于后台辩论，后台辩论优先于批量任务。
+调度器运行在异步客户端的事件循环上，统计信息可以从界面线程读取。
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+
+from retry_policy import LatencyTracker
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_BATCH = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "对话", PRIORITY_BACKGROUND: "后台", PRIORITY_BATCH: "批量"}
+
+
+class TokenBucket:
+    """按每分钟额度匀速补充的令牌桶，最多积累一分钟的额度"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """还需等待多少秒才有 amount 个令牌"""
+        self._refill(now)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+    def give_back(self, amount):
+        """归还多扣的令牌（amount 为负数时补扣）"""
+        self.level = min(self.capacity, self.level + amount)
+
+    def available(self):
+        self._refill(time.monotonic())
+        return max(0.0, self.level)
+
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute=120, tokens_per_minute=100000):
+        # 额度为 0 表示不限制
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # 等待队列：(优先级, 序号, future, token 数)
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.timer = None
+        self.lock = threading.Lock()
+        self.wait_times = LatencyTracker()
+        self.granted = 0
+        self.rejected_hedges = 0
+
+    @classmethod
+    def from_env(cls):
+        """从 .env 读取 API_RPM / API_TPM"""
+        return cls(int(os.getenv("API_RPM", "120")), int(os.getenv("API_TPM", "100000")))
+
+    def _clamp(self, tokens):
+        # 超过整个桶容量的请求按满桶计，否则永远无法放行
+        return min(tokens, self.tokens.capacity) if self.tokens else tokens
+
+    def _delay(self, tokens, now):
+        delay = 0.0
+        if self.requests:
+            delay = self.requests.delay(1, now)
+        if self.tokens:
+            delay = max(delay, self.tokens.delay(tokens, now))
+        return delay
+
+    def _take(self, tokens, now):
+        if self.requests:
+            self.requests.take(1, now)
+        if self.tokens:
+            self.tokens.take(tokens, now)
+        self.granted += 1
+
+    def _dispatch(self):
+        """按优先级放行队首的请求；额度不足时定时在额度恢复后再检查"""
+        self.timer = None
+        with self.lock:
+            while self.waiters:
+                _, _, future, tokens = self.waiters[0]
+                if future.done():
+                    heapq.heappop(self.waiters)
+                    continue
+                now = time.monotonic()
+                delay = self._delay(tokens, now)
+                if delay > 0:
+                    self.timer = asyncio.get_event_loop().call_later(delay, self._dispatch)
+                    return
+                heapq.heappop(self.waiters)
+                self._take(tokens, now)
+                future.set_result(None)
+
+    async def acquire(self, tokens, priority=PRIORITY_INTERACTIVE):
+        """等待直到请求数和 token 额度都足够，且没有更高优先级的请求在排队；返回实际扣除的 token 数，
+        请求结束后以它调用 settle"""
+        tokens = self._clamp(tokens)
+        future = asyncio.get_event_loop().create_future()
+        start = time.monotonic()
+        with self.lock:
+            heapq.heappush(self.waiters, (priority, next(self.sequence), future, tokens))
+        self._reschedule()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经放行但还没发出请求就被取消，归还扣除的 token
+                self.settle(tokens, 0)
+            # 排在队首的请求被取消后，后面的请求可能已经可以放行
+            self._reschedule()
+            raise
+        with self.lock:
+            self.wait_times.add(time.monotonic() - start)
+        return tokens
+
+    def _reschedule(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self._dispatch()
+
+    def try_acquire(self, tokens, priority=PRIORITY_INTERACTIVE):
+        """不等待地申请额度（用于对冲请求），返回扣除的 token 数；有同级或更高优先级的请求在排队
+        或额度不足时放弃，返回 None"""
+        tokens = self._clamp(tokens)
+        with self.lock:
+            if any(p <= priority and not f.done() for p, _, f, _ in self.waiters):
+                self.rejected_hedges += 1
+                return None
+            now = time.monotonic()
+            if self._delay(tokens, now) > 0:
+                self.rejected_hedges += 1
+                return None
+            self._take(tokens, now)
+            return tokens
+
+    def settle(self, charged, actual):
+        """请求结束后按实际 token 数修正预扣的额度"""
+        if self.tokens:
+            with self.lock:
+                self.tokens.give_back(charged - actual)
+
+    def stats(self):
+        """返回排队数量（按优先级）、排队等待耗时和剩余额度"""
+        with self.lock:
+            queued = {}
+            for priority, _, future, _ in self.waiters:
+                if not future.done():
+                    queued[priority] = queued.get(priority, 0) + 1
+            return {
+                'queued': sum(queued.values()),
+                'queued_by_priority': {PRIORITY_NAMES.get(p, p): n for p, n in sorted(queued.items())},
+                'wait_p50_ms': (self.wait_times.percentile(50) or 0.0) * 1000,
+                'wait_p95_ms': (self.wait_times.percentile(95) or 0.0) * 1000,
+                'granted': self.granted,
+                'requests_available': self.requests.available() if self.requests else None,
+                'tokens_available': self.tokens.available() if self.tokens else None,
+            }
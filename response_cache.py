@@ -0,0 +1,156 @@
+"""低温度请求的回答缓存
+
+以 (模型, 规范化后的消息, 温度) 为键，最近使用的回答保存在内存 LRU 中，全部回答
+持久化到 SQLite 文件；超过有效期的回答不再使用，磁盘缓存超出大小上限时淘汰最久
+未使用的回答。
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used);
+"""
+
+
+def make_cache_key(model, messages, temperature):
+    """生成缓存键：统一换行符并去掉每条消息首尾的空白，温度保留两位小数"""
+    normalized = [(msg['role'], msg['content'].replace('\r\n', '\n').strip()) for msg in messages]
+    payload = json.dumps([model, normalized, round(temperature, 2)], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def iter_replay(response, stop_event=None, chunk_size=32):
+    """把缓存的回答按数据块逐段输出，页面可以和真实的流式输出一样处理"""
+    for start in range(0, len(response), chunk_size):
+        if stop_event and stop_event.is_set():
+            return
+        yield response[start:start + chunk_size]
+
+
+class ResponseCache:
+    def __init__(self, path="response_cache.db", max_memory_entries=256, max_disk_bytes=64 * 1024 * 1024,
+                 ttl=7 * 24 * 3600):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # 键 -> (回答, 写入时间, 最近使用时间)；内存命中只更新这里的使用时间，条目离开内存、
+        # 磁盘淘汰之前和关闭时才写回 SQLite，热门回答不会因磁盘上的旧时间被淘汰
+        self.memory = OrderedDict()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.disk_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _remember(self, key, response, created, used):
+        self.memory[key] = (response, created, used)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            evicted, (_, _, evicted_used) = self.memory.popitem(last=False)
+            self._touch([(evicted_used, evicted)])
+
+    def _touch(self, rows):
+        """把 [(最近使用时间, 键), ...] 写回磁盘"""
+        with self.conn:
+            self.conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?", rows)
+
+    def _flush_last_used(self):
+        self._touch([(used, key) for key, (_, _, used) in self.memory.items()])
+
+    def get(self, key):
+        """返回未过期的缓存回答，没有时返回 None"""
+        return self.lookup([key])[1]
+
+    def lookup(self, keys):
+        """依次查找 keys，返回 (命中的键, 回答)，都未命中时返回 (None, None)；一次查找只计一次命中或未命中"""
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                entry = self.memory.get(key)
+                if entry is not None and now - entry[1] < self.ttl:
+                    self._remember(key, entry[0], entry[1], now)
+                    self.memory_hits += 1
+                    return key, entry[0]
+                row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] < self.ttl:
+                    self._remember(key, row[0], row[1], now)
+                    self._touch([(now, key)])
+                    self.disk_hits += 1
+                    return key, row[0]
+                if row is not None:
+                    self._delete(key)
+                self.memory.pop(key, None)
+            self.misses += 1
+            return None, None
+
+    def put(self, key, response):
+        """保存一个完整的回答，磁盘缓存超出上限时淘汰最久未使用的回答"""
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            self._delete(key)
+            with self.conn:
+                self.conn.execute("INSERT INTO responses (key, response, created, last_used, size) "
+                                  "VALUES (?, ?, ?, ?, ?)", (key, response, now, now, size))
+            self.disk_bytes += size
+            self._remember(key, response, now, now)
+            self.stores += 1
+            if self.disk_bytes > self.max_disk_bytes:
+                self._flush_last_used()
+            while self.disk_bytes > self.max_disk_bytes:
+                row = self.conn.execute("SELECT key FROM responses ORDER BY last_used LIMIT 1").fetchone()
+                if row is None or row[0] == key:
+                    break
+                self._delete(row[0])
+                self.memory.pop(row[0], None)
+                self.evictions += 1
+
+    def _delete(self, key):
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            with self.conn:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.disk_bytes -= row[0]
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+            self.memory.clear()
+            self.disk_bytes = 0
+
+    def stats(self):
+        """返回命中、未命中和占用空间的统计"""
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'memory_entries': len(self.memory),
+                'disk_bytes': self.disk_bytes,
+            }
+
+    def close(self):
+        with self.lock:
+            self._flush_last_used()
+            self.conn.close()
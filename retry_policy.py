@@ -0,0 +1,94 @@
+"""流式请求的重试、退避、首字超时和对冲设置
+
+只在收到第一个内容块之前重试：429、5xx、连接错误和首字超时都可以安全地重新请求，
+已经输出给用户的内容无法撤回，之后的错误直接结束本次回答。
+"""
+import math
+import os
+import random
+from collections import deque
+
+from openai import APIConnectionError
+
+# 除 5xx 外可以重试的状态码
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class FirstTokenTimeout(Exception):
+    """在首字超时时间内没有收到任何内容"""
+
+
+class StreamStalled(Exception):
+    """输出过程中超过停顿超时时间没有收到新内容"""
+
+
+def is_retryable(exc):
+    if isinstance(exc, (FirstTokenTimeout, APIConnectionError)):
+        return True
+    status = getattr(exc, 'status_code', None)
+    return status is not None and (status in RETRYABLE_STATUS or status >= 500)
+
+
+def retry_after(exc):
+    """读取服务端在 Retry-After 中建议的等待秒数，没有时返回 None"""
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    try:
+        return max(0.0, float(response.headers.get('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=8.0, ttft_timeout=30.0, stall_timeout=30.0,
+                 hedge=False, hedge_percentile=95, hedge_min_samples=20):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.ttft_timeout = ttft_timeout
+        self.stall_timeout = stall_timeout
+        # 对冲：首字等待时间超过近期首字耗时的该百分位数时，再发一个相同的请求，取先返回的一个
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+    @classmethod
+    def from_env(cls):
+        """从 .env 读取设置"""
+        return cls(
+            max_retries=int(os.getenv("API_MAX_RETRIES", "3")),
+            base_delay=float(os.getenv("API_RETRY_BASE_DELAY", "0.5")),
+            max_delay=float(os.getenv("API_RETRY_MAX_DELAY", "8")),
+            ttft_timeout=float(os.getenv("API_TTFT_TIMEOUT", "30")),
+            stall_timeout=float(os.getenv("API_STALL_TIMEOUT", "30")),
+            hedge=os.getenv("API_HEDGE", "0") == "1",
+            hedge_percentile=float(os.getenv("API_HEDGE_PERCENTILE", "95")),
+        )
+
+    def backoff(self, attempt, exc=None):
+        """第 attempt 次重试前的等待秒数：指数退避加全抖动，服务端给出 Retry-After 时以其为准"""
+        hint = retry_after(exc)
+        if hint is not None:
+            return min(hint, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class LatencyTracker:
+    """保存最近若干次耗时，用于计算百分位数"""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, p):
+        """返回第 p 百分位的耗时（最近邻法），没有样本时返回 None"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
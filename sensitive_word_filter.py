@@ -1,13 +1,424 @@
 import json
 import os
+import tempfile
+import threading
+import unicodedata
+from collections import deque
+
+# 常用繁体字到简体字的对照，可通过 char_variants.json 补充
+TRADITIONAL_CHARS = (
+    "學國這個們來時說為會對於與後從開關門問間東車長發現愛歡見聽話語讀寫書買賣錢銀貨實義黨軍戰殺槍彈藥賭"
+    "穢傷亂體頭臉腦媽幹讓認識還進過運動氣電網視圖聲帶處點麼樣機無萬億雙兩邊號據獨罵騙詐偽謊黃飛鳥魚馬龍"
+    "雞豬貓鬥麗蘭華劉陳張楊趙錯盡擊滅贏輸獄審權憲選舉衛嚴廣場廠產歲憂鬱殘惡屍癡瘋髒糞雜種蟲醫療澀傳價優"
+    "務隊階陽陰險靈鐵鋼錄鏈鍵韓順顏題願類顯風飯館驗鬧"
+)
+SIMPLIFIED_CHARS = (
+    "学国这个们来时说为会对于与后从开关门问间东车长发现爱欢见听话语读写书买卖钱银货实义党军战杀枪弹药赌"
+    "秽伤乱体头脸脑妈干让认识还进过运动气电网视图声带处点么样机无万亿双两边号据独骂骗诈伪谎黄飞鸟鱼马龙"
+    "鸡猪猫斗丽兰华刘陈张杨赵错尽击灭赢输狱审权宪选举卫严广场厂产岁忧郁残恶尸痴疯脏粪杂种虫医疗涩传价优"
+    "务队阶阳阴险灵铁钢录链键韩顺颜题愿类显风饭馆验闹"
+)
+# 归一化后小于该字符的有效字符视为拉丁字母或数字：它们之间的空白是单词边界，不能跳过
+LATIN_END = '\u0250'
+# 句末标点是句子边界，匹配不跨越它们
+SENTENCE_BREAKS = frozenset("。｡！？；…!?;")
+
+
+class CharFoldTable(dict):
+    """字符归一化表：全角转半角、大写转小写、繁体转简体，空白和标点映射为空串（匹配时跳过）
+
+    跳过有两个例外：拉丁字母或数字之间的空白按一个空格匹配（"was sent" 不会命中 "ass"），
+    句末标点处重新开始匹配（"特色。情况" 不会命中 "色情"）。
+
+    表项在第一次遇到某个字符时计算并缓存，之后每个字符只需一次字典查找。
+    """
+
+    def __init__(self, variants=None):
+        super().__init__()
+        self.variants = dict(zip(TRADITIONAL_CHARS, SIMPLIFIED_CHARS))
+        if variants:
+            self.variants.update(variants)
+
+    def __missing__(self, ch):
+        folded = unicodedata.normalize('NFKC', ch)
+        if len(folded) != 1:
+            folded = ch
+        if folded.isspace() or unicodedata.category(folded)[0] in 'PSC':
+            folded = ''
+        else:
+            folded = folded.lower()
+            if len(folded) != 1:
+                folded = ch
+            folded = self.variants.get(folded, folded)
+        self[ch] = folded
+        return folded
+
+    def fold(self, word):
+        """返回敏感词归一化后的结果，拉丁字母或数字之间的空白保留为一个空格"""
+        chars = []
+        spaced = False
+        for raw in word:
+            ch = self[raw]
+            if not ch:
+                spaced = spaced or raw.isspace()
+                continue
+            if spaced and chars and chars[-1] < LATIN_END and ch < LATIN_END:
+                chars.append(' ')
+            spaced = False
+            chars.append(ch)
+        return ''.join(chars)
+
+
+class AhoCorasickAutomaton:
+    """敏感词多模式匹配自动机（Aho-Corasick），一次线性扫描即可找出所有命中
+
+    敏感词和待扫描文本都经过同一张 CharFoldTable 归一化，命中区间仍以原文下标表示。
+    """
+
+    # 两个有效字符之间最多允许插入的被跳过字符数，超过则视为不相连
+    max_gap = 4
+
+    def __init__(self, words=(), fold=None):
+        self.fold = fold if fold is not None else CharFoldTable()
+        # 每个节点的转移表、失败指针、节点深度、以该节点结尾的敏感词长度、沿失败链可命中的最长敏感词长度
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.term = [0]
+        # 归一化后落在该节点结尾的敏感词个数，多个词（如 abc 与 ABC）可能共用同一个词尾
+        self.count = [0]
+        self.out = [0]
+        # 流式过滤时需要扣留的后缀长度：沿失败链最深的、仍可继续扩展的节点深度
+        self.hold = [0]
+        # 失败树：节点 -> 失败指针指向它的节点集合；增量修改时沿它找出需要重算的节点
+        self.fail_children = {}
+        # 字符 -> 经由该字符进入的节点，新增单字前缀时据此找出失败指针需要改指的节点
+        self.edge_nodes = {}
+        # 已删除但仍留在字典树中的敏感词数量，过多时由调用方整体重建
+        self.removed_count = 0
+        # 增量修改与扫描互斥，保证其他线程不会读到半更新的失败指针
+        self.lock = threading.Lock()
+        for word in words:
+            self.insert(word)
+        self.build()
+
+    def insert(self, word, new_nodes=None, touched=None):
+        """把敏感词插入字典树（插入后需调用 build 重新计算失败指针），归一化后为空的词无法匹配，返回 False
+
+        new_nodes 不为 None 时记录新建的节点 (节点, 父节点, 字符)，touched 记录词尾标记或转移表有变化的已有节点。
+        """
+        word = self.fold.fold(word)
+        if not word:
+            return False
+        goto = self.goto
+        node = 0
+        for ch in word:
+            nxt = goto[node].get(ch)
+            if nxt is None:
+                if touched is not None and node and not goto[node]:
+                    # 叶子节点有了子节点，扣留长度随之变化
+                    touched.add(node)
+                nxt = len(goto)
+                goto[node][ch] = nxt
+                goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[node] + 1)
+                self.term.append(0)
+                self.count.append(0)
+                self.out.append(0)
+                self.hold.append(0)
+                self.edge_nodes.setdefault(ch, []).append(nxt)
+                if new_nodes is not None:
+                    new_nodes.append((nxt, node, ch))
+            node = nxt
+        if touched is not None and not self.term[node]:
+            touched.add(node)
+        self.term[node] = len(word)
+        self.count[node] += 1
+        return True
+
+    def build(self):
+        """按广度优先顺序计算失败指针和输出长度"""
+        goto, fail, term, out = self.goto, self.fail, self.term, self.out
+        depth, hold = self.depth, self.hold
+        fail_children = {}
+        queue = deque()
+        for child in goto[0].values():
+            fail[child] = 0
+            out[child] = term[child]
+            hold[child] = depth[child] if goto[child] else 0
+            fail_children.setdefault(0, set()).add(child)
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for ch, child in goto[node].items():
+                state = fail[node]
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(ch, 0)
+                out[child] = max(term[child], out[fail[child]])
+                hold[child] = depth[child] if goto[child] else hold[fail[child]]
+                fail_children.setdefault(fail[child], set()).add(child)
+                queue.append(child)
+        self.fail_children = fail_children
+
+    def _set_fail(self, node, target):
+        old = self.fail[node]
+        if old in self.fail_children:
+            self.fail_children[old].discard(node)
+        self.fail[node] = target
+        self.fail_children.setdefault(target, set()).add(node)
+
+    def _fail_subtree(self, node):
+        """失败指针直接或间接指向 node 的全部节点，即以 node 对应字符串为后缀的节点"""
+        fail_children = self.fail_children
+        stack = list(fail_children.get(node, ()))
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(fail_children.get(node, ()))
+
+    def _refresh(self, roots):
+        """按失败树自上而下重算 roots 及其失败子树中各节点的输出长度和扣留长度"""
+        goto, fail, term, out, depth, hold = self.goto, self.fail, self.term, self.out, self.depth, self.hold
+        fail_children = self.fail_children
+        visited = set()
+        # 先处理浅的节点，深的节点若在其失败子树中会一并算好
+        for root in sorted(roots, key=depth.__getitem__):
+            if root in visited:
+                continue
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                visited.add(node)
+                target = fail[node]
+                out[node] = max(term[node], out[target])
+                hold[node] = depth[node] if goto[node] else hold[target]
+                stack.extend(fail_children.get(node, ()))
+
+    def add_words(self, words):
+        """批量增量添加敏感词
+
+        只为新建的节点计算失败指针，并把以新节点为后缀、原失败指针更短的已有节点改指向新节点，
+        然后只重算这些节点及其失败子树的输出长度，不重新遍历整棵字典树。
+        """
+        with self.lock:
+            goto, fail, depth = self.goto, self.fail, self.depth
+            new_nodes = []
+            touched = set()
+            for word in words:
+                self.insert(word, new_nodes, touched)
+            created = {node for node, _, _ in new_nodes}
+            relinked = set()
+            # 按深度顺序处理，计算新节点的失败指针时更浅的节点都已就绪
+            for node, parent, ch in sorted(new_nodes, key=lambda entry: depth[entry[0]]):
+                if parent == 0:
+                    target = 0
+                else:
+                    state = fail[parent]
+                    while state and ch not in goto[state]:
+                        state = fail[state]
+                    target = goto[state].get(ch, 0)
+                self._set_fail(node, target)
+                # 以新节点为后缀的已有节点：父节点以 parent 为后缀、且经由同一字符进入
+                if parent == 0:
+                    candidates = self.edge_nodes[ch]
+                else:
+                    candidates = [goto[x].get(ch) for x in self._fail_subtree(parent)]
+                for other in candidates:
+                    if other is None or other in created:
+                        continue
+                    if depth[fail[other]] < depth[node]:
+                        self._set_fail(other, node)
+                        relinked.add(other)
+            self._refresh(created | touched | relinked)
+
+    def remove_words(self, words):
+        """批量增量删除敏感词：字典树结构不变，词尾不再被其他词共用时才清除标记，然后重算受影响节点的输出长度"""
+        with self.lock:
+            goto, term, count = self.goto, self.term, self.count
+            cleared = set()
+            for word in words:
+                node = 0
+                for ch in self.fold.fold(word):
+                    node = goto[node].get(ch)
+                    if node is None:
+                        break
+                if node and count[node]:
+                    count[node] -= 1
+                    if not count[node]:
+                        term[node] = 0
+                        cleared.add(node)
+                        self.removed_count += 1
+            self._refresh(cleared)
+
+    def step(self, state, ch):
+        """从 state 读入一个字符后的新状态"""
+        goto, fail = self.goto, self.fail
+        while True:
+            nxt = goto[state].get(ch)
+            if nxt is not None:
+                return nxt
+            if state == 0:
+                return 0
+            state = fail[state]
+
+    def find_spans(self, text):
+        """返回文本中所有命中区间 [(start, end), ...]，重叠区间已合并"""
+        with self.lock:
+            return self._find_spans(text)
+
+    def _find_spans(self, text):
+        goto, fail, out, fold, max_gap = self.goto, self.fail, self.out, self.fold, self.max_gap
+        spans = []
+        # 每个有效（未被跳过）字符在原文中的下标，用于把命中映射回原文区间
+        positions = []
+        state = 0
+        gap = 0
+        # 当前跳过的字符中第一个空白的下标，上一个有效字符是否为拉丁字母或数字
+        space_at = -1
+        latin = False
+        for i, raw in enumerate(text):
+            ch = fold[raw]
+            if not ch:
+                gap += 1
+                if gap > max_gap or raw in SENTENCE_BREAKS:
+                    state = 0
+                elif space_at < 0 and raw.isspace():
+                    space_at = i
+                continue
+            was_latin, latin = latin, ch < LATIN_END
+            if gap:
+                if space_at >= 0 and latin and was_latin:
+                    # 拉丁字母之间的空白按一个空格匹配；敏感词不以空格结尾，这一步不会命中
+                    state = self.step(state, ' ')
+                    positions.append(space_at)
+                gap = 0
+                space_at = -1
+            positions.append(i)
+            while True:
+                nxt = goto[state].get(ch)
+                if nxt is not None:
+                    state = nxt
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            length = out[state]
+            if length:
+                start = positions[-length]
+                # 新区间可能覆盖之前的多个区间，需全部合并
+                while spans and start <= spans[-1][1]:
+                    start = min(start, spans.pop()[0])
+                spans.append((start, i + 1))
+        return spans
+
+
+def mask_spans(text, spans, mask_char='*'):
+    """把命中区间内的字符替换为掩码字符"""
+    if not spans:
+        return text
+    parts = []
+    last = 0
+    for start, end in spans:
+        parts.append(text[last:start])
+        parts.append(mask_char * (end - start))
+        last = end
+    parts.append(text[last:])
+    return ''.join(parts)
+
+
+class StreamFilterSession:
+    """流式过滤会话：跨数据块保存自动机状态，捕获被切分在两个数据块之间的敏感词"""
+
+    def __init__(self, automaton, mask_char='*'):
+        self.automaton = automaton
+        self.mask_char = mask_char
+        self.state = 0
+        self.gap = 0
+        # 跳过的字符中第一个空白在 pending 中的下标，上一个有效字符是否为拉丁字母或数字
+        self.space_at = -1
+        self.latin = False
+        # 尚未输出的尾部原文字符，其中有效字符不超过最长敏感词长度减一
+        self.pending = []
+        # pending 中有效字符的下标
+        self.positions = []
+
+    def feed(self, chunk):
+        """输入一个数据块，返回可以安全显示的文本和本块是否命中敏感词"""
+        automaton = self.automaton
+        out, hold, fold, max_gap = automaton.out, automaton.hold, automaton.fold, automaton.max_gap
+        buf = self.pending
+        positions = self.positions
+        base = len(buf)
+        buf.extend(chunk)
+        state = self.state
+        gap = self.gap
+        space_at = self.space_at
+        latin = self.latin
+        contains_sensitive = False
+        with automaton.lock:
+            for i, raw in enumerate(chunk, base):
+                ch = fold[raw]
+                if not ch:
+                    gap += 1
+                    if gap > max_gap or raw in SENTENCE_BREAKS:
+                        state = 0
+                    elif space_at < 0 and raw.isspace():
+                        space_at = i
+                    continue
+                was_latin, latin = latin, ch < LATIN_END
+                if gap:
+                    if space_at >= 0 and latin and was_latin:
+                        state = automaton.step(state, ' ')
+                        positions.append(space_at)
+                    gap = 0
+                    space_at = -1
+                positions.append(i)
+                state = automaton.step(state, ch)
+                length = out[state]
+                if length:
+                    contains_sensitive = True
+                    for k in range(positions[-length], i + 1):
+                        buf[k] = self.mask_char
+            # 只扣留仍可能构成敏感词前缀的最短后缀
+            keep = hold[state]
+        self.state = state
+        self.gap = gap
+        self.latin = latin
+        emit_len = positions[-keep] if keep else len(buf)
+        # 已输出的空白不会再被用到：没有扣留的字符时当前状态不可能继续匹配
+        self.space_at = space_at - emit_len if space_at >= emit_len else -1
+        safe_text = ''.join(buf[:emit_len])
+        self.pending = buf[emit_len:]
+        self.positions = [p - emit_len for p in positions[-keep:]] if keep else []
+        return safe_text, contains_sensitive
+
+    def flush(self):
+        """输出流结束（或被终止）时取出剩余的扣留文本"""
+        text = ''.join(self.pending)
+        self.pending = []
+        self.positions = []
+        self.state = 0
+        self.gap = 0
+        self.space_at = -1
+        self.latin = False
+        return text
+
 
 class SensitiveWordFilter:
     """敏感词过滤类，负责加载、管理和过滤敏感词"""
-    
-    def __init__(self, file_path="sensitive_words.json"):
+
+    def __init__(self, file_path="sensitive_words.json", variants_path="char_variants.json"):
         self.file_path = file_path
+        self.variants_path = variants_path
         self.sensitive_words = self.load_sensitive_words()
-        
+        # 字符归一化表只构建一次，所有自动机共享
+        self.fold_table = CharFoldTable(self.load_char_variants())
+        # 集合索引，成员判断为 O(1)；列表保留插入顺序供界面显示和持久化
+        self.word_index = set(self.sensitive_words)
+        self.rebuild_automaton()
+
     def load_sensitive_words(self):
         """从文件加载敏感词库"""
         try:
@@ -19,39 +430,124 @@ class SensitiveWordFilter:
         except Exception as e:
             print(f"加载敏感词库失败: {e}")
             return []
-            
+
+    def load_char_variants(self):
+        """从文件加载额外的异体字对照表（{"異體字": "标准字", ...}）"""
+        try:
+            if os.path.exists(self.variants_path):
+                with open(self.variants_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"加载异体字对照表失败: {e}")
+        return {}
+
+    def rebuild_automaton(self):
+        """根据当前敏感词库重新编译匹配自动机"""
+        # 整体替换引用，正在其他线程中扫描的调用仍使用旧自动机；词库文件中重复的词只计一次
+        self.automaton = AhoCorasickAutomaton(dict.fromkeys(self.sensitive_words), self.fold_table)
+
+    def is_matchable(self, word):
+        """敏感词归一化后不为空才能匹配；只由空白和标点组成的词会被全部跳过"""
+        return bool(self.fold_table.fold(word))
+
     def save_sensitive_words(self):
-        """保存敏感词库到文件"""
+        """保存敏感词库到文件（先写临时文件再原子替换，避免写到一半损坏词库）"""
+        tmp_path = None
         try:
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.sensitive_words, f, ensure_ascii=False, indent=2)
+            directory = os.path.dirname(os.path.abspath(self.file_path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.sensitive_words_', suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.sensitive_words, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.file_path)
         except Exception as e:
             print(f"保存敏感词库失败: {e}")
-            
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def add_sensitive_words(self, words):
+        """批量添加敏感词，整批只增量更新一次自动机、写一次文件，返回实际新增的数量
+
+        已存在的词和无法匹配的词（见 is_matchable）不会加入。
+        """
+        added = []
+        for word in words:
+            if word and word not in self.word_index and self.is_matchable(word):
+                self.word_index.add(word)
+                added.append(word)
+        if added:
+            self.sensitive_words.extend(added)
+            self.automaton.add_words(added)
+            self.save_sensitive_words()
+        return len(added)
+
+    def remove_sensitive_words(self, words):
+        """批量移除敏感词，整批只增量更新一次自动机、写一次文件，返回实际移除的数量"""
+        removed = set()
+        for word in words:
+            if word in self.word_index:
+                self.word_index.discard(word)
+                removed.add(word)
+        if removed:
+            self.sensitive_words = [w for w in self.sensitive_words if w not in removed]
+            self.automaton.remove_words(removed)
+            # 残留的无效节点多于有效敏感词时整体重建，回收字典树空间
+            if self.automaton.removed_count > len(self.sensitive_words):
+                self.rebuild_automaton()
+            self.save_sensitive_words()
+        return len(removed)
+
     def add_sensitive_word(self, word):
         """添加敏感词"""
-        if word and word not in self.sensitive_words:
-            self.sensitive_words.append(word)
-            self.save_sensitive_words()
-            return True
-        return False
-        
+        return self.add_sensitive_words([word]) == 1
+
     def remove_sensitive_word(self, word):
         """移除敏感词"""
-        if word in self.sensitive_words:
-            self.sensitive_words.remove(word)
-            self.save_sensitive_words()
-            return True
-        return False
-        
+        return self.remove_sensitive_words([word]) == 1
+
     def filter_text(self, text):
         """过滤文本中的敏感词，返回过滤后的文本和是否包含敏感词的标志"""
-        contains_sensitive = False
-        filtered_text = text
-        
-        for word in self.sensitive_words:
-            if word in filtered_text:
-                contains_sensitive = True
-                filtered_text = filtered_text.replace(word, '*' * len(word))
-                
-        return filtered_text, contains_sensitive    
\ No newline at end of file
+        spans = self.automaton.find_spans(text)
+        if not spans:
+            return text, False
+        return mask_spans(text, spans), True
+
+    def start_stream(self):
+        """为一次流式输出创建过滤会话"""
+        return StreamFilterSession(self.automaton)
+
+
+# 单词和句子边界的回归用例：(敏感词, 文本, 期望的过滤结果)
+BOUNDARY_CASES = (
+    ("ass", "was sent", "was sent"),
+    ("ass", "a s s", "a s s"),
+    ("ass", "A-S-S", "*****"),
+    ("ass", "ＡＳＳ", "***"),
+    ("fuck you", "fuck   you", "**********"),
+    ("fuck you", "fuckyou", "fuckyou"),
+    ("色情", "特色。情况", "特色。情况"),
+    ("色情", "特色！情况", "特色！情况"),
+    ("色情", "色 情", "***"),
+    ("色情", "色*情", "***"),
+    ("色情", "色, 情", "****"),
+    ("AV女优", "AV 女优", "*****"),
+)
+
+
+def check_word_boundaries(cases=BOUNDARY_CASES):
+    """整段过滤和逐字流式过滤都按 cases 检查，返回不符合期望的用例 [(敏感词, 文本, 整段结果, 流式结果), ...]"""
+    failures = []
+    for word, text, expected in cases:
+        automaton = AhoCorasickAutomaton([word])
+        whole = mask_spans(text, automaton.find_spans(text))
+        session = StreamFilterSession(automaton)
+        streamed = ''.join(session.feed(ch)[0] for ch in text) + session.flush()
+        if whole != expected or streamed != expected:
+            failures.append((word, text, whole, streamed))
+    return failures
+
+
+if __name__ == "__main__":
+    failed = check_word_boundaries()
+    for word, text, whole, streamed in failed:
+        print(f"敏感词 {word!r} 过滤 {text!r}: 整段结果 {whole!r}，流式结果 {streamed!r}")
+    print(f"边界用例 {len(BOUNDARY_CASES) - len(failed)}/{len(BOUNDARY_CASES)} 通过")
@@ -0,0 +1,251 @@
+"""基于 SQLite 的对话存储（可选）
+
+对话和消息分表保存，数据库使用 WAL 模式；消息内容同时写入 FTS5 全文索引，
+提供 search(query, limit) 按相关度返回带高亮片段的结果。
+
+从旧的 conversations/*.json(l) 一次性迁移:
+    python sqlite_memory.py migrate [--storage-dir conversations] [--db conversations.db]
+"""
+import argparse
+import os
+import re
+import sqlite3
+
+from memory import ConversationMemory, Message, iter_conversation_files, store_for_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    created_at TEXT,
+    title TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT,
+    content TEXT,
+    timestamp TEXT,
+    UNIQUE (conversation_id, seq)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body);
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    DELETE FROM messages_fts WHERE rowid = old.id;
+END;
+"""
+
+# 中日韩字符逐字切分后再交给 FTS5 的 unicode61 分词器，这样两个字的词也能检索。
+# 切分用不可见分隔符 U+2063，生成搜索片段时可以原样去掉，不影响原文中的空格
+_CJK_CHAR = re.compile('([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff])')
+_SEGMENT_SEP = '\u2063'
+
+
+def segment_text(text):
+    """在每个中日韩字符两侧加分隔符，供全文索引使用"""
+    return _CJK_CHAR.sub(_SEGMENT_SEP + r'\1' + _SEGMENT_SEP, text)
+
+
+def build_match_query(query):
+    """把用户输入转换为 FTS5 查询：每个空白分隔的词作为一个短语，词之间为 AND 关系"""
+    phrases = []
+    for term in query.split():
+        words = segment_text(term).replace(_SEGMENT_SEP, ' ').split()
+        if words:
+            phrases.append('"' + ' '.join(words).replace('"', '""') + '"')
+    return ' '.join(phrases)
+
+
+def _title_of(messages):
+    return next((msg['content'] for msg in messages if msg.get('role') == 'user'), '')[:30]
+
+
+def _insert_messages(conn, conversation_id, messages, start):
+    rows = [(conversation_id, seq, msg.get('role'), msg.get('content', ''), msg.get('timestamp'))
+            for seq, msg in enumerate(messages[start:], start)]
+    for row in rows:
+        cursor = conn.execute(
+            "INSERT INTO messages (conversation_id, seq, role, content, timestamp) VALUES (?, ?, ?, ?, ?)", row)
+        conn.execute("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+                     (cursor.lastrowid, segment_text(row[3] or '')))
+
+
+def _upsert_conversation(conn, conversation):
+    messages = conversation['messages']
+    conn.execute(
+        "INSERT INTO conversations (id, created_at, title, message_count) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET title = excluded.title, message_count = excluded.message_count",
+        (conversation['id'], conversation.get('created_at', ''), _title_of(messages), len(messages)))
+
+
+def open_database(db_path):
+    """打开（必要时创建）对话数据库，启用 WAL 模式"""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class SQLiteConversationMemory(ConversationMemory):
+    """与 ConversationMemory 接口相同，但把对话保存在 SQLite 数据库中，并支持全文搜索"""
+
+    def __init__(self, db_path="conversations.db", max_cache_bytes=32 * 1024 * 1024, recall_index=None):
+        self.db_path = db_path
+        # 界面线程和流式输出线程都会访问同一个连接，由基类创建的 self.lock 保护
+        self.conn = open_database(db_path)
+        # 对话id -> 数据库中已保存的消息条数
+        self.persisted = {}
+        super().__init__(storage_dir=os.path.dirname(os.path.abspath(db_path)), max_cache_bytes=max_cache_bytes,
+                         recall_index=recall_index)
+
+    def load_conversations(self):
+        """从数据库读取对话列表（不读取消息正文）"""
+        self.index = {}
+        self.cache.clear()
+        self.cache_bytes = 0
+        with self.lock:
+            rows = self.conn.execute("SELECT id, created_at, title, message_count FROM conversations").fetchall()
+        for conversation_id, created_at, title, message_count in rows:
+            self.index[conversation_id] = {'created_at': created_at, 'title': title,
+                                           'message_count': message_count}
+            self.persisted[conversation_id] = message_count
+
+    def save_index(self, force=True):
+        pass
+
+    def close(self):
+        self.closing.set()
+        if self.recall_thread:
+            self.recall_thread.join()
+        with self.lock:
+            self.conn.close()
+
+    def _load_conversation(self, conversation_id, cache=True):
+        cached = self.cache.get(conversation_id)
+        if cached is not None:
+            self.cache.move_to_end(conversation_id)
+            return cached[0]
+        meta = self.index.get(conversation_id)
+        if meta is None:
+            return None
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT role, content, timestamp FROM messages WHERE conversation_id = ? ORDER BY seq",
+                (conversation_id,)).fetchall()
+        messages = [Message.from_dict({'role': role, 'content': content, 'timestamp': timestamp})
+                    for role, content, timestamp in rows]
+        data = {'id': conversation_id, 'created_at': meta['created_at'], 'messages': messages}
+        if cache:
+            self._cache_put(conversation_id, data, sum(len(content or '') for _, content, _ in rows))
+        return data
+
+    def save_conversation(self):
+        """保存当前对话，只插入尚未写入数据库的新消息"""
+        if not self.current_conversation:
+            return
+        conversation = self.current_conversation
+        conversation_id = conversation['id']
+        messages = conversation['messages']
+        with self.lock, self.conn:
+            start = self.persisted.get(conversation_id, 0)
+            if start > len(messages):
+                self.conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                start = 0
+            _upsert_conversation(self.conn, conversation)
+            _insert_messages(self.conn, conversation_id, messages, start)
+        self.persisted[conversation_id] = len(messages)
+        self.index[conversation_id] = {'created_at': conversation.get('created_at', ''),
+                                       'title': _title_of(messages), 'message_count': len(messages)}
+        self._cache_put(conversation_id, conversation, sum(len(msg.get('content') or '') for msg in messages))
+
+    def delete_conversation(self, conversation_id):
+        """删除指定对话"""
+        if conversation_id not in self.index:
+            return False
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self.conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+        del self.index[conversation_id]
+        self.persisted.pop(conversation_id, None)
+        cached = self.cache.pop(conversation_id, None)
+        if cached is not None:
+            self.cache_bytes -= cached[1]
+        return True
+
+    def search(self, query, limit=20):
+        """全文搜索所有对话，按 BM25 相关度返回 [{conversation_id, index, role, snippet, score}, ...]"""
+        match = build_match_query(query)
+        if not match:
+            return []
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT m.conversation_id, m.seq, m.role, "
+                "snippet(messages_fts, 0, '[', ']', '…', 24), bm25(messages_fts) AS score "
+                "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH ? ORDER BY score LIMIT ?",
+                (match, limit)).fetchall()
+        return [{'conversation_id': conversation_id, 'index': seq, 'role': role,
+                 'snippet': snippet.replace(_SEGMENT_SEP, ''), 'score': -score}
+                for conversation_id, seq, role, snippet, score in rows]
+
+
+def migrate_from_files(storage_dir="conversations", db_path="conversations.db", batch_size=500):
+    """把 storage_dir 下的 JSON / JSONL 对话文件一次性导入数据库，已存在的对话会跳过，返回导入数量"""
+    conn = open_database(db_path)
+    existing = {row[0] for row in conn.execute("SELECT id FROM conversations")}
+    imported = 0
+    pending = 0
+    try:
+        conn.execute("BEGIN")
+        for path in iter_conversation_files(storage_dir):
+            try:
+                data = store_for_path(path).read(path)
+            except Exception as e:
+                print(f"读取对话文件 {os.path.basename(path)} 失败: {e}")
+                continue
+            conversation_id = data.get('id') or os.path.splitext(os.path.basename(path))[0]
+            if conversation_id in existing:
+                continue
+            data['id'] = conversation_id
+            data.setdefault('messages', [])
+            _upsert_conversation(conn, data)
+            _insert_messages(conn, conversation_id, data['messages'], 0)
+            existing.add(conversation_id)
+            imported += 1
+            pending += 1
+            if pending >= batch_size:
+                conn.execute("COMMIT")
+                conn.execute("BEGIN")
+                pending = 0
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite 对话存储工具")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help="从 JSON / JSONL 对话文件迁移到数据库")
+    migrate_parser.add_argument('--storage-dir', default="conversations", help="对话文件目录")
+    migrate_parser.add_argument('--db', default="conversations.db", help="数据库路径")
+    search_parser = subparsers.add_parser('search', help="全文搜索历史对话")
+    search_parser.add_argument('query', help="搜索内容")
+    search_parser.add_argument('--db', default="conversations.db", help="数据库路径")
+    search_parser.add_argument('--limit', type=int, default=20, help="最多返回的结果数")
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        count = migrate_from_files(args.storage_dir, args.db)
+        print(f"已导入 {count} 个对话到 {args.db}")
+    else:
+        memory = SQLiteConversationMemory(args.db)
+        for hit in memory.search(args.query, args.limit):
+            print(f"{hit['conversation_id']} #{hit['index']} ({hit['role']}): {hit['snippet']}")
+        memory.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""本地 OpenAI 兼容替身服务器
+
+不需要网络和 API 密钥即可测试各页面的性能，三种模式：
+    synth   按设定的首字耗时分布、输出速度合成流式回答
+    replay  按录制时的节奏重放 cassettes/ 中的录制文件，没有对应录制时按 --on-miss 处理
+    record  把请求转发到 --upstream 指定的真实接口，边转发边录制为录制文件
+
+synth 和 replay 模式可以按比例注入错误状态码、输出中途停顿和连接中断，用于检验重试和超时处理。
+把 .env 中的 BASE_URL 设为 http://127.0.0.1:8000/v1 后运行 main_app.py 即可。
+
+用法: python stand_in_server.py [--mode synth|replay|record] [--port 8000] [--cassettes cassettes]
+      [--upstream URL] [--tokens-per-second 30] [--ttft-ms 400] [--ttft-sigma 0.5] [--error-rate 0.05]
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from context_builder import MESSAGE_OVERHEAD, estimate_tokens
+from stream_cassette import CassetteLibrary, StreamRecorder, cassette_key
+
+# 合成回答使用的词表
+VOCAB = ("这是", "一个", "本地", "替身", "服务器", "生成", "的", "回答", "，", "用于", "测试", "流式", "输出",
+         "和", "重试", "。", "The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", ".")
+
+ERROR_MESSAGES = {429: "rate limit exceeded", 500: "internal server error", 502: "bad gateway",
+                  503: "service unavailable", 504: "gateway timeout"}
+
+
+class StandInSettings:
+    def __init__(self, mode="synth", cassettes="cassettes", on_miss="synth", upstream=None, upstream_key=None,
+                 tokens_per_second=30.0, ttft_ms=400.0, ttft_sigma=0.5, max_tokens=200, speed=1.0,
+                 error_rate=0.0, error_status=(429, 500, 503), stall_rate=0.0, stall_seconds=60.0,
+                 disconnect_rate=0.0, seed=None):
+        self.mode = mode
+        self.cassettes = cassettes
+        # replay 模式下没有对应录制时：synth 合成回答，cycle 轮流重放已有录制，error 返回 404
+        self.on_miss = on_miss
+        self.upstream = upstream.rstrip('/') if upstream else None
+        self.upstream_key = upstream_key
+        self.tokens_per_second = tokens_per_second
+        # 首字耗时服从对数正态分布，ttft_ms 为中位数，ttft_sigma 越大长尾越明显
+        self.ttft_ms = ttft_ms
+        self.ttft_sigma = ttft_sigma
+        self.max_tokens = max_tokens
+        # 重放速度倍数，2 表示按录制时一半的耗时重放
+        self.speed = speed
+        self.error_rate = error_rate
+        self.error_status = tuple(error_status)
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.disconnect_rate = disconnect_rate
+        self.seed = seed
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, StandInHandler)
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.random_lock = threading.Lock()
+        self.library = CassetteLibrary(settings.cassettes) if settings.mode in ("replay", "record") else None
+        self.ids = itertools.count(1)
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'replayed': 0, 'synthesized': 0, 'recorded': 0,
+                      'errors': 0, 'stalls': 0, 'disconnects': 0}
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def draw(self, func, *args):
+        """在共享的随机数生成器上取值，指定 --seed 时整次运行可复现"""
+        with self.random_lock:
+            return getattr(self.random, func)(*args)
+
+    def sample_ttft(self):
+        return self.settings.ttft_ms / 1000 * math.exp(self.settings.ttft_sigma * self.draw('gauss', 0, 1))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error_status(self, status):
+        headers = {"Retry-After": "1"} if status == 429 else None
+        self._send_json(status, {'error': {'message': ERROR_MESSAGES.get(status, "error"),
+                                           'type': "stand_in_error", 'code': status}}, headers)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _send_event(self, data):
+        payload = f"data: {data}\n\n".encode('utf-8')
+        self.wfile.write(f"{len(payload):X}\r\n".encode('ascii') + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith("/models"):
+            self._send_json(200, {'object': "list", 'data': [{'id': "stand-in", 'object': "model"}]})
+        else:
+            self._send_error_status(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {'error': {'message': "invalid JSON body", 'type': "invalid_request_error"}})
+            return
+        if not self.path.rstrip('/').endswith("/chat/completions"):
+            self._send_error_status(404)
+            return
+        server = self.server
+        server.count('requests')
+        try:
+            if server.settings.mode == "record":
+                self._proxy_and_record(body)
+                return
+            if server.settings.error_rate and server.draw('random') < server.settings.error_rate:
+                server.count('errors')
+                self._send_error_status(server.draw('choice', server.settings.error_status))
+                return
+            cassette = None
+            if server.settings.mode == "replay":
+                cassette = server.library.get(cassette_key(body))
+                if cassette is None and server.settings.on_miss == "cycle":
+                    cassette = server.library.next()
+                if cassette is None and server.settings.on_miss == "error":
+                    self._send_error_status(404)
+                    return
+            if cassette is not None:
+                server.count('replayed')
+                self._replay(body, cassette)
+            else:
+                server.count('synthesized')
+                self._synthesize(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开（停止回答或取消对冲请求）
+            self.close_connection = True
+
+    def _faults(self, total):
+        """返回 (停顿发生在第几个数据块, 断开发生在第几个数据块)，不发生时为 None"""
+        server = self.server
+        stall_at = disconnect_at = None
+        if server.settings.stall_rate and server.draw('random') < server.settings.stall_rate:
+            stall_at = server.draw('randint', 1, max(1, total - 1))
+        if server.settings.disconnect_rate and server.draw('random') < server.settings.disconnect_rate:
+            disconnect_at = server.draw('randint', 1, max(1, total - 1))
+        return stall_at, disconnect_at
+
+    def _inject(self, index, stall_at, disconnect_at):
+        """在第 index 个数据块前注入停顿或断开，断开时返回 True"""
+        if index == stall_at:
+            self.server.count('stalls')
+            time.sleep(self.server.settings.stall_seconds)
+        if index == disconnect_at:
+            self.server.count('disconnects')
+            self.close_connection = True
+            return True
+        return False
+
+    def _chunk(self, completion_id, model, delta, finish_reason=None):
+        return json.dumps({'id': completion_id, 'object': "chat.completion.chunk", 'created': int(time.time()),
+                           'model': model, 'choices': [{'index': 0, 'delta': delta,
+                                                        'finish_reason': finish_reason}]},
+                          ensure_ascii=False)
+
+    def _synthesize(self, body):
+        server = self.server
+        settings = server.settings
+        model = body.get('model', "stand-in")
+        completion_id = f"chatcmpl-standin-{next(server.ids)}"
+        total = max(1, int(body.get('max_tokens') or settings.max_tokens))
+        total = server.draw('randint', max(1, total // 2), total)
+        tokens = [server.draw('choice', VOCAB) for _ in range(total)]
+        ttft = server.sample_ttft()
+        if not body.get('stream'):
+            time.sleep(ttft + total / settings.tokens_per_second)
+            self._send_json(200, self._completion(body, completion_id, ''.join(tokens), total))
+            return
+        stall_at, disconnect_at = self._faults(total)
+        self._start_stream()
+        self._send_event(self._chunk(completion_id, model, {'role': "assistant", 'content': ""}))
+        time.sleep(ttft)
+        for index, token in enumerate(tokens):
+            if index:
+                time.sleep(server.draw('uniform', 0.5, 1.5) / settings.tokens_per_second)
+            if self._inject(index, stall_at, disconnect_at):
+                return
+            self._send_event(self._chunk(completion_id, model, {'content': token}))
+        self._send_event(self._chunk(completion_id, model, {}, "stop"))
+        if (body.get('stream_options') or {}).get('include_usage'):
+            self._send_event(json.dumps({'id': completion_id, 'object': "chat.completion.chunk",
+                                         'created': int(time.time()), 'model': model, 'choices': [],
+                                         'usage': self._usage(body, total)}))
+        self._send_event("[DONE]")
+        self._end_stream()
+
+    def _replay(self, body, cassette):
+        speed = self.server.settings.speed
+        if not body.get('stream'):
+            if cassette.events:
+                time.sleep(cassette.events[-1][0] / speed)
+            content = cassette.content()
+            self._send_json(200, self._completion(body, f"chatcmpl-standin-{next(self.server.ids)}", content,
+                                                  estimate_tokens(content)))
+            return
+        stall_at, disconnect_at = self._faults(len(cassette.events))
+        self._start_stream()
+        start = time.perf_counter()
+        for index, (offset, data) in enumerate(cassette.events):
+            delay = offset / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            if self._inject(index, stall_at, disconnect_at):
+                return
+            self._send_event(data)
+        self._end_stream()
+
+    def _usage(self, body, completion_tokens):
+        prompt_tokens = sum(estimate_tokens(str(msg.get('content', ''))) + MESSAGE_OVERHEAD
+                            for msg in body.get('messages', []))
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens}
+
+    def _completion(self, body, completion_id, content, completion_tokens):
+        return {'id': completion_id, 'object': "chat.completion", 'created': int(time.time()),
+                'model': body.get('model', "stand-in"),
+                'choices': [{'index': 0, 'message': {'role': "assistant", 'content': content},
+                             'finish_reason': "stop"}],
+                'usage': self._usage(body, completion_tokens)}
+
+    def _proxy_and_record(self, body):
+        """转发到真实接口并原样返回，完整结束的流式回答保存为录制文件"""
+        settings = self.server.settings
+        headers = {"Content-Type": "application/json"}
+        authorization = self.headers.get("Authorization")
+        if settings.upstream_key:
+            authorization = f"Bearer {settings.upstream_key}"
+        if authorization:
+            headers["Authorization"] = authorization
+        request = urllib.request.Request(settings.upstream + "/chat/completions",
+                                         data=json.dumps(body).encode('utf-8'), headers=headers, method="POST")
+        try:
+            response = urllib.request.urlopen(request, timeout=120)
+        except urllib.error.HTTPError as e:
+            payload = e.read()
+            self.send_response(e.code)
+            self.send_header("Content-Type", e.headers.get("Content-Type", "application/json"))
+            self.send_header("Content-Length", str(len(payload)))
+            if e.headers.get("Retry-After"):
+                self.send_header("Retry-After", e.headers["Retry-After"])
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        except urllib.error.URLError as e:
+            self._send_json(502, {'error': {'message': f"upstream unreachable: {e.reason}", 'type': "stand_in_error"}})
+            return
+        with response:
+            if not body.get('stream'):
+                payload = response.read()
+                self.send_response(response.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+            recorder = StreamRecorder(body)
+            self._start_stream()
+            done = False
+            for raw in response:
+                line = raw.decode('utf-8').strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                recorder.add(data)
+                self._send_event(data)
+                if data == "[DONE]":
+                    done = True
+                    break
+            self._end_stream()
+        if done:
+            self.server.library.add(recorder.finish())
+            self.server.count('recorded')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容替身服务器")
+    parser.add_argument('--mode', choices=['synth', 'replay', 'record'], default='synth', help="运行模式")
+    parser.add_argument('--host', default="127.0.0.1", help="监听地址")
+    parser.add_argument('--port', type=int, default=8000, help="监听端口")
+    parser.add_argument('--cassettes', default="cassettes", help="录制文件目录")
+    parser.add_argument('--on-miss', choices=['synth', 'cycle', 'error'], default='synth',
+                        help="replay 模式下没有对应录制时的处理方式")
+    parser.add_argument('--upstream', default=None,
+                        help="record 模式转发到的接口地址，例如 https://api.siliconflow.cn/v1")
+    parser.add_argument('--upstream-key', default=None, help="record 模式使用的 API 密钥，默认使用客户端请求中的密钥")
+    parser.add_argument('--tokens-per-second', type=float, default=30.0, help="合成回答的输出速度")
+    parser.add_argument('--ttft-ms', type=float, default=400.0, help="合成回答首字耗时的中位数（毫秒）")
+    parser.add_argument('--ttft-sigma', type=float, default=0.5, help="首字耗时对数正态分布的 sigma")
+    parser.add_argument('--max-tokens', type=int, default=200, help="合成回答的最大 token 数")
+    parser.add_argument('--speed', type=float, default=1.0, help="重放速度倍数")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回错误状态码的比例")
+    parser.add_argument('--error-status', default="429,500,503", help="注入的错误状态码，逗号分隔")
+    parser.add_argument('--stall-rate', type=float, default=0.0, help="输出中途停顿的比例")
+    parser.add_argument('--stall-seconds', type=float, default=60.0, help="停顿秒数")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help="输出中途断开连接的比例")
+    parser.add_argument('--seed', type=int, default=None, help="随机数种子，指定后延迟和错误注入可复现")
+    args = parser.parse_args()
+
+    if args.mode == "record" and not args.upstream:
+        parser.error("record 模式需要 --upstream")
+    settings = StandInSettings(
+        mode=args.mode, cassettes=args.cassettes, on_miss=args.on_miss, upstream=args.upstream,
+        upstream_key=args.upstream_key,
+        tokens_per_second=args.tokens_per_second, ttft_ms=args.ttft_ms, ttft_sigma=args.ttft_sigma,
+        max_tokens=args.max_tokens, speed=args.speed, error_rate=args.error_rate,
+        error_status=[int(status) for status in args.error_status.split(',') if status.strip()],
+        stall_rate=args.stall_rate, stall_seconds=args.stall_seconds, disconnect_rate=args.disconnect_rate,
+        seed=args.seed)
+    server = StandInServer((args.host, args.port), settings)
+    print(f"替身服务器已启动（{args.mode} 模式）: http://{args.host}:{server.server_address[1]}/v1")
+    if server.library is not None:
+        print(f"已载入 {len(server.library)} 个录制文件")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("统计: " + json.dumps(server.stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""流式回答的录制文件（cassette）
+
+一个录制文件保存一次 chat.completions 流式请求：请求参数、响应状态，以及每一行 SSE 数据
+和它相对请求发出时刻的秒数，本地替身服务器（stand_in_server.py）可以按原来的节奏重放。
+录制文件按请求内容（消息和温度，不含模型名）命名，同一请求再次录制时覆盖旧文件。
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from response_cache import make_cache_key
+
+CASSETTE_SUFFIX = ".cassette.json"
+
+
+def cassette_key(body):
+    """请求体对应的录制文件键；不含模型名，切换接口或模型后仍能命中"""
+    return make_cache_key("", body.get('messages', []), body.get('temperature', 1.0))
+
+
+class Cassette:
+    def __init__(self, request, status, events, recorded_at=None):
+        self.request = request
+        self.status = status
+        # [(相对请求发出时刻的秒数, SSE 数据行)]，数据行不含 "data: " 前缀
+        self.events = events
+        self.recorded_at = recorded_at if recorded_at is not None else time.time()
+
+    @property
+    def key(self):
+        return cassette_key(self.request)
+
+    def content(self):
+        """拼接全部内容块，得到完整回答"""
+        parts = []
+        for _, data in self.events:
+            if data == "[DONE]":
+                continue
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            for choice in chunk.get('choices') or ():
+                parts.append((choice.get('delta') or {}).get('content') or '')
+        return ''.join(parts)
+
+    def to_dict(self):
+        return {'request': self.request, 'status': self.status, 'recorded_at': self.recorded_at,
+                'events': self.events}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['request'], data.get('status', 200), [tuple(event) for event in data['events']],
+                   data.get('recorded_at'))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+    def save(self, directory):
+        """原子地写入 directory，返回文件路径"""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.key + CASSETTE_SUFFIX)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+
+class StreamRecorder:
+    """边转发边记录一次流式响应，finish() 时生成录制文件"""
+
+    def __init__(self, request):
+        self.request = request
+        self.start = time.perf_counter()
+        self.events = []
+
+    def add(self, data):
+        self.events.append((round(time.perf_counter() - self.start, 4), data))
+
+    def finish(self, status=200):
+        return Cassette(self.request, status, self.events)
+
+
+class CassetteLibrary:
+    """目录中的全部录制文件，按键查找；找不到时可按顺序轮流取用，用于提示词各不相同的压测"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.cassettes = {}
+        self.order = []
+        self.position = 0
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith(CASSETTE_SUFFIX):
+                    continue
+                try:
+                    self._add(Cassette.load(os.path.join(directory, name)))
+                except Exception as e:
+                    print(f"读取录制文件 {name} 失败: {e}")
+
+    def __len__(self):
+        return len(self.cassettes)
+
+    def _add(self, cassette):
+        if cassette.key not in self.cassettes:
+            self.order.append(cassette.key)
+        self.cassettes[cassette.key] = cassette
+
+    def add(self, cassette):
+        """保存新录制的文件并加入库中"""
+        cassette.save(self.directory)
+        with self.lock:
+            self._add(cassette)
+
+    def get(self, key):
+        with self.lock:
+            return self.cassettes.get(key)
+
+    def next(self):
+        """按顺序轮流返回录制文件，库为空时返回 None"""
+        with self.lock:
+            if not self.order:
+                return None
+            key = self.order[self.position % len(self.order)]
+            self.position += 1
+            return self.cassettes[key]
@@ -0,0 +1,279 @@
+"""流式请求的耗时和吞吐统计
+
+每个请求记录一条 RequestMetrics：排队、建立连接、第一个字节、第一个内容块、最后一个内容块
+的时间，数据块数量和 token 用量（服务端通过 stream_options 的 include_usage 返回，不支持时
+按字符估算）。MetricsRegistry 在内存中保存累计直方图和最近若干次请求的滚动样本，可以导出
+为 Prometheus 文本格式，写入本地文件或通过 HTTP 端点提供。
+"""
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from retry_policy import LatencyTracker
+
+METRIC_PREFIX = "aiagent"
+
+# 秒数直方图的分桶上限
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500)
+COUNT_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class RequestMetrics:
+    """一次流式请求的计时记录，时间点均为 time.perf_counter() 的值，未发生时为 None"""
+
+    __slots__ = ('endpoint', 'model', 'priority', 'cached', 'outcome', 'retries',
+                 'enqueued', 'dispatched', 'sent', 'connected', 'first_byte', 'first_token', 'last_token',
+                 'chunks', 'prompt_tokens', 'completion_tokens', 'usage_reported')
+
+    def __init__(self, enqueued, model=None, priority=None):
+        self.endpoint = None
+        self.model = model
+        self.priority = priority
+        self.cached = False
+        # ok / error / stopped / cancelled
+        self.outcome = None
+        self.retries = 0
+        self.enqueued = enqueued
+        self.dispatched = None
+        self.sent = None
+        self.connected = None
+        self.first_byte = None
+        self.first_token = None
+        self.last_token = None
+        self.chunks = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.usage_reported = False
+
+    def _since(self, start, end):
+        return end - start if start is not None and end is not None else None
+
+    @property
+    def queue_seconds(self):
+        """从提交请求到调度器放行（第一次）的等待时间"""
+        return self._since(self.enqueued, self.dispatched)
+
+    @property
+    def connect_seconds(self):
+        """最终成功的那次请求从发出到收到响应头的时间"""
+        return self._since(self.sent, self.connected)
+
+    @property
+    def first_byte_seconds(self):
+        return self._since(self.enqueued, self.first_byte)
+
+    @property
+    def ttft_seconds(self):
+        return self._since(self.enqueued, self.first_token)
+
+    @property
+    def total_seconds(self):
+        return self._since(self.enqueued, self.last_token)
+
+    @property
+    def tokens_per_second(self):
+        """第一个到最后一个内容块之间的输出速度"""
+        seconds = self._since(self.first_token, self.last_token)
+        if not seconds or not self.completion_tokens:
+            return None
+        return self.completion_tokens / seconds
+
+    def to_dict(self):
+        return {
+            'endpoint': self.endpoint,
+            'model': self.model,
+            'priority': self.priority,
+            'cached': self.cached,
+            'outcome': self.outcome,
+            'retries': self.retries,
+            'queue_seconds': self.queue_seconds,
+            'connect_seconds': self.connect_seconds,
+            'first_byte_seconds': self.first_byte_seconds,
+            'ttft_seconds': self.ttft_seconds,
+            'total_seconds': self.total_seconds,
+            'tokens_per_second': self.tokens_per_second,
+            'chunks': self.chunks,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'usage_reported': self.usage_reported,
+        }
+
+
+class Histogram:
+    """累计分桶计数（供 Prometheus 使用）加最近若干个样本（用于计算 p50/p95）"""
+
+    def __init__(self, buckets, window=500):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+        self.recent = LatencyTracker(window)
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+        self.recent.add(value)
+
+    def cumulative(self):
+        """按 Prometheus 约定返回 [(上限, 小于等于该上限的样本数)]"""
+        result = []
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+
+# 直方图名称 -> (RequestMetrics 属性, 分桶, 说明)
+HISTOGRAMS = {
+    'queue_seconds': ('queue_seconds', SECONDS_BUCKETS, "请求在调度器中排队的秒数"),
+    'connect_seconds': ('connect_seconds', SECONDS_BUCKETS, "发出请求到收到响应头的秒数"),
+    'first_byte_seconds': ('first_byte_seconds', SECONDS_BUCKETS, "提交请求到收到第一个数据块的秒数"),
+    'ttft_seconds': ('ttft_seconds', SECONDS_BUCKETS, "提交请求到收到第一个内容块的秒数"),
+    'total_seconds': ('total_seconds', SECONDS_BUCKETS, "提交请求到收到最后一个内容块的秒数"),
+    'tokens_per_second': ('tokens_per_second', RATE_BUCKETS, "第一个到最后一个内容块之间每秒输出的 token 数"),
+    'chunks': ('chunks', COUNT_BUCKETS, "每个回答的数据块数量"),
+}
+
+
+class MetricsRegistry:
+    def __init__(self, window=500):
+        self.lock = threading.Lock()
+        self.histograms = {name: Histogram(buckets, window) for name, (_, buckets, _) in HISTOGRAMS.items()}
+        # (接口, 结果) -> 请求数
+        self.requests = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.server = None
+        self.exporter = None
+        self.closing = threading.Event()
+
+    def record(self, metrics):
+        """记录一次结束的请求；缓存命中只计数，不计入耗时直方图"""
+        with self.lock:
+            outcome = "cached" if metrics.cached else metrics.outcome or "ok"
+            key = (metrics.endpoint or "", outcome)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if metrics.cached:
+                return
+            self.prompt_tokens += metrics.prompt_tokens
+            self.completion_tokens += metrics.completion_tokens
+            self.retries += metrics.retries
+            for name, (attribute, _, _) in HISTOGRAMS.items():
+                if name == 'chunks' and metrics.first_token is None:
+                    continue
+                value = getattr(metrics, attribute)
+                if value is not None:
+                    self.histograms[name].observe(value)
+
+    def summary(self):
+        """各项指标最近若干次请求的 p50/p95 和样本数，供界面显示"""
+        with self.lock:
+            result = {name: {'p50': histogram.recent.percentile(50),
+                             'p95': histogram.recent.percentile(95),
+                             'count': len(histogram.recent)}
+                      for name, histogram in self.histograms.items()}
+            result['requests'] = sum(self.requests.values())
+            result['errors'] = sum(n for (_, outcome), n in self.requests.items() if outcome == "error")
+            result['prompt_tokens'] = self.prompt_tokens
+            result['completion_tokens'] = self.completion_tokens
+            result['retries'] = self.retries
+            return result
+
+    def prometheus_text(self):
+        """导出为 Prometheus 文本格式"""
+        lines = []
+        with self.lock:
+            name = f"{METRIC_PREFIX}_requests_total"
+            lines += [f"# HELP {name} 结束的流式请求数", f"# TYPE {name} counter"]
+            for (endpoint, outcome), count in sorted(self.requests.items()):
+                lines.append(f'{name}{{endpoint="{endpoint}",outcome="{outcome}"}} {count}')
+            for suffix, value, help_text in (("prompt_tokens_total", self.prompt_tokens, "输入 token 数"),
+                                             ("completion_tokens_total", self.completion_tokens, "输出 token 数"),
+                                             ("retries_total", self.retries, "首字前的重试次数")):
+                name = f"{METRIC_PREFIX}_{suffix}"
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+            for metric, (_, _, help_text) in HISTOGRAMS.items():
+                histogram = self.histograms[metric]
+                name = f"{METRIC_PREFIX}_{metric}"
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{name}_bucket{{le="{bound:g}"}} {count}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum {histogram.total:.6f}")
+                lines.append(f"{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """原子地把当前指标写入文件（可供 node_exporter 的 textfile 收集器读取）"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"写入指标文件 {path} 失败: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def start_file_exporter(self, path, interval=15.0):
+        """每隔 interval 秒把指标写入 path，close() 时再写一次"""
+        def run():
+            while not self.closing.wait(interval):
+                self.write(path)
+            self.write(path)
+
+        self.exporter = threading.Thread(target=run, name="metrics-exporter", daemon=True)
+        self.exporter.start()
+
+    def serve(self, port, host="127.0.0.1"):
+        """在后台线程中启动 HTTP 服务，GET /metrics 返回 Prometheus 文本"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"启动指标服务失败（端口 {port}）: {e}")
+            return None
+        threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True).start()
+        return self.server.server_address[1]
+
+    def start_from_env(self):
+        """按 .env 中的 METRICS_FILE / METRICS_PORT 启动导出"""
+        path = os.getenv("METRICS_FILE", "")
+        if path:
+            self.start_file_exporter(path, float(os.getenv("METRICS_FILE_INTERVAL", "15")))
+        port = int(os.getenv("METRICS_PORT", "0"))
+        if port:
+            self.serve(port)
+
+    def close(self):
+        self.closing.set()
+        if self.exporter is not None:
+            self.exporter.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()